@@ -2,4 +2,9 @@
 __author__ = 'kevin@isolationism.com'
 __version__ = (0, 1, 6)
 
-from imagecraft import *
+from .imagecraft import *
+from .layer_cache import LayerCache, layer_cache
+from .layer_store import LayerStore
+from .prefix_cache import PrefixCache
+from .pool import RenderPool
+from .result_cache import ResultCache
@@ -0,0 +1,6 @@
+# Allows the command line tool to be run with `python -m imagecraft`
+import sys
+
+from .cli import main
+
+sys.exit(main())
@@ -0,0 +1,179 @@
+"""
+Asyncio support for rendering from inside an event loop (Python 3.7+).
+
+Compositing and encoding are CPU-bound and would block the event loop for
+the whole render, so an AsyncRenderer hands them to an executor and awaits
+the result:
+
+    renderer = AsyncRenderer(max_in_flight=4, timeout=10)
+
+    async def skin(request):
+        data = await renderer.render(Button(request.palette), 'PNG')
+        ...
+
+A semaphore bounds the number of renders running (or queued) in the
+executor at once, so a burst of requests waits its turn on the loop instead
+of piling work up in the executor. A render that is cancelled or times out
+is cancelled in the executor if it has not started yet; one that is already
+running keeps its slot until it actually finishes, so the limit always
+reflects the work really in progress.
+
+This module is not imported by the package itself, as it requires Python 3.
+ImageGenerator.render_async is a shortcut to the default renderer.
+"""
+
+# Standard library
+import asyncio
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncRenderer(object):
+    """
+    Renders ImageGenerator instances to encoded bytes without blocking the
+    event loop.
+
+    PIL releases the GIL while it composites and encodes, so the default
+    thread pool gives real parallelism; pass a ProcessPoolExecutor instead
+    to sidestep the GIL entirely (generators must then be picklable).
+    """
+
+    def __init__(self, executor=None, max_in_flight=None, timeout=None):
+        """
+        Constructor.
+
+        executor - (optional) The concurrent.futures executor renders run
+            in. By default a ThreadPoolExecutor is created on first use and
+            shut down by close().
+
+        max_in_flight - (optional) The maximum number of renders submitted to
+            the executor at once. Defaults to no limit.
+
+        timeout - (optional) The default number of seconds to wait for each
+            render before giving up with asyncio.TimeoutError.
+        """
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self._executor = executor
+        self._owns_executor = executor is None
+        # Semaphores belong to the loop they are first used on
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    @property
+    def executor(self):
+        """The executor renders are submitted to"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        return self._executor
+
+    def close(self, wait=True):
+        """Shuts down the executor, if it was created by this renderer."""
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    async def render(self, generator, image_format=None, timeout=None):
+        """
+        Renders `generator` and returns the encoded file contents as bytes,
+        like ImageGenerator.render_bytes.
+
+        timeout - (optional) Seconds to wait before raising
+            asyncio.TimeoutError; defaults to the renderer's timeout.
+
+        * Raises whatever render_bytes raises for the generator.
+        """
+        return await self.run(generator.render_bytes, image_format,
+                              timeout=timeout)
+
+    async def render_many(self, generators, image_format=None, timeout=None,
+                          return_exceptions=False):
+        """
+        Renders every generator in `generators` concurrently (subject to
+        max_in_flight) and returns the list of encoded results, in order.
+
+        return_exceptions - (optional) If True, a failed render is returned
+            in place of its result instead of raising; otherwise the first
+            failure is raised and the remaining renders are cancelled.
+        """
+        tasks = [asyncio.ensure_future(self.render(generator, image_format,
+                                                   timeout))
+                 for generator in generators]
+        try:
+            return await asyncio.gather(*tasks,
+                                        return_exceptions=return_exceptions)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def run(self, func, *args, timeout=None):
+        """
+        Calls func(*args) in the executor, once a slot is free, and returns
+        its result. Takes the same timeout argument as render; the timeout
+        covers the wait for a slot as well as the call itself.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        return await asyncio.wait_for(self._run(func, args), timeout)
+
+    async def _run(self, func, args):
+        """Submits a call to the executor while holding a semaphore slot"""
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphore(loop)
+        if semaphore is not None:
+            await semaphore.acquire()
+
+        try:
+            future = self.executor.submit(func, *args)
+        except BaseException:
+            if semaphore is not None:
+                semaphore.release()
+            raise
+
+        if semaphore is not None:
+            # Release the slot when the call really ends, not when the
+            # caller stops waiting for it
+            future.add_done_callback(
+                lambda future: loop.call_soon_threadsafe(semaphore.release))
+
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # Drops the call if it has not started yet
+            future.cancel()
+            raise
+
+    def _semaphore(self, loop):
+        """Returns the semaphore for the given loop, or None if unlimited"""
+        if not self.max_in_flight:
+            return None
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(
+                self.max_in_flight)
+        return semaphore
+
+
+# The renderer used by ImageGenerator.render_async when none is given.
+default_renderer = AsyncRenderer()
+
+
+async def render_async(generator, image_format=None, timeout=None,
+                       renderer=None):
+    """
+    Renders `generator` with `renderer` (by default, the shared
+    default_renderer) and returns the encoded bytes.
+    """
+    renderer = renderer or default_renderer
+    return await renderer.render(generator, image_format, timeout)
+
+
+async def render_many_async(generators, image_format=None, timeout=None,
+                            return_exceptions=False, renderer=None):
+    """
+    Renders every generator in `generators` with `renderer` (by default, the
+    shared default_renderer) and returns the encoded results, in order.
+    """
+    renderer = renderer or default_renderer
+    return await renderer.render_many(generators, image_format, timeout,
+                                      return_exceptions)
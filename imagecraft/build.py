@@ -0,0 +1,389 @@
+"""
+Renders many generators against many palettes, optionally in parallel.
+
+A build is described by a list of jobs. Each job names some ImageGenerator
+subclasses, some palettes (named color dictionaries) and where the output
+should go; every generator is rendered once for every palette in its job.
+
+    jobs = [{
+        'generators': ['myskins.buttons:Button', 'myskins.tabs.Tab'],
+        'palettes': {'acme': {'dark_color': '#227'}, 'globex': {...}},
+        'output_path': '/srv/skins/{palette}',
+    }]
+    for result in build(jobs, workers=4):
+        print(result)
+
+A job may also list `scales` (such as [1, 2, 3]) to render every image at
+each of those pixel densities; see ImageGenerator.source_scale.
+
+The same structure can be stored as JSON and built with `imagecraft build`.
+Renders are grouped into chunks of one generator and several palettes, so
+each worker process can render its chunk with ImageGenerator.render_many.
+A failed render is reported in its BuildResult; it never stops the build,
+and neither does a generator that cannot be imported.
+Outputs whose inputs have not changed since they were last written are
+skipped (see ImageGenerator.fingerprint) unless the build is forced.
+"""
+
+# Standard library
+import json
+import os
+import time
+import traceback
+
+try:
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+except ImportError:
+    # Python 2 needs the `futures` backport for parallel builds
+    ProcessPoolExecutor = None
+
+
+class BuildTask(object):
+    """A single generator to render against a single palette."""
+
+    def __init__(self, generator, palette_name, palette, output_path,
+                 source_path=None, scale=None):
+        """
+        Constructor.
+
+        generator - The ImageGenerator subclass to render, or its import
+            path if it could not be imported.
+
+        palette_name - The name of the palette, used in reports and paths.
+
+        palette - The color dictionary to render with.
+
+        output_path - The directory the rendered file is written to.
+
+        source_path - (optional) Passed through to the generator.
+
+        scale - (optional) Passed through to the generator.
+        """
+        self.generator = generator
+        self.palette_name = palette_name
+        self.palette = palette
+        self.output_path = output_path
+        self.source_path = source_path
+        self.scale = scale
+
+    def make_generator(self):
+        """Returns the generator instance for this task."""
+        return self.generator(self.palette, source_path=self.source_path,
+                              output_path=self.output_path, scale=self.scale)
+
+
+class BuildResult(object):
+    """The outcome of a single BuildTask."""
+
+    def __init__(self, task, filename=None, seconds=0.0, error=None,
+                 skipped=False):
+        """
+        Constructor.
+
+        task - The BuildTask this is the result of.
+
+        filename - The file that was written (or skipped), if any.
+
+        seconds - Wall time spent rendering and writing the file. Files
+            rendered together in a batch (see ImageGenerator.render_many)
+            each get their own write time plus an even share of the time
+            the batch took to render.
+
+        error - The formatted traceback if the render failed, otherwise None.
+
+        skipped - True if the file was already up to date.
+        """
+        self.generator_name = _generator_name(task.generator)
+        self.palette_name = task.palette_name
+        self.filename = filename
+        self.seconds = seconds
+        self.error = error
+        self.skipped = skipped
+
+    @property
+    def ok(self):
+        """True if the file was rendered successfully"""
+        return self.error is None
+
+    def __str__(self):
+        if self.skipped:
+            return "skip  %7.3fs  %s [%s] -> %s" % (
+                self.seconds, self.generator_name, self.palette_name,
+                self.filename)
+        elif self.ok:
+            return "ok    %7.3fs  %s [%s] -> %s" % (
+                self.seconds, self.generator_name, self.palette_name,
+                self.filename)
+        return "FAIL  %7.3fs  %s [%s]\n%s" % (
+            self.seconds, self.generator_name, self.palette_name,
+            self.error.rstrip())
+
+
+def load_generator(dotted_path):
+    """
+    Imports and returns a generator class from a path such as
+    "package.module:ClassName" or "package.module.ClassName".
+
+    * Raises ImportError if the module or class cannot be found.
+    """
+    if ':' in dotted_path:
+        module_name, class_name = dotted_path.split(':', 1)
+    else:
+        module_name, unused, class_name = dotted_path.rpartition('.')
+
+    module = __import__(module_name, fromlist=[class_name])
+    try:
+        return getattr(module, class_name)
+    except AttributeError:
+        raise ImportError("Module %s has no generator %s" % (module_name,
+                                                             class_name))
+
+
+def load_jobs(spec_path):
+    """
+    Reads a JSON build specification and returns its list of jobs. The file
+    may hold either a list of jobs or an object with a "jobs" list.
+
+    Palettes may be given inline or as the path of a JSON file holding the
+    color dictionary; relative paths (including output_path and
+    source_path) are resolved against the directory of the spec file.
+    """
+    with open(spec_path) as fp:
+        spec = json.load(fp)
+    if isinstance(spec, dict):
+        spec = spec['jobs']
+
+    here = os.path.dirname(os.path.abspath(spec_path))
+    for job in spec:
+        palettes = {}
+        for name, palette in job['palettes'].items():
+            if not hasattr(palette, 'keys'):
+                with open(os.path.join(here, palette)) as fp:
+                    palette = json.load(fp)
+            palettes[name] = palette
+        job['palettes'] = palettes
+
+        for key in ('output_path', 'source_path'):
+            if job.get(key):
+                job[key] = os.path.join(here, job[key])
+
+    return spec
+
+
+def expand_jobs(jobs, failures=None):
+    """
+    Returns the list of BuildTasks described by `jobs`. Generators may be
+    given as classes or as import paths understood by load_generator.
+
+    The output_path of a job may contain {palette} and {generator}
+    placeholders, which are filled in for each task.
+
+    failures - (optional) A list to which a failed BuildResult is appended
+        for each task of a generator that cannot be imported, instead of
+        raising. The other generators' tasks are returned as usual.
+
+    * Raises ImportError if a generator cannot be imported and no failures
+      list is given.
+    """
+    tasks = []
+    for job in jobs:
+        for generator in job['generators']:
+            error = None
+            if not isinstance(generator, type):
+                try:
+                    generator = load_generator(generator)
+                except Exception:
+                    if failures is None:
+                        raise
+                    error = traceback.format_exc()
+
+            job_tasks = []
+            for palette_name in sorted(job['palettes']):
+                output_path = job['output_path'].format(
+                    palette=palette_name, generator=_generator_name(generator))
+                for scale in job.get('scales') or [None]:
+                    job_tasks.append(BuildTask(generator, palette_name,
+                                               job['palettes'][palette_name],
+                                               output_path,
+                                               job.get('source_path'), scale))
+            if error is None:
+                tasks.extend(job_tasks)
+            else:
+                failures.extend(BuildResult(task, error=error)
+                                for task in job_tasks)
+    return tasks
+
+
+def _generator_name(generator):
+    """Returns the name of a generator class, or of its import path"""
+    if isinstance(generator, type):
+        return generator.__name__
+    return generator.replace(':', '.').rpartition('.')[2]
+
+
+def _chunk_tasks(tasks, chunksize):
+    """
+    Groups tasks into lists of up to chunksize that share a generator,
+    source path and scale
+    """
+    chunks = []
+    open_chunks = {}
+    for task in tasks:
+        key = (task.generator, task.source_path, task.scale)
+        chunk = open_chunks.get(key)
+        if chunk is None or len(chunk) >= chunksize:
+            chunk = open_chunks[key] = []
+            chunks.append(chunk)
+        chunk.append(task)
+    return chunks
+
+
+def _write(task, image):
+    """Writes a rendered image out to the task's output path"""
+    if not os.path.isdir(task.output_path):
+        try:
+            os.makedirs(task.output_path)
+        except OSError:
+            # Another worker may have created it in the meantime
+            if not os.path.isdir(task.output_path):
+                raise
+
+    generator = task.make_generator()
+    generator._write_to_file(image)
+    return generator._output_file()
+
+
+def _render_one(task):
+    """Renders and writes a single task, returning its BuildResult"""
+    started = time.time()
+    try:
+        filename = _write(task, task.make_generator().render_image())
+    except Exception:
+        return BuildResult(task, seconds=time.time() - started,
+                           error=traceback.format_exc())
+    return BuildResult(task, filename, time.time() - started)
+
+
+def _check_up_to_date(task):
+    """
+    Returns a BuildResult if the task's output is already up to date (or its
+    inputs are invalid), otherwise None.
+    """
+    started = time.time()
+    try:
+        generator = task.make_generator()
+        if not generator.is_up_to_date():
+            return None
+        filename = generator._output_file()
+    except Exception:
+        return BuildResult(task, seconds=time.time() - started,
+                           error=traceback.format_exc())
+    return BuildResult(task, filename, time.time() - started, skipped=True)
+
+
+def _render_chunk(chunk, force=False):
+    """
+    Renders a list of tasks that share a generator, returning their
+    BuildResults. This runs inside the worker processes.
+    """
+    results = []
+    pending = []
+    for task in chunk:
+        result = None if force else _check_up_to_date(task)
+        if result is None:
+            pending.append(task)
+        else:
+            results.append(result)
+    if not pending:
+        return results
+
+    # (task, filename, seconds spent writing) for each file written
+    written = []
+    render_seconds = 0.0
+    generator = pending[0].generator
+    started = time.time()
+    try:
+        rendered = generator.render_many([task.palette for task in pending],
+                                         source_path=pending[0].source_path,
+                                         batch_size=len(pending),
+                                         scale=pending[0].scale)
+        for task, (palette, image) in zip(pending, rendered):
+            finished = time.time()
+            render_seconds += finished - started
+            filename = _write(task, image)
+            started = time.time()
+            written.append((task, filename, started - finished))
+    except Exception:
+        failed = pending[len(written):]
+    else:
+        failed = []
+
+    # The whole batch is rendered up front, so share its time out evenly
+    for task, filename, seconds in written:
+        results.append(BuildResult(task, filename,
+                                   seconds + render_seconds / len(written)))
+    # Render whatever is left one at a time to isolate the failure
+    results.extend(_render_one(task) for task in failed)
+    return results
+
+
+def build(jobs, workers=None, chunksize=8, force=False):
+    """
+    Renders every task described by `jobs`, yielding a BuildResult for each
+    one as it finishes.
+
+    workers - (optional) The number of worker processes. Defaults to the
+        number of processors; 1 renders everything in this process.
+
+    chunksize - (optional) The maximum number of palettes sent to a worker
+        for the same generator in one go.
+
+    force - (optional) Render every output, even those that are up to date.
+
+    A generator that cannot be imported yields a failed BuildResult for
+    each of its palettes and scales, and the rest of the build goes ahead.
+
+    * Raises ImportError if parallel workers are requested but
+      concurrent.futures is not available.
+    """
+    failures = []
+    tasks = expand_jobs(jobs, failures)
+    for result in failures:
+        yield result
+    for result in build_tasks(tasks, workers, chunksize, force):
+        yield result
+
+
+def build_tasks(tasks, workers=None, chunksize=8, force=False):
+    """
+    Like build, but renders a list of BuildTasks (see expand_jobs). A
+    single chunk of work is always rendered in this process.
+    """
+    chunks = _chunk_tasks(tasks, max(1, chunksize))
+
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            for result in _render_chunk(chunk, force):
+                yield result
+        return
+
+    if ProcessPoolExecutor is None:
+        raise ImportError("Parallel builds require concurrent.futures; "
+                          "install the `futures` package or use 1 worker")
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = dict((executor.submit(_render_chunk, chunk, force), chunk)
+                       for chunk in chunks)
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception:
+                # The worker itself died; fail the whole chunk
+                error = traceback.format_exc()
+                results = [BuildResult(task, error=error)
+                           for task in futures[future]]
+            for result in results:
+                yield result
+    finally:
+        executor.shutdown(wait=True)
@@ -0,0 +1,171 @@
+"""
+Theme bundles: every image of a skin for one palette, in a single archive.
+
+A bundle renders a set of generators for one palette and streams each image
+straight into a ZIP or tar archive as soon as it is encoded, so however many
+images a bundle holds, only one is ever in memory and nothing is written to
+disk but the archive itself (which may just as well be a pipe or socket):
+
+    with open('/tmp/acme.zip', 'wb') as fp:
+        manifest = export_bundle([Button, Tab, Star], acme_colors, fp)
+
+The archive ends with a manifest.json describing the palette and each file:
+the generator it came from, its format, scale, dimensions, size, SHA-1 and
+fingerprint (see ImageGenerator.fingerprint).
+
+Writing a ZIP archive to a stream that cannot seek, such as standard output,
+requires Python 3; tar archives can be streamed anywhere.
+"""
+
+# Standard library
+import hashlib
+import json
+import tarfile
+import time
+import zipfile
+from io import BytesIO
+
+# Third-party libraries
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        raise ImportError("Could not locate Python Imaging Library (PIL)")
+
+# This module
+from .wsgi import palette_hash
+
+
+FORMATS = ('zip', 'tar', 'tar.gz')
+MANIFEST_NAME = 'manifest.json'
+
+
+class _ZipArchive(object):
+    """Writes entries to a ZIP archive"""
+
+    def __init__(self, fp):
+        self.archive = zipfile.ZipFile(fp, 'w')
+
+    def add(self, name, data, compress=False):
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.external_attr = 0o644 << 16
+        # Images are compressed already; deflating them again is wasted time
+        info.compress_type = (zipfile.ZIP_DEFLATED if compress
+                              else zipfile.ZIP_STORED)
+        self.archive.writestr(info, data)
+
+    def close(self):
+        self.archive.close()
+
+
+class _TarArchive(object):
+    """Writes entries to a (possibly gzipped) tar stream"""
+
+    def __init__(self, fp, compression=''):
+        self.archive = tarfile.open(fileobj=fp, mode='w|' + compression)
+
+    def add(self, name, data, compress=False):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        info.mode = 0o644
+        self.archive.addfile(info, BytesIO(data))
+
+    def close(self):
+        self.archive.close()
+
+
+def open_archive(fp, archive_format):
+    """
+    Returns an archive writer for one of FORMATS, writing to fp.
+
+    * Raises ValueError if the format is unknown.
+    """
+    if archive_format == 'zip':
+        return _ZipArchive(fp)
+    elif archive_format == 'tar':
+        return _TarArchive(fp)
+    elif archive_format == 'tar.gz':
+        return _TarArchive(fp, 'gz')
+    raise ValueError("Unknown bundle format %r; expected one of %s"
+                     % (archive_format, ', '.join(FORMATS)))
+
+
+def format_for(filename):
+    """Returns the bundle format implied by a file name, or None"""
+    filename = filename.lower()
+    if filename.endswith('.zip'):
+        return 'zip'
+    elif filename.endswith(('.tar.gz', '.tgz')):
+        return 'tar.gz'
+    elif filename.endswith('.tar'):
+        return 'tar'
+    return None
+
+
+def export_bundle(generators, color_dict, fp, archive_format='zip',
+                  source_path=None, scales=None, prefix=''):
+    """
+    Renders each generator with `color_dict` and writes the images, followed
+    by a manifest, to a bundle. Returns the manifest as a dictionary.
+
+    generators - A sequence of ImageGenerator subclasses. Each image is
+        stored under the generator's output file name.
+
+    fp - A writable file-like object. It is not closed.
+
+    archive_format - (optional) One of FORMATS.
+
+    source_path - (optional) Passed through to the generators.
+
+    scales - (optional) A list of pixel densities to render each generator
+        at (see ImageGenerator.scale), instead of just its scale constant.
+
+    prefix - (optional) A directory, such as "acme/", to put every entry in.
+
+    * Raises ValueError if the format is unknown or two images would have
+      the same name.
+    * Raises the same errors as the generators for invalid palettes.
+    """
+    archive = open_archive(fp, archive_format)
+    files = []
+    names = set()
+    try:
+        for generator_class in generators:
+            for scale in scales or [None]:
+                generator = generator_class(color_dict,
+                                            source_path=source_path,
+                                            scale=scale)
+                name = prefix + generator._output_filename()
+                if name in names:
+                    raise ValueError("More than one image is named %s"
+                                     % name)
+                names.add(name)
+
+                data = generator.render_bytes()
+                archive.add(name, data)
+                files.append({
+                    'name': name,
+                    'generator': generator_class.__name__,
+                    'format': generator.image_format,
+                    'scale': generator.scale,
+                    'size': list(Image.open(BytesIO(data)).size),
+                    'bytes': len(data),
+                    'sha1': hashlib.sha1(data).hexdigest(),
+                    'fingerprint': generator.fingerprint(),
+                })
+
+        manifest = {
+            'palette': palette_hash(color_dict),
+            'colors': color_dict,
+            'files': files,
+        }
+        archive.add(prefix + MANIFEST_NAME,
+                    json.dumps(manifest, indent=2,
+                               sort_keys=True).encode('utf-8'),
+                    compress=True)
+    finally:
+        archive.close()
+    return manifest
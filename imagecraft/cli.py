@@ -0,0 +1,257 @@
+"""
+The `imagecraft` command line tool.
+
+    imagecraft build jobs.json --workers 4
+    imagecraft watch jobs.json
+    imagecraft compile jobs.json -o layers.store
+    imagecraft export myskins:Button --palette acme.json -o acme.zip
+
+See the build module for the format of the job specification, the watch
+module for how outputs are kept up to date as source images are edited, the
+layer_store module for compiled layer stores and the bundle module for
+exported bundles.
+"""
+
+# Standard library
+import argparse
+import json
+import os
+import sys
+import time
+
+# This module
+from .build import build, load_generator, load_jobs
+from .bundle import FORMATS, export_bundle, format_for
+from .layer_store import LayerStore, compile_store, job_sources
+from .watch import Watcher
+
+
+def _load_jobs(args):
+    """Loads the job specification named on the command line"""
+    jobs = load_jobs(args.spec)
+    if args.path:
+        # Make generators importable relative to the given directories
+        sys.path[:0] = args.path
+    return jobs
+
+
+def _report(results, quiet):
+    """
+    Writes out BuildResults as they arrive, followed by a summary. Returns
+    the number of failures.
+    """
+    started = time.time()
+    rendered = skipped = failed = 0
+    for result in results:
+        if result.skipped:
+            skipped += 1
+        elif result.ok:
+            rendered += 1
+        else:
+            failed += 1
+        if not (result.ok and quiet):
+            sys.stdout.write("%s\n" % result)
+
+    sys.stdout.write("Rendered %d image(s) in %.3fs, %d up to date, "
+                     "%d failed\n" % (rendered, time.time() - started,
+                                       skipped, failed))
+    return failed
+
+
+def _build(args):
+    """Runs the build subcommand, returning the process exit status"""
+    jobs = _load_jobs(args)
+    failed = _report(build(jobs, workers=args.workers,
+                           chunksize=args.chunksize, force=args.force),
+                     args.quiet)
+    return 1 if failed else 0
+
+
+def _watch(args):
+    """Runs the watch subcommand until interrupted"""
+    watcher = Watcher(_load_jobs(args), workers=args.workers,
+                      chunksize=args.chunksize, debounce=args.debounce,
+                      method='poll' if args.poll else 'auto',
+                      interval=args.interval)
+    try:
+        _report(watcher.build(force=args.force), args.quiet)
+        sys.stdout.write("Watching %d source file(s) for %d output(s); "
+                         "press Ctrl-C to stop\n"
+                         % (len(watcher.index.paths),
+                            len(watcher.index.tasks)))
+        sys.stdout.flush()
+        while True:
+            changed = watcher.wait()
+            for path in sorted(changed):
+                sys.stdout.write("Changed: %s\n" % path)
+            _report(watcher.rebuild(changed), args.quiet)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+
+
+def _compile(args):
+    """Runs the compile subcommand, returning the process exit status"""
+    failures = []
+    sources = job_sources(_load_jobs(args), failures)
+    for result in failures:
+        sys.stdout.write("%s\n" % result)
+    started = time.time()
+    count = compile_store(args.output, sources)
+    sys.stdout.write("Compiled %d layer(s) from %d source file(s) into %s "
+                     "(%d bytes) in %.3fs\n"
+                     % (count, len(set(path for path, size in sources)),
+                        args.output, os.path.getsize(args.output),
+                        time.time() - started))
+    if failures:
+        sys.stdout.write("Left out the layers of %d failed task(s)\n"
+                         % len(failures))
+    if args.verify:
+        bad = LayerStore(args.output).verify()
+        for key in bad:
+            sys.stdout.write("Checksum mismatch: %s\n" % key)
+        if bad:
+            return 1
+    return 1 if failures else 0
+
+
+def _scale(text):
+    """Parses a --scale value, keeping whole numbers as integers"""
+    scale = float(text)
+    return int(scale) if scale == int(scale) else scale
+
+
+def _export(args):
+    """Runs the export subcommand, returning the process exit status"""
+    if args.path:
+        sys.path[:0] = args.path
+    generators = [load_generator(name) for name in args.generators]
+    with open(args.palette) as fp:
+        color_dict = json.load(fp)
+
+    archive_format = args.format or format_for(args.output) or 'zip'
+    started = time.time()
+    if args.output == '-':
+        # Python 3 needs the binary buffer underneath standard output
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        manifest = export_bundle(generators, color_dict, stdout,
+                                 archive_format, args.source_path,
+                                 args.scale or None, args.prefix)
+        stdout.flush()
+    else:
+        with open(args.output, 'wb') as fp:
+            manifest = export_bundle(generators, color_dict, fp,
+                                     archive_format, args.source_path,
+                                     args.scale or None, args.prefix)
+    sys.stderr.write("Exported %d image(s) in %.3fs\n"
+                     % (len(manifest['files']), time.time() - started))
+    return 0
+
+
+def main(argv=None):
+    """Entry point for the command line tool"""
+    parser = argparse.ArgumentParser(prog='imagecraft')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    build_parser = subparsers.add_parser(
+        'build', help="render generators against palettes from a job spec")
+    build_parser.add_argument('spec', help="path to a JSON job specification")
+    build_parser.add_argument(
+        '-j', '--workers', type=int, default=None,
+        help="number of worker processes (default: one per processor)")
+    build_parser.add_argument(
+        '--chunksize', type=int, default=8,
+        help="palettes sent to a worker at a time per generator")
+    build_parser.add_argument(
+        '-p', '--path', action='append', default=[],
+        help="directory to add to the import path (may be repeated)")
+    build_parser.add_argument(
+        '-f', '--force', action='store_true',
+        help="render every output, even if it is up to date")
+    build_parser.add_argument(
+        '-q', '--quiet', action='store_true',
+        help="only report failures and the summary")
+    build_parser.set_defaults(func=_build)
+
+    watch_parser = subparsers.add_parser(
+        'watch', help="re-render outputs as their source images change")
+    watch_parser.add_argument('spec', help="path to a JSON job specification")
+    watch_parser.add_argument(
+        '-j', '--workers', type=int, default=1,
+        help="number of worker processes (default: 1)")
+    watch_parser.add_argument(
+        '--chunksize', type=int, default=8,
+        help="palettes sent to a worker at a time per generator")
+    watch_parser.add_argument(
+        '-p', '--path', action='append', default=[],
+        help="directory to add to the import path (may be repeated)")
+    watch_parser.add_argument(
+        '-f', '--force', action='store_true',
+        help="render every output when starting, even if it is up to date")
+    watch_parser.add_argument(
+        '-q', '--quiet', action='store_true',
+        help="only report failures and summaries")
+    watch_parser.add_argument(
+        '--debounce', type=float, default=0.2,
+        help="seconds to wait for further changes before rendering")
+    watch_parser.add_argument(
+        '--poll', action='store_true',
+        help="poll the source files instead of using inotify")
+    watch_parser.add_argument(
+        '--interval', type=float, default=0.5,
+        help="seconds between checks when polling")
+    watch_parser.set_defaults(func=_watch)
+
+    compile_parser = subparsers.add_parser(
+        'compile', help="decode the source images of a job spec into a "
+                        "memory-mappable layer store")
+    compile_parser.add_argument('spec',
+                                help="path to a JSON job specification")
+    compile_parser.add_argument(
+        '-o', '--output', required=True, help="path of the store to write")
+    compile_parser.add_argument(
+        '-p', '--path', action='append', default=[],
+        help="directory to add to the import path (may be repeated)")
+    compile_parser.add_argument(
+        '--verify', action='store_true',
+        help="check the written store against its checksums")
+    compile_parser.set_defaults(func=_compile)
+
+    export_parser = subparsers.add_parser(
+        'export', help="render generators for one palette into a ZIP or tar "
+                       "bundle")
+    export_parser.add_argument(
+        'generators', nargs='+',
+        help="generators to render, as module:Class import paths")
+    export_parser.add_argument(
+        '--palette', required=True,
+        help="path to a JSON file holding the color dictionary")
+    export_parser.add_argument(
+        '-o', '--output', default='-',
+        help="path of the bundle to write, or - for standard output "
+             "(the default)")
+    export_parser.add_argument(
+        '--format', choices=FORMATS,
+        help="archive format (default: from the output file name, or zip)")
+    export_parser.add_argument(
+        '--source-path', help="directory holding the source images")
+    export_parser.add_argument(
+        '--scale', type=_scale, action='append', default=[],
+        help="pixel density to render at (may be repeated)")
+    export_parser.add_argument(
+        '--prefix', default='',
+        help="directory inside the bundle to put the files in")
+    export_parser.add_argument(
+        '-p', '--path', action='append', default=[],
+        help="directory to add to the import path (may be repeated)")
+    export_parser.set_defaults(func=_export)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
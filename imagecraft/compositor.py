@@ -0,0 +1,408 @@
+"""
+Compositing engines for whole layer stacks.
+
+The kernels here reproduce the integer arithmetic PIL uses for
+Image.composite, along with the premultiplied alpha helpers on
+ImageGenerator, but operate on NumPy arrays. Every function accepts arrays
+with any number of leading dimensions, which lets a whole batch of color
+variants be processed in a single pass (LayerStack.composite). Single
+renders go through LayerStack.composite_frame instead, which pastes each
+layer into its working images in place.
+
+NumPy is optional; callers must check that `numpy` is not None before using
+anything in this module.
+"""
+
+# Third-party libraries
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        raise ImportError("Could not locate Python Imaging Library (PIL)")
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# This module
+from .instrumentation import NULL_RECORD
+
+
+def div255(values):
+    """
+    Divides a uint16 array by 255 with the same rounding PIL uses when
+    blending (the DIV255 macro in libImaging).
+    """
+    tmp = values + 128
+    return ((tmp >> 8) + tmp) >> 8
+
+
+def blend(base, overlay, mask):
+    """
+    Returns `overlay` pasted over `base` through `mask`, exactly as
+    Image.composite(overlay, base, mask) would compute it.
+
+    base - A uint8 array of pixels.
+
+    overlay - A uint8 array (or scalar) broadcastable against base.
+
+    mask - A uint8 array broadcastable against base, usually with a trailing
+        dimension of 1 so that it applies to every band.
+    """
+    mask = mask.astype(numpy.uint16)
+    # 255 * 255 + 128 and its rounding fit in uint16 without overflowing
+    values = base * (255 - mask) + overlay * mask
+    return div255(values).astype(numpy.uint8)
+
+
+def remove_premultiplied_alpha(pixels):
+    """Returns RGBA pixels with pre-multiplied alpha removed"""
+    # uint16 is wide enough for 255 * 255 without overflowing
+    wide = pixels.astype(numpy.uint16)
+    alpha = wide[..., 3:]
+
+    out = numpy.empty(pixels.shape, dtype=numpy.uint8)
+    out[..., :3] = wide[..., :3] * alpha // 255
+    out[..., 3:] = pixels[..., 3:]
+
+    return out
+
+
+def apply_premultiplied_alpha(pixels):
+    """Returns RGBA pixels with premultiplied alpha added"""
+    # uint16 is wide enough for 255 * 255 + 127 without overflowing
+    wide = pixels.astype(numpy.uint16)
+    rgb = wide[..., :3]
+    alpha = wide[..., 3:]
+    opaque = alpha > 0
+
+    # Divide by 1 where alpha is zero; those pixels are left untouched
+    divisor = numpy.where(opaque, alpha, 1)
+    scaled = (rgb * 255 + alpha // 2) // divisor
+
+    out = numpy.empty(pixels.shape, dtype=numpy.uint8)
+    # Pixel access clips out-of-range values, so do the same here
+    out[..., :3] = numpy.where(opaque, numpy.minimum(scaled, 255), rgb)
+    out[..., 3:] = pixels[..., 3:]
+
+    return out
+
+
+class LayerStack(object):
+    """
+    The decoded layers of one generator, ready to be composited against any
+    number of color variants at once.
+
+    Usage:
+
+        stack = LayerStack(cached_layers)
+        if stack.supports(colorized):
+            pixels = stack.composite(luts, count)
+            image = stack.composite_frame(luts_for_one_variant)
+
+    Every pixel's output depends only on that pixel's values in each layer
+    and on the colors, so pixels with identical values across the whole
+    stack are composited just once per variant and copied out afterwards.
+    Working out which pixels are distinct happens once per stack and set of
+    colorized layers, and is reused for every batch after that.
+    """
+
+    def __init__(self, layers):
+        """
+        Constructor.
+
+        layers - A sequence of CachedLayer objects, bottom layer first.
+        """
+        self.layers = tuple(layers)
+        self._distinct = {}
+
+    def supports(self, colorized):
+        """
+        Returns True if the array kernels can composite this stack, given a
+        sequence of booleans stating which layers are colorized. Anything
+        else (mismatched sizes, exotic modes) must go through PIL.
+        """
+        if len(colorized) != len(self.layers) or not self.layers:
+            return False
+
+        mode = None
+        size = self.layers[0].size
+        for layer, is_colorized in zip(self.layers, colorized):
+            if layer.size != size:
+                return False
+
+            if is_colorized:
+                if layer.alpha is None:
+                    mode = "RGB"
+                elif mode is None:
+                    mode = "RGBA"
+            elif layer.alpha is None:
+                if layer.image.mode != "RGB":
+                    return False
+                mode = "RGB"
+            elif layer.image.mode != "RGBA" or mode != "RGBA":
+                return False
+
+        return True
+
+    def _distinct_pixels(self, colorized):
+        """
+        Returns (planes, inverse) for the given colorized layers, where planes
+        maps (layeridx, plane name) to an array holding that plane's value for
+        each distinct pixel, and inverse maps every pixel of the image (in
+        row-major order) to its distinct pixel.
+        """
+        colorized = tuple(colorized)
+        if colorized in self._distinct:
+            return self._distinct[colorized]
+
+        # Gather only the planes that influence the output
+        names = []
+        columns = []
+        for layeridx, (layer, is_colorized) in enumerate(
+                zip(self.layers, colorized)):
+            wanted = ['greyscale', 'alpha'] if is_colorized else ['image']
+            for plane in wanted:
+                pil_image = getattr(layer, plane)
+                if pil_image is None:
+                    continue
+                values = numpy.asarray(pil_image)
+                values = values.reshape(values.shape[0] * values.shape[1], -1)
+                names.append(((layeridx, plane), values.shape[1]))
+                columns.append(values)
+
+        rows = numpy.ascontiguousarray(numpy.hstack(columns))
+        keys = rows.view(numpy.dtype((numpy.void, rows.shape[1]))).ravel()
+        unused, first, inverse = numpy.unique(keys, return_index=True,
+                                              return_inverse=True)
+        distinct = rows[first]
+
+        planes = {}
+        offset = 0
+        for key, width in names:
+            planes[key] = distinct[:, offset:offset + width]
+            offset += width
+
+        self._distinct[colorized] = (planes, inverse)
+        return planes, inverse
+
+    def composite(self, luts, count):
+        """
+        Composites the stack once for each of `count` color variants and
+        returns a uint8 array of shape (count, height, width, bands), where
+        bands is 4 for RGBA output and 3 for RGB output.
+
+        luts - One entry per layer; None for layers that are not colorized,
+            otherwise a uint8 array of shape (count, 256, 3) holding each
+            variant's colorization lookup table.
+
+        Only call this if supports() is True for the same colorized layers.
+        """
+        planes, inverse = self._distinct_pixels(
+            [lut is not None for lut in luts])
+        base = None
+
+        for layeridx, layer in enumerate(self.layers):
+            lut = luts[layeridx]
+
+            # Colorize image if a color is present
+            if lut is not None:
+                colorized = lut[:, planes[(layeridx, 'greyscale')][:, 0]]
+                alpha = planes.get((layeridx, 'alpha'))
+
+                if alpha is None:
+                    base = colorized
+                elif base is None:
+                    base = numpy.empty(colorized.shape[:2] + (4,),
+                                       dtype=numpy.uint8)
+                    base[..., :3] = colorized
+                    base[..., 3:] = alpha
+                    base = remove_premultiplied_alpha(base)
+                elif base.shape[-1] == 4:
+                    # The colorized layer is treated as fully opaque RGBA
+                    out = numpy.empty(base.shape, dtype=numpy.uint8)
+                    out[..., :3] = blend(base[..., :3], colorized, alpha)
+                    out[..., 3:] = blend(base[..., 3:], 255, alpha)
+                    base = out
+                else:
+                    base = blend(base, colorized, alpha)
+
+            # Image is not colorized
+            else:
+                image = planes[(layeridx, 'image')]
+                if layer.alpha is None:
+                    base = numpy.broadcast_to(image, (count,) + image.shape)
+                else:
+                    base = remove_premultiplied_alpha(
+                        blend(base, image, image[:, 3:]))
+
+        if base.shape[-1] == 4:
+            base = apply_premultiplied_alpha(base)
+
+        width, height = self.layers[0].size
+        return base[:, inverse].reshape(count, height, width, base.shape[-1])
+
+    def composite_frame(self, luts, record=NULL_RECORD, resume=None,
+                        checkpoint=None, premultiplied=False):
+        """
+        Composites the stack for a single color variant and returns the
+        resulting PIL image.
+
+        Unlike composite, every pixel is processed, one band at a time: the
+        bands are held as separate greyscale images which each layer is
+        pasted into in place, so no intermediate composites are allocated per
+        layer and peak memory does not grow with the number of layers. Each
+        paste performs exactly the arithmetic of Image.composite, and is
+        limited to the layer's bounding box; fully transparent layers are
+        skipped and fully opaque ones are copied without a mask.
+
+        luts - One entry per layer; None for layers that are not colorized,
+            otherwise the layer's 768-entry colorization lookup table.
+
+        record - (optional) An instrumentation.RenderRecord to time the
+            colorize and premultiply stages in.
+
+        resume - (optional) A (count, bands, planes) state previously passed
+            to checkpoint: compositing carries on from the state after the
+            first `count` layers. The planes are copied, never modified.
+
+        checkpoint - (optional) A callable passed the (count, bands, planes)
+            state before each colorized layer but the first, so that a later
+            render changing only the colors from there on can resume from
+            it. It must copy the planes if it keeps them.
+
+        premultiplied - (optional) If true, an image with alpha is returned
+            with its colors left premultiplied, as an "RGBa" image, saving
+            the division that turns them back into an "RGBA" one.
+
+        Only call this if supports() is True for the same colorized layers.
+        """
+        size = self.layers[0].size
+        if resume is None:
+            start = 0
+            planes = [Image.new("L", size, 0) for band in range(4)]
+            bands = 0 # 0 until the first layer, then 3 (RGB) or 4 (RGBA)
+        else:
+            start, bands, planes = resume
+            planes = [plane.copy() for plane in planes]
+
+        for layeridx in range(start, len(self.layers)):
+            layer = self.layers[layeridx]
+            lut = luts[layeridx]
+            if checkpoint is not None and lut is not None and layeridx > 0:
+                checkpoint(layeridx, bands, planes)
+
+            alpha = layer.alpha
+            # Only the part of a layer inside its bounding box is visible;
+            # pasting nothing is a no-op, and pasting through a fully opaque
+            # mask is a straight copy.
+            bbox = layer.bbox
+            mask = None
+            if bbox is not None and not layer.is_opaque:
+                mask = _region(alpha, bbox)
+
+            # Colorize image if a color is present
+            if lut is not None:
+                if alpha is None:
+                    with record.stage('colorize'):
+                        planes[:3] = [
+                            _colorize_band(layer.greyscale, lut, band)
+                            for band in range(3)]
+                    bands = 3
+                elif bands == 0:
+                    # Outside the bounding box alpha is zero, so every band
+                    # is zero once pre-multiplied alpha has been removed.
+                    if bbox is not None:
+                        greyscale = _region(layer.greyscale, bbox)
+                        with record.stage('colorize'):
+                            region = [_colorize_band(greyscale, lut, band)
+                                      for band in range(3)]
+                        region.append(_region(alpha, bbox))
+                        with record.stage('premultiply'):
+                            region = _remove_premultiplied_alpha_planes(
+                                region)
+                        for plane, values in zip(planes, region):
+                            plane.paste(values, bbox[:2])
+                    bands = 4
+                elif bbox is not None:
+                    greyscale = _region(layer.greyscale, bbox)
+                    for band in range(3):
+                        with record.stage('colorize'):
+                            colorized = _colorize_band(greyscale, lut, band)
+                        planes[band].paste(colorized, bbox[:2], mask)
+                    if bands == 4:
+                        # The colorized layer is treated as fully opaque RGBA
+                        planes[3].paste(255, bbox, mask)
+
+            # Image is not colorized
+            else:
+                if alpha is None:
+                    planes[:3] = layer.image.split()
+                    bands = 3
+                else:
+                    if bbox is not None:
+                        image_planes = _region(layer.image, bbox).split()
+                        for plane, values in zip(planes, image_planes):
+                            plane.paste(values, bbox[:2], mask)
+                    with record.stage('premultiply'):
+                        planes = _remove_premultiplied_alpha_planes(planes)
+
+        if bands == 4:
+            if premultiplied:
+                return Image.merge("RGBa", planes)
+            with record.stage('premultiply'):
+                planes = _apply_premultiplied_alpha_planes(planes)
+            return Image.merge("RGBA", planes)
+        return Image.merge("RGB", planes[:3])
+
+
+def _region(image, bbox):
+    """
+    Returns the part of image inside bbox, without copying it if that is the
+    whole image.
+    """
+    if tuple(bbox) == (0, 0) + image.size:
+        return image
+    return image.crop(bbox)
+
+
+def _colorize_band(greyscale, lut, band):
+    """Returns one band of a greyscale image colorized with a 768-entry LUT"""
+    return greyscale.point(lut[band * 256:(band + 1) * 256])
+
+
+def _remove_premultiplied_alpha_planes(planes):
+    """
+    Returns R, G, B, A band images with pre-multiplied alpha removed. The
+    alpha band is passed through untouched.
+    """
+    alpha = numpy.asarray(planes[3], dtype=numpy.uint16)
+    out = []
+    for plane in planes[:3]:
+        values = numpy.asarray(plane, dtype=numpy.uint16) * alpha // 255
+        out.append(Image.fromarray(values.astype(numpy.uint8), "L"))
+    return out + [planes[3]]
+
+
+def _apply_premultiplied_alpha_planes(planes):
+    """
+    Returns R, G, B, A band images with premultiplied alpha added. The alpha
+    band is passed through untouched.
+    """
+    alpha = numpy.asarray(planes[3], dtype=numpy.uint16)
+    opaque = alpha > 0
+    # Divide by 1 where alpha is zero; those pixels are left untouched
+    divisor = numpy.where(opaque, alpha, 1)
+    half = alpha // 2
+
+    out = []
+    for plane in planes[:3]:
+        values = numpy.asarray(plane, dtype=numpy.uint16)
+        scaled = (values * 255 + half) // divisor
+        # Pixel access clips out-of-range values, so do the same here
+        values = numpy.where(opaque, numpy.minimum(scaled, 255), values)
+        out.append(Image.fromarray(values.astype(numpy.uint8), "L"))
+    return out + [planes[3]]
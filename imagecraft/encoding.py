@@ -0,0 +1,160 @@
+"""
+Encoder settings for rendered images.
+
+ImageGenerator.encoder_options holds keyword arguments for PIL's save,
+such as {'compress_level': 9} for PNG or {'lossless': True} for WebP, along
+with one option handled here rather than by PIL:
+
+    quantize - If true, a PNG whose pixels use 256 distinct colours or fewer
+        is stored as a palette image. Every pixel keeps its exact value
+        (alpha included), so the output decodes to the same RGBA image;
+        images with more colours are left alone. Requires NumPy.
+
+ImageGenerator.encoder_candidates trades encode time for size: the image
+is encoded once for each set of options in it (each applied on top of
+encoder_options) and only the smallest result is written.
+
+    class Button(ImageGenerator):
+        image_format = 'PNG'
+        encoder_candidates = encoding.SMALLEST_PNG
+
+Some ready-made settings are defined below.
+"""
+
+# Standard library
+from io import BytesIO
+
+# Third-party libraries
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        raise ImportError("Could not locate Python Imaging Library (PIL)")
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# This module
+from .tiling import TiledImage
+
+
+# Quick PNG compression, for previews and frequently changing output.
+PNG_FAST = {'compress_level': 1}
+
+# The best compression zlib offers, without changing any pixels.
+PNG_BEST = {'compress_level': 9}
+
+# Lossless WebP, for use with image_format = 'WEBP'. Without `exact` (which
+# older versions of Pillow ignore) the colour of fully transparent pixels is
+# not kept.
+WEBP_LOSSLESS = {'lossless': True, 'quality': 100, 'method': 6,
+                 'exact': True}
+
+# Candidates for encoder_candidates that find the smallest lossless PNG.
+SMALLEST_PNG = (
+    {'compress_level': 9},
+    {'optimize': True},
+    {'compress_level': 9, 'quantize': True},
+    {'optimize': True, 'quantize': True},
+)
+
+# Options understood by encode itself and never passed on to PIL.
+_OWN_OPTIONS = ('quantize',)
+
+
+def encode(image, fp, image_format, options=None, candidates=None):
+    """
+    Encodes image in the given format to fp, a filename or writable
+    file-like object.
+
+    options - (optional) A dictionary of encoder options: PIL save options
+        plus those described in the module docstring.
+
+    candidates - (optional) A sequence of option dictionaries, applied on
+        top of options. The image is encoded with each and the smallest
+        result is written.
+
+    Images rendered in strips (tiling.TiledImage) are streamed straight to
+    fp as usual, so neither quantize nor candidates apply to them; the
+    whole image is never held at once.
+    """
+    options = dict(options or {})
+
+    if not candidates or isinstance(image, TiledImage):
+        _save(image, fp, image_format, options)
+        return
+
+    smallest = None
+    for candidate in candidates:
+        buf = BytesIO()
+        _save(image, buf, image_format, dict(options, **candidate))
+        if smallest is None or buf.tell() < len(smallest):
+            smallest = buf.getvalue()
+
+    if hasattr(fp, 'write'):
+        fp.write(smallest)
+    else:
+        with open(fp, 'wb') as fileobj:
+            fileobj.write(smallest)
+
+
+def _save(image, fp, image_format, options):
+    """Saves image with a single set of encoder options"""
+    save_options = dict((key, value) for key, value in options.items()
+                        if key not in _OWN_OPTIONS)
+
+    if options.get('quantize') and (image_format or '').upper() == 'PNG' \
+            and not isinstance(image, TiledImage):
+        palette_image, transparency = to_palette(image)
+        if palette_image is not None:
+            image = palette_image
+            if transparency:
+                save_options['transparency'] = transparency
+
+    image.save(fp, image_format, **save_options)
+
+
+def to_palette(image):
+    """
+    Returns (palette image, transparency) holding exactly the pixels of an
+    RGB or RGBA image, where transparency is the alpha of each palette
+    entry as a string of bytes (empty if every pixel is opaque). Returns
+    (None, None) if the image has more than 256 colours, has some other
+    mode, or NumPy is not available.
+    """
+    if numpy is None or image.mode not in ("RGB", "RGBA"):
+        return None, None
+    # Cheap check first; getcolors gives up as soon as it sees 257 colours
+    if image.getcolors(256) is None:
+        return None, None
+
+    bands = len(image.mode)
+    pixels = numpy.asarray(image).reshape(-1, bands)
+    keys = numpy.zeros(len(pixels), dtype=numpy.uint32)
+    for band in range(bands):
+        keys |= pixels[:, band].astype(numpy.uint32) << (8 * band)
+    colors, indices = numpy.unique(keys, return_inverse=True)
+
+    palette = numpy.empty((len(colors), bands), dtype=numpy.uint8)
+    for band in range(bands):
+        palette[:, band] = (colors >> (8 * band)) & 0xff
+
+    transparency = b''
+    if bands == 4:
+        # Put translucent entries first, so that tRNS can stop after them
+        order = numpy.argsort(palette[:, 3] == 255, kind='mergesort')
+        palette = palette[order]
+        remap = numpy.empty(len(order), dtype=numpy.intp)
+        remap[order] = numpy.arange(len(order))
+        indices = remap[indices]
+        translucent = int(numpy.count_nonzero(palette[:, 3] != 255))
+        transparency = palette[:translucent, 3].tobytes()
+
+    out = Image.frombytes("P", image.size,
+                          indices.astype(numpy.uint8).tobytes())
+    out.putpalette(palette[:, :3].tobytes())
+    return out, transparency
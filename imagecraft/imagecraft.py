@@ -3,20 +3,73 @@
 __author__ = 'kevin@isolationism.com'
 
 # Standard library
+import copy
+import hashlib
+import itertools
+import json
 import os
-from warnings import warn
+from io import BytesIO
 
 # Third-party libraries
 try:
-    from PIL import Image, ImageOps, ImageChops
+    from PIL import Image
 except ImportError:
     try:
-        import Image, ImageOps, ImageChops
+        import Image
     except ImportError:
         raise ImportError("Could not locate Python Imaging Library (PIL)")
 
+# NumPy is optional; without it the pixel kernels fall back to pure Python.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # This module
-from named_colors import COLORS
+from .named_colors import COLORS
+from .layer_cache import CachedLayer, layer_cache
+from . import compositor
+from .tiling import PNGReader, TiledImage
+from .instrumentation import NULL_RECORD, current_record, recording
+from . import encoding
+from .plan import Layer, plan_for
+from .prefix_cache import preview_cache
+
+
+# Memoized colorization lookup tables, keyed by (black, white) color pairs.
+_colorize_luts = {}
+_max_colorize_luts = 4096
+
+
+def colorize_lut(black, white):
+    """
+    Returns the 768-entry RGB lookup table that maps greyscale values onto a
+    gradient from `black` to `white`, identical to the one built internally by
+    ImageOps.colorize. Tables are memoized per (black, white) pair.
+    """
+    key = (tuple(black), tuple(white))
+    lut = _colorize_luts.get(key)
+    if lut is None:
+        lut = []
+        for black_val, white_val in zip(black, white):
+            lut.extend([black_val + i * (white_val - black_val) // 255
+                        for i in range(255)])
+            lut.append(white_val)
+        # Shared between threads, so never modifiable
+        lut = tuple(lut)
+        if len(_colorize_luts) >= _max_colorize_luts:
+            _colorize_luts.clear()
+        _colorize_luts[key] = lut
+    return lut
+
+
+def colorize(greyscale_img, black, white):
+    """
+    Colorizes a greyscale ("L") image with `black` as black and `white` as
+    white. Produces the same result as ImageOps.colorize, but reuses a cached
+    lookup table for each color pair.
+    """
+    return greyscale_img.convert("RGB").point(colorize_lut(black, white))
 
 
 class ImageGenerator(object):
@@ -58,6 +111,12 @@ class ImageGenerator(object):
     you may wish to supply an output_path argument to the constructor to
     specify where to save the file to. By default output will go to the
     'generated_images' folder.
+
+    Rendering is thread-safe: nothing about an instance changes once it has
+    been constructed, and the caches shared between instances (layers, render
+    plans, prefixes) do their own locking and hand out read-only data. Any
+    number of threads may render different instances, or the same one, at
+    once; see imagecraft.pool for a thread pool that does this for you.
     """
 
     # Override this property with your layer definitions.
@@ -68,8 +127,39 @@ class ImageGenerator(object):
     _default_output_path = os.path.join(os.path.dirname(__file__),
                                         'generated_images')
     image_format = None
-
-    def __init__(self, color_dict, source_path=None, output_path=None):
+    # Decoded source layers are shared process-wide unless overridden.
+    layer_cache = layer_cache
+    # Set to a number of bytes to composite in strips that keep the memory
+    # a render holds, source layers included, under that ceiling (see
+    # _render_output).
+    max_render_bytes = None
+    # The pixel density the source images are drawn at (e.g. 3 for sources
+    # drawn for 3x displays), and the density to render at. Outputs at
+    # scales other than 1 are named after scaled_filename.
+    source_scale = 1
+    scale = 1
+    scaled_filename = '{name}@{scale}x{ext}'
+    # Encoder settings; see the encoding module.
+    encoder_options = None
+    encoder_candidates = None
+    # Set to a prefix_cache.PrefixCache to reuse partial composites between
+    # renders that share the colors of their lower layers.
+    prefix_cache = None
+    # Set to a result_cache.ResultCache to keep the encoded results of
+    # render_bytes for identical requests.
+    result_cache = None
+    # The largest width or height of previews (see render_preview), and the
+    # prefix cache they use.
+    preview_size = 256
+    preview_prefix_cache = preview_cache
+    # Callables passed an instrumentation.RenderRecord after each render.
+    observers = ()
+    # True on the copies that render previews, whose images with alpha are
+    # composited to "RGBa", leaving their colors premultiplied.
+    _preview = False
+
+    def __init__(self, color_dict, source_path=None, output_path=None,
+                 scale=None):
         """
         Constructor.
 
@@ -83,15 +173,32 @@ class ImageGenerator(object):
         output_path - (optional) The path where the generated file will be
             written. If none is provided, the _default_output_path will be
             used.
+
+        scale - (optional) The pixel density to render at, overriding the
+            scale constant.
         """
+        if scale is not None:
+            self.scale = scale
+        self._plan = plan_for(type(self))
         self.colors_for_layers = self._map_colors_to_layers(color_dict)
         self.source_path = source_path or self._default_source_path
         self.output_path = output_path or self._default_output_path
         self.matte_color = None
 
+    @property
+    def _record(self):
+        """
+        The instrumentation.RenderRecord of the render of this generator in
+        progress on the current thread, or NULL_RECORD.
+        """
+        if not self.observers:
+            return NULL_RECORD
+        return current_record(self)
+
     def _map_colors_to_layers(self, color_dict):
         """
-        Passes through all layers ensuring that a passed color maps to it.
+        Passes through all layers ensuring that a passed color maps to it,
+        and returns a tuple of plan.Layer objects.
 
         * Raises KeyError if the layer requires a color value that is not
           present in color_dict.
@@ -102,21 +209,24 @@ class ImageGenerator(object):
           key-value pair.
         """
         if not hasattr(color_dict, 'keys'):
-            raise TypeError, "color_dict must be a dictionary-like object"
+            raise TypeError("color_dict must be a dictionary-like object")
 
         colors_for_layers = []
 
-        for required_color, layer_img in self.layers:
+        # The layer definitions themselves were validated by the plan
+        for spec in self._plan.layers:
+            required_color = spec.color_name
+
             if required_color not in color_dict.keys():
-                if required_color is 'transparent':
-                    colors_for_layers.append({None: layer_img})
+                if required_color == 'transparent':
+                    colors_for_layers.append(Layer(None, spec.filename))
                 else:
-                    raise ValueError, "Required color %s not found in " \
-                                      "color_dict" % (required_color,)
+                    raise ValueError("Required color %s not found in "
+                                     "color_dict" % (required_color,))
             else:
                 # Success; map the color to the image
                 found_color = self._rgbcolor(color_dict.get(required_color))
-                colors_for_layers.append({found_color: layer_img})
+                colors_for_layers.append(Layer(found_color, spec.filename))
 
         return tuple(colors_for_layers)
 
@@ -129,7 +239,7 @@ class ImageGenerator(object):
         colortup = (0,0,0) # Default value to start with
 
         # Handles hex triplets (most common case)
-        if hasattr(colorval, 'find') and colorval.find('#') is 0:
+        if hasattr(colorval, 'find') and colorval.find('#') == 0:
 
             # 24-bit hexadecimal colors (e.g. #FF0000)
             if len(colorval) == 7:
@@ -148,7 +258,7 @@ class ImageGenerator(object):
                 )
 
         # Handles an RGB triplet (e.g. rgb(255, 0, 0))
-        elif hasattr(colorval, 'find') and colorval.lower().find('rgb') is 0:
+        elif hasattr(colorval, 'find') and colorval.lower().find('rgb') == 0:
             colorval = colorval.replace('rgb', '').replace('(', '')\
                 .replace(')', '')
 
@@ -184,57 +294,525 @@ class ImageGenerator(object):
 
         # Unknown color format; throw an error
         else:
-            raise ValueError, "I don't know how to handle colors in format %s" \
-                % (colorval,)
+            raise ValueError("I don't know how to handle colors in format %s"
+                             % (colorval,))
 
         return colortup
 
-    def render(self):
+    def render(self, force=False, scales=None):
         """
         Passes over each layer, reads the file, colorizes it, sandwiches them
         all together, and saves.
 
+        Rendering is skipped if the output file was written by an earlier
+        render with exactly the same inputs (see fingerprint), unless `force`
+        is True. Returns True if the file was written, False if skipped.
+
+        scales - (optional) A list of pixel densities (such as [1, 2, 3]) to
+            write an output file for, instead of just the scale constant.
+            The source files are only decoded once for all of them. Returns
+            True if any file was written.
+
         * Raises IOError if there's a problem reading or writing files.
         """
-        baselayer = None
-        previous_alpha = None
-
-        for layeridx, layer in enumerate(self.colors_for_layers):
-            color = layer.keys()[0]
-            filename = layer.values()[0]
-            img = Image.open(os.path.join(self.source_path, filename))
-            img.load() # Explicitly load the image to prevent errors
-
-            # Split the image into component channels
-            split_channels = img.split()
-            if len(split_channels) == 2: # Image is Greyscale + Alpha
-                alpha = split_channels[1]
-            elif len(split_channels) == 4: # Image is RGB + Alpha
-                alpha = split_channels[3]
-            else: # No alpha channel present
-                alpha = None
-                if layeridx > 0:
-                    warn("Non-background layer `%s` has no alpha channel, " \
-                        "which obscures all previous layers" % filename)
-                else:
-                    previous_alpha = Image.new("L", img.size, 128)
-                    
-            # Combine the alpha channel with the previous one for the next pass
-            if alpha:
-                if not previous_alpha: # No previous_alpha exists; create one
-                    previous_alpha = alpha
+        if scales is not None:
+            return self._render_scales(force, scales)
+
+        with recording(self) as record:
+            with record.stage('fingerprint'):
+                fingerprint = self.fingerprint()
+                if not force and self.is_up_to_date(fingerprint):
+                    record.count('renders_skipped')
+                    return False
+
+            baselayer = self._render_output()
+
+            # Attempt to write the image out to disk.
+            if baselayer:
+                record.count('pixels', baselayer.size[0] * baselayer.size[1])
+                self._write_to_file(baselayer, fingerprint)
+            else:
+                raise ValueError("Nothing to write to disk")
+
+        return True
+
+    def _render_scales(self, force, scales):
+        """Renders the output once for each scale in scales"""
+        written = False
+        for scale in scales:
+            written = self._at_scale(scale).render(force) or written
+        return written
+
+    def _at_scale(self, scale):
+        """Returns a copy of this generator that renders at another scale"""
+        generator = copy.copy(self)
+        generator.scale = scale
+        return generator
+
+    def render_image(self):
+        """
+        Passes over each layer, colorizes it and sandwiches them all together
+        like render(), but returns the resulting PIL image instead of saving.
+
+        * Raises ValueError if there are no layers to render.
+        """
+        with recording(self) as record:
+            baselayer = self._composite_layers()
+            if not baselayer:
+                raise ValueError("Nothing to render")
+            record.count('pixels', baselayer.size[0] * baselayer.size[1])
+        return baselayer
+
+    def render_to(self, fp, image_format=None):
+        """
+        Renders the image and encodes it straight into `fp`, a writable
+        file-like object, without touching the disk.
+
+        image_format - (optional) The format to encode with; defaults to the
+            image_format constant.
+
+        * Raises NotImplementedError if no format is given or defined.
+        """
+        image_format = image_format or self.image_format
+        if not image_format:
+            raise NotImplementedError("You must specify an output format")
+        with recording(self) as record:
+            baselayer = self._render_output()
+            if not baselayer:
+                raise ValueError("Nothing to render")
+            record.count('pixels', baselayer.size[0] * baselayer.size[1])
+            self._encode(baselayer, fp, image_format)
+
+    def render_bytes(self, image_format=None):
+        """
+        Renders the image and returns the encoded file contents as a string
+        of bytes. Takes the same arguments as render_to.
+
+        If the class has a result_cache, the result is taken from it when it
+        can be, and kept in it otherwise (see imagecraft.result_cache).
+        """
+        if self.result_cache is not None:
+            return self.result_cache.render_bytes(self, image_format)
+        return self._render_bytes(image_format)
+
+    def _render_bytes(self, image_format):
+        """Renders the image for render_bytes, without the result cache"""
+        buf = BytesIO()
+        self.render_to(buf, image_format)
+        return buf.getvalue()
+
+    def render_preview(self, max_size=None, premultiplied=False):
+        """
+        Quickly renders a scaled-down copy of the image for interactive use,
+        such as redrawing a colour picker while a slider is dragged, and
+        returns it as a PIL image no wider or taller than max_size.
+
+        Previews are composited from downscaled copies of the source layers,
+        which stay in the layer cache, and go through preview_prefix_cache,
+        so changing one color only composites the layers from there up.
+        Removing premultiplied alpha at the end, and applying it too where
+        that is not done on NumPy arrays, is left to PIL, which rounds where
+        render() truncates. Drawn over a background, a pixel of a preview
+        may differ from a full render by a level or two.
+
+        max_size - (optional) The largest width or height of the preview.
+            Defaults to the preview_size constant; smaller images are not
+            enlarged.
+
+        premultiplied - (optional) If true, a preview with alpha is returned
+            as an "RGBa" image, its colors premultiplied by alpha, which
+            saves a division per pixel when it is drawn on a surface that
+            uses premultiplied pixels (Cairo, Qt or an HTML canvas).
+
+        * Raises ValueError if there are no layers to render.
+        """
+        preview = self._preview_generator(max_size)
+        with recording(preview) as record:
+            image = preview._composite_layers()
+            if not image:
+                raise ValueError("Nothing to render")
+            if image.mode == "RGBa" and not premultiplied:
+                with record.stage('premultiply'):
+                    image = image.convert("RGBA")
+            record.count('pixels', image.size[0] * image.size[1])
+        return image
+
+    def preview_bytes(self, max_size=None, image_format='PNG'):
+        """
+        Renders a preview as for render_preview and returns it encoded for
+        speed rather than size (PNGs with encoding.PNG_FAST).
+        """
+        image = self.render_preview(max_size)
+        options = encoding.PNG_FAST if image_format.upper() == 'PNG' else None
+        buf = BytesIO()
+        encoding.encode(image, buf, image_format, options)
+        return buf.getvalue()
+
+    def _preview_generator(self, max_size):
+        """
+        Returns a copy of this generator that renders previews no wider or
+        taller than max_size (by default, preview_size)
+        """
+        max_size = max_size or self.preview_size
+        layers, sizes = self._visible_layers()
+        largest = max([max(self._scaled_size(size) or size)
+                       for size in sizes] or [0])
+        scale = self.scale
+        if largest > max_size:
+            scale = self.scale * float(max_size) / largest
+
+        preview = self._at_scale(scale)
+        preview._preview = True
+        preview.prefix_cache = self.preview_prefix_cache
+        return preview
+
+    def render_async(self, image_format=None, timeout=None, renderer=None):
+        """
+        Returns an awaitable that renders the image in an executor, without
+        blocking the event loop, and resolves to the encoded bytes (see
+        imagecraft.aio). Requires Python 3.7 or later.
+
+        timeout - (optional) Seconds to wait before raising
+            asyncio.TimeoutError.
+
+        renderer - (optional) The aio.AsyncRenderer to use, which determines
+            the executor and the limit on renders in flight. Defaults to the
+            shared aio.default_renderer.
+        """
+        from . import aio
+        return aio.render_async(self, image_format, timeout, renderer)
+
+    def fingerprint(self):
+        """
+        Returns a hash of everything that determines the rendered output: the
+        layer definitions with their resolved colors, the contents of the
+        source files and the output format.
+        """
+        inputs = json.dumps(self._fingerprint_inputs(), sort_keys=True)
+        return hashlib.sha1(inputs.encode('utf-8')).hexdigest()
+
+    def _fingerprint_inputs(self):
+        """Returns a JSON-serializable description of the render inputs"""
+        layers = []
+        for layer in self.colors_for_layers:
+            digest = self.layer_cache.digest(os.path.join(self.source_path,
+                                                          layer.filename))
+            layers.append([layer.color, layer.filename, digest])
+
+        inputs = {
+            'layers': layers,
+            'output_filename': self.output_filename,
+            'image_format': self.image_format,
+        }
+        # Only when set, so that existing fingerprints stay valid
+        if self.scale != 1 or self.source_scale != 1:
+            inputs['scale'] = [self.scale, self.source_scale]
+        if self.encoder_options or self.encoder_candidates:
+            inputs['encoder'] = [self.encoder_options,
+                                 self.encoder_candidates]
+        return inputs
+
+    def is_up_to_date(self, fingerprint=None):
+        """
+        Returns True if the output file exists and was last written from
+        inputs matching `fingerprint` (by default, the current fingerprint).
+        """
+        output_file = self._output_file()
+        try:
+            with open(output_file + '.fingerprint') as fp:
+                recorded = fp.read().strip()
+        except IOError:
+            return False
+
+        if fingerprint is None:
+            fingerprint = self.fingerprint()
+        return recorded == fingerprint and os.path.exists(output_file)
+
+    @classmethod
+    def render_many(cls, palettes, source_path=None, batch_size=16,
+                    scale=None):
+        """
+        Renders one image for every color dictionary in `palettes`, yielding
+        (color_dict, image) pairs in order as each image is finished. Nothing
+        is written to disk.
+
+        The layer stack is only loaded once. When NumPy is available the
+        palettes are composited `batch_size` at a time as stacked arrays, so
+        memory use is bounded by the batch size rather than the number of
+        palettes.
+
+        source_path - (optional) As for the constructor.
+
+        batch_size - (optional) The number of palettes composited at once.
+
+        scale - (optional) As for the constructor.
+
+        * Raises the same errors as the constructor for invalid palettes.
+        """
+        palettes = iter(palettes)
+        stack = None
+
+        while True:
+            chunk = list(itertools.islice(palettes, batch_size))
+            if not chunk:
+                break
+
+            generators = [cls(palette, source_path=source_path, scale=scale)
+                          for palette in chunk]
+            if stack is None and numpy is not None:
+                stack = generators[0]._layer_stack()
+
+            # Variants can only share a batch if the same layers are colorized
+            groups = {}
+            for position, generator in enumerate(generators):
+                colors = generator._layer_colors()
+                colorized = tuple(color is not None for color in colors)
+                groups.setdefault(colorized, []).append((position, colors))
+
+            images = [None] * len(generators)
+            for colorized, members in groups.items():
+                if stack is not None and stack.supports(colorized):
+                    pixels = stack.composite(
+                        cls._batch_luts(colorized, members), len(members))
+                    mode = "RGBA" if pixels.shape[-1] == 4 else "RGB"
+                    for (position, colors), variant in zip(members, pixels):
+                        images[position] = Image.fromarray(variant, mode)
                 else:
-                    previous_alpha = ImageChops.screen(previous_alpha, alpha)
+                    for position, colors in members:
+                        images[position] = \
+                            generators[position]._composite_layers()
+
+            for palette, image in zip(chunk, images):
+                yield palette, image
+
+    @staticmethod
+    def _batch_luts(colorized, members):
+        """
+        Returns the per-layer colorization lookup tables for a batch of
+        variants, as expected by compositor.LayerStack.composite.
+        """
+        white = (255, 255, 255)
+        luts = []
+        for layeridx, is_colorized in enumerate(colorized):
+            if not is_colorized:
+                luts.append(None)
+                continue
+            tables = numpy.array([colorize_lut(colors[layeridx], white)
+                                  for position, colors in members])
+            # Image.point clips table entries to 0-255; do the same here
+            tables = numpy.clip(tables, 0, 255).astype(numpy.uint8)
+            luts.append(tables.reshape(len(members), 3, 256)
+                        .transpose(0, 2, 1))
+        return luts
+
+    def _visible_layers(self):
+        """
+        Returns the layers that can affect the output, those from the
+        topmost layer without an alpha channel upwards (see plan.RenderPlan),
+        along with the size of each one's source file.
+        """
+        info = self._plan.inspect(self.source_path)
+        return self.colors_for_layers[info.first_visible:], \
+            info.sizes[info.first_visible:]
+
+    def _layer_colors(self):
+        """
+        Returns the resolved color (or None) for each visible layer, in order
+        """
+        layers, sizes = self._visible_layers()
+        return tuple(layer.color for layer in layers)
+
+    def _layer_stack(self):
+        """Returns a compositor.LayerStack of the visible layers"""
+        cached_layers = []
+        # A file used by several layers is only fetched once, so it is not
+        # decoded again if the cache evicts it part way through the stack.
+        loaded = {}
+        record = self._record
+        layers, sizes = self._visible_layers()
+        record.count('layers', len(layers))
+        for layer, size in zip(layers, sizes):
+            cached = loaded.get(layer.filename)
+            if cached is None:
+                with record.stage('decode'):
+                    cached = loaded[layer.filename] = self.layer_cache.get(
+                        os.path.join(self.source_path, layer.filename),
+                        record, self._scaled_size(size))
+            cached_layers.append(cached)
+        return compositor.LayerStack(cached_layers)
+
+    def _scaled_size(self, size):
+        """
+        Returns the size a source image of the given size is rendered at, or
+        None if it is rendered at its own size.
+        """
+        if self.scale == self.source_scale:
+            return None
+        ratio = float(self.scale) / self.source_scale
+        return (max(1, int(round(size[0] * ratio))),
+                max(1, int(round(size[1] * ratio))))
+
+    def _render_output(self):
+        """
+        Returns the image to be encoded by render and render_to: a PIL image,
+        or a tiling.TiledImage if max_render_bytes calls for rendering in
+        strips. Returns None if there are no layers.
+
+        A tiled render bypasses the layer cache for source images that are
+        8-bit, non-interlaced PNGs rendered at their own size: each strip
+        decodes just its own rows of them (see tiling.PNGReader). Other
+        sources are held whole in the layer cache for the render, as are
+        those the cache's store holds, which then cost no private memory.
+        max_render_bytes bounds the memory held for those sources, the
+        rows of every source for the current strip and the working space
+        needed to composite it, but not the finished image unless it is
+        streamed out as PNG. If it leaves no room, strips are one row high.
+        """
+        if not self.max_render_bytes:
+            return self._composite_layers()
+
+        layers, sizes = self._visible_layers()
+        scaled_sizes = [self._scaled_size(size) for size in sizes]
+        output_sizes = set(scaled or size
+                           for scaled, size in zip(scaled_sizes, sizes))
+        if len(output_sizes) != 1:
+            # Nothing to tile (or mismatched layers); let PIL sort it out
+            return self._composite_layers()
+
+        width, height = output_sizes.pop()
+        record = self._record
+        record.count('layers', len(layers))
+        sources = {}
+        for layer, size in zip(layers, scaled_sizes):
+            if layer.filename not in sources:
+                path = os.path.join(self.source_path, layer.filename)
+                with record.stage('decode'):
+                    sources[layer.filename] = _StripSource(
+                        self.layer_cache, path, size, record)
+        held_bytes = sum(source.held_bytes for source in sources.values())
+        # Compositing needs roughly a dozen bytes per pixel of working space
+        row_bytes = width * 12 + sum(source.row_bytes
+                                     for source in sources.values())
+        strip_height = max(1, (self.max_render_bytes - held_bytes)
+                           // row_bytes)
+        if strip_height >= height:
+            return self._composite_layers()
+
+        colors = tuple(layer.color for layer in layers)
+
+        def render_strip(box):
+            with record.stage('decode'):
+                strips = dict((filename, source.strip(box))
+                              for filename, source in sources.items())
+            strip = compositor.LayerStack([strips[layer.filename]
+                                           for layer in layers])
+            return self._composite_stack(strip, colors)
+
+        return TiledImage((width, height), strip_height, render_strip)
+
+    def _composite_layers(self):
+        """
+        Passes over each layer, colorizes it and sandwiches them all together.
+        Returns the resulting image, or None if there are no layers.
+        """
+        return self._composite_stack(self._layer_stack(),
+                                     self._layer_colors(), self.prefix_cache)
+
+    def _composite_stack(self, stack, colors, prefix_cache=None):
+        """
+        Composites a compositor.LayerStack using the resolved color for each
+        layer, returning the resulting image (or None if there are no layers).
+
+        prefix_cache - (optional) A prefix_cache.PrefixCache to resume from
+            and save partial composites to. Only pass one for whole stacks,
+            not strips of one.
+
+        When NumPy is available the stack is accumulated band by band into a
+        fixed set of working images (see compositor.LayerStack); otherwise, or
+        for layer stacks it does not handle, each layer is composited into a
+        new image.
+        """
+        with self._record.stage('composite'):
+            if numpy is not None and \
+                    stack.supports([color is not None for color in colors]):
+                white = (255, 255, 255)
+                luts = [None if color is None else colorize_lut(color, white)
+                        for color in colors]
+                if prefix_cache is None:
+                    return stack.composite_frame(luts, self._record,
+                                                 premultiplied=self._preview)
+                return self._composite_frame_cached(stack, colors, luts,
+                                                    prefix_cache)
+
+            return self._composite_layers_pil(stack, colors, prefix_cache)
+
+    def _composite_frame_cached(self, stack, colors, luts, prefix_cache):
+        """
+        Calls the stack's composite_frame, carrying on from the longest
+        prefix of it in prefix_cache and saving the prefixes it goes through
+        """
+        key = ('frame', _stack_key(stack))
+        width, height = stack.layers[0].size
+        nbytes = width * height * 4
+
+        count, resume = prefix_cache.find(key, colors)
+        if resume is not None:
+            self._record.count('prefix_cache_hits')
+            self._record.count('layers_reused', count)
+            resume = (count,) + resume
+
+        def checkpoint(count, bands, planes):
+            if prefix_cache.wants(key, colors[:count], nbytes):
+                prefix_cache.save(key, colors[:count],
+                                  (bands, [plane.copy() for plane in planes]),
+                                  nbytes)
+
+        return stack.composite_frame(luts, self._record, resume, checkpoint,
+                                     self._preview)
+
+    def _composite_layers_pil(self, stack, colors, prefix_cache=None):
+        """
+        PIL version of _composite_layers, given the generator's
+        compositor.LayerStack and the resolved color for each layer, and
+        optionally a prefix cache as for _composite_stack.
+        """
+        baselayer = None
+        start = 0
+        if prefix_cache is not None:
+            # Previews premultiply differently (see render_preview)
+            key = ('pil-preview' if self._preview else 'pil',
+                   _stack_key(stack))
+            start, baselayer = prefix_cache.find(key, colors)
+            if start:
+                self._record.count('prefix_cache_hits')
+                self._record.count('layers_reused', start)
+
+        for layeridx in range(start, len(stack.layers)):
+            cached = stack.layers[layeridx]
+            color = colors[layeridx]
+            if prefix_cache is not None and color is not None and \
+                    baselayer is not None:
+                # Every step below makes a new baselayer, so the current one
+                # can be saved as it is
+                nbytes = (baselayer.size[0] * baselayer.size[1] *
+                          len(baselayer.getbands()))
+                if prefix_cache.wants(key, colors[:layeridx], nbytes):
+                    prefix_cache.save(key, colors[:layeridx], baselayer,
+                                      nbytes)
+
+            img = cached.image
+            alpha = cached.alpha
 
             # Colorize image if a color is present
             if color is not None:
 
-                # Convert the image to greyscale in case it isn't already.
-                greyscale_img = ImageOps.grayscale(img)
+                # The image converted to greyscale in case it isn't already.
+                greyscale_img = cached.greyscale
 
                 # Colorize the image with `color` as black, and white as white
                 white = (255, 255, 255)
-                colorized = ImageOps.colorize(greyscale_img, color, white)
+                with self._record.stage('colorize'):
+                    colorized = colorize(greyscale_img, color, white)
 
                 if alpha:
                     img_mask = alpha
@@ -258,26 +836,59 @@ class ImageGenerator(object):
                     baselayer = Image.composite(img, baselayer, img)
                     baselayer = self._remove_premultiplied_alpha(baselayer)
                 else:
-                    # No colorize, no alpha, just overwrite it
-                    baselayer = img
+                    # No colorize, no alpha, just overwrite it. The cached
+                    # layer is shared, so never hand it out directly.
+                    baselayer = img.copy()
 
         # pre-multiplied alpha = slightly improved alpha-blended colours
-        if baselayer.mode == "RGBA":
+        if baselayer and baselayer.mode == "RGBA":
+            if self._preview:
+                return Image.merge("RGBa", baselayer.split())
             baselayer = self._apply_premultiplied_alpha(baselayer)
 
-        # Attempt to write the image out to disk.
-        if baselayer:
-            self._write_to_file(baselayer)
-        else:
-            raise ValueError, "Nothing to write to disk"
-
-        return
+        return baselayer
 
     def _remove_premultiplied_alpha(self, pil_image):
         """Returns an object with pre-multiplied alpha removed"""
         if pil_image.mode != "RGBA":
             raise ValueError("Cannot operate on alpha if not mode RGBA")
 
+        with self._record.stage('premultiply'):
+            if self._preview:
+                return self._remove_premultiplied_alpha_pil(pil_image)
+            if numpy is not None:
+                return self._remove_premultiplied_alpha_numpy(pil_image)
+            return self._remove_premultiplied_alpha_python(pil_image)
+
+    def _apply_premultiplied_alpha(self, pil_image):
+        """Returns a PIL object with premultiplied alpha added"""
+        if pil_image.mode != "RGBA":
+            raise ValueError("Cannot operate on alpha if not mode RGBA")
+
+        with self._record.stage('premultiply'):
+            if numpy is not None:
+                return self._apply_premultiplied_alpha_numpy(pil_image)
+            return self._apply_premultiplied_alpha_python(pil_image)
+
+    def _remove_premultiplied_alpha_numpy(self, pil_image):
+        """Array-backed version of _remove_premultiplied_alpha"""
+        pixels = compositor.remove_premultiplied_alpha(numpy.asarray(pil_image))
+        return Image.fromarray(pixels, "RGBA")
+
+    def _apply_premultiplied_alpha_numpy(self, pil_image):
+        """Array-backed version of _apply_premultiplied_alpha"""
+        pixels = compositor.apply_premultiplied_alpha(numpy.asarray(pil_image))
+        return Image.fromarray(pixels, "RGBA")
+
+    def _remove_premultiplied_alpha_pil(self, pil_image):
+        """
+        Version of _remove_premultiplied_alpha using PIL's conversion to
+        "RGBa", which rounds rather than truncates; for previews only
+        """
+        return Image.merge("RGBA", pil_image.convert("RGBa").split())
+
+    def _remove_premultiplied_alpha_python(self, pil_image):
+        """Pure-Python version of _remove_premultiplied_alpha"""
         out = Image.new(pil_image.mode, pil_image.size, None)
         o = out.load()
         p = pil_image.load()
@@ -291,11 +902,8 @@ class ImageGenerator(object):
 
         return out
 
-    def _apply_premultiplied_alpha(self, pil_image):
-        """Returns a PIL object with premultiplied alpha added"""
-        if pil_image.mode != "RGBA":
-            raise ValueError("Cannot operate on alpha if not mode RGBA")
-
+    def _apply_premultiplied_alpha_python(self, pil_image):
+        """Pure-Python version of _apply_premultiplied_alpha"""
         out = Image.new(pil_image.mode, pil_image.size, None)
         o = out.load()
         p = pil_image.load()
@@ -310,27 +918,164 @@ class ImageGenerator(object):
 
         return out
 
-    def _write_to_file(self, imageobj):
+    def _output_file(self):
         """
-        Writes the output image out to disk.
+        Returns the path the output image is written to.
 
         * Raises NotImplementedError if you forgot to specify
           self.output_filename or self.image_format constants.
-
-        * Raises OSError if there was a problem writing out the file.
         """
         if not self.output_filename:
-            raise NotImplementedError, "You must specify an output filename"
+            raise NotImplementedError("You must specify an output filename")
         elif not self.image_format:
-            raise NotImplementedError, "You must specify an output format"
+            raise NotImplementedError("You must specify an output format")
         else:
             pass # Both values present, continue
 
+        return os.path.join(self.output_path, self._output_filename())
+
+    def _output_filename(self):
+        """
+        Returns the name of the output file: output_filename, or for scales
+        other than 1, scaled_filename filled in with the name and extension
+        of output_filename and the scale.
+        """
+        if self.scale == 1:
+            return self.output_filename
+        name, ext = os.path.splitext(self.output_filename)
+        return self.scaled_filename.format(name=name, ext=ext,
+                                           scale=_format_scale(self.scale))
+
+    def _write_to_file(self, imageobj, fingerprint=None):
+        """
+        Writes the output image out to disk, along with a sidecar file
+        recording the fingerprint of the inputs it was rendered from.
+
+        * Raises NotImplementedError if you forgot to specify
+          self.output_filename or self.image_format constants.
+
+        * Raises OSError if there was a problem writing out the file.
+        """
+        output_file = self._output_file()
+        fingerprint_file = output_file + '.fingerprint'
+
+        # Never leave a stale fingerprint behind a partially-written image
+        if os.path.exists(fingerprint_file):
+            os.remove(fingerprint_file)
+
         try:
-            imageobj.save(os.path.join(self.output_path, self.output_filename),
-                            self.image_format)
-        except IOError, msg:
+            self._encode(imageobj, output_file, self.image_format)
+        except IOError:
             raise
 
+        with open(fingerprint_file, 'w') as fp:
+            fp.write(fingerprint or self.fingerprint())
+
         return
 
+    def _encode(self, imageobj, fp, image_format):
+        """
+        Encodes the image in the given format to `fp`, which may be a
+        filename or a writable file-like object.
+        """
+        record = self._record
+        if record is NULL_RECORD:
+            encoding.encode(imageobj, fp, image_format, self.encoder_options,
+                            self.encoder_candidates)
+            return
+
+        start = _file_position(fp)
+        with record.stage('encode'):
+            encoding.encode(imageobj, fp, image_format, self.encoder_options,
+                            self.encoder_candidates)
+        end = _file_position(fp)
+        if start is not None and end is not None:
+            record.count('bytes_encoded', end - start)
+
+
+class _StripSource(object):
+    """
+    The rows of one source image for each strip of a tiled render, read a
+    strip at a time from the file where possible (see
+    ImageGenerator._render_output), otherwise cropped from the whole layer.
+    """
+
+    def __init__(self, cache, path, size, record):
+        """
+        Constructor.
+
+        cache - The layer_cache.LayerCache to fetch whole layers from.
+
+        path - The path of the source image.
+
+        size - The size the layer is rendered at, or None for its own size.
+
+        record - An instrumentation.RenderRecord to count lookups in.
+        """
+        self.path = path
+        self._reader = None
+        self._layer = None
+        if size is None and not cache.is_stored(path):
+            try:
+                self._reader = PNGReader(path)
+            except ValueError:
+                pass # Not a PNG that can be read in strips
+            else:
+                # Reopened by the first strip, as the image may never be
+                # rendered
+                self._reader.close()
+        if self._reader is None:
+            self._layer = cache.get(path, record, size)
+            self.held_bytes = self._layer.nbytes
+            self.row_bytes = self._layer.nbytes // self._layer.size[1]
+        else:
+            self.held_bytes = 0
+            # A CachedLayer of the rows, plus the copies made decoding them
+            self.row_bytes = self._reader.size[0] * 2 + \
+                self._reader.stride * 4
+
+    def strip(self, box):
+        """Returns a CachedLayer of the rows of the layer inside box"""
+        if self._layer is not None:
+            return self._layer.crop(box)
+
+        top, bottom = box[1], box[3]
+        if self._reader.fp.closed or self._reader.row > top:
+            # Strips are normally asked for in order; start again if not
+            self._reader.close()
+            self._reader = PNGReader(self.path)
+        while self._reader.row < top:
+            self._reader.read(min(bottom - top, top - self._reader.row))
+        image = self._reader.read(bottom - top)
+        if self._reader.row == self._reader.size[1]:
+            self._reader.close()
+        return CachedLayer(image, None)
+
+
+def _stack_key(stack):
+    """
+    Returns a key identifying the source layers of a compositor.LayerStack,
+    for prefix_cache.PrefixCache
+    """
+    return tuple((layer.digest, layer.size) for layer in stack.layers)
+
+
+def _format_scale(scale):
+    """Formats a scale for a file name: 2 and 2.0 as "2", 1.5 as "1.5" """
+    if float(scale) == int(scale):
+        return str(int(scale))
+    return str(scale)
+
+
+def _file_position(fp):
+    """
+    Returns the current size of the file named fp, or the position of the
+    file-like object fp, or None if neither can be determined.
+    """
+    try:
+        if hasattr(fp, 'tell'):
+            return fp.tell()
+        return os.path.getsize(fp) if os.path.exists(fp) else 0
+    except (IOError, OSError, ValueError):
+        return None
+
@@ -0,0 +1,312 @@
+"""
+Opt-in timing and counters for renders.
+
+Give an ImageGenerator (or a subclass, or the base class for everything) a
+sequence of observers, and after every render each observer is called with
+a RenderRecord describing where the time went:
+
+    stats = StatsCollector()
+    ImageGenerator.observers = (stats,)
+    ...
+    print(stats.to_prometheus())
+
+Observers are plain callables, so a function that logs slow renders works
+just as well as a StatsCollector. Stage times are exclusive: time spent
+colorizing inside compositing is counted as colorize, not composite, so the
+stages of a render add up to (nearly) its total time.
+
+Stages:
+
+    fingerprint - Hashing the inputs to decide whether to render at all.
+    decode - Fetching layers, including decoding and splitting them.
+    colorize - Colorizing greyscale layers.
+    composite - Combining the layers.
+    premultiply - Removing and applying premultiplied alpha.
+    encode - Encoding (and writing) the output file.
+
+Counters:
+
+    layers - Layers in the stack.
+    pixels - Pixels in the output image.
+    layer_cache_hits, layer_cache_misses - Layer cache lookups.
+    layer_store_loads - Misses served by a compiled layer store.
+    prefix_cache_hits - Composites resumed from a prefix cache.
+    layers_reused - Layers not composited again thanks to the prefix cache.
+    bytes_decoded - Encoded bytes read and decoded on cache misses.
+    bytes_encoded - Bytes of output written.
+    renders_skipped - Calls to render() that found the output file already
+        up to date, so rendered nothing.
+
+When a generator has no observers, the hooks are calls to a shared no-op
+record, so instrumentation costs nothing measurable. Records belong to the
+thread doing the render, so one generator can be rendered (and observed) by
+several threads at once.
+"""
+
+# Standard library
+import threading
+import time
+
+
+STAGES = ('fingerprint', 'decode', 'colorize', 'composite', 'premultiply',
+          'encode')
+
+
+class RenderRecord(object):
+    """The timings and counters of a single render."""
+
+    def __init__(self, generator):
+        """
+        Constructor.
+
+        generator - The ImageGenerator instance being rendered.
+        """
+        self.generator = generator
+        self.generator_name = type(generator).__name__
+        self.stages = {}
+        self.counters = {}
+        self.seconds = 0.0
+        self.error = None
+        self._started = time.time()
+        # Open stage timers, innermost last
+        self._open = []
+
+    def stage(self, name):
+        """
+        Returns a context manager that times the code inside it as stage
+        `name`.
+        """
+        return _StageTimer(self, name)
+
+    def count(self, name, value=1):
+        """Adds value to the counter `name`."""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self, error=None):
+        """Records the total time of the render and any exception raised."""
+        self.seconds = time.time() - self._started
+        self.error = error
+
+
+class _StageTimer(object):
+    """Times one stage of a RenderRecord, excluding any nested stages"""
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+        self.nested = 0.0
+
+    def __enter__(self):
+        self.record._open.append(self)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.time() - self.started
+        record = self.record
+        record._open.pop()
+        record.stages[self.name] = (record.stages.get(self.name, 0.0) +
+                                    elapsed - self.nested)
+        if record._open:
+            record._open[-1].nested += elapsed
+        return False
+
+
+class _NullRecord(object):
+    """Stands in for a RenderRecord when nobody is observing"""
+
+    def stage(self, name):
+        return _NULL_TIMER
+
+    def count(self, name, value=1):
+        pass
+
+
+class _NullTimer(object):
+    """A stage timer that does nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+# The record used when a generator has no observers.
+NULL_RECORD = _NullRecord()
+
+# The renders in progress on each thread, as id(generator) -> RenderRecord
+_local = threading.local()
+
+
+def current_record(generator):
+    """
+    Returns the RenderRecord of the render of `generator` in progress on
+    this thread, or NULL_RECORD if there is none.
+    """
+    records = getattr(_local, 'records', None)
+    if not records:
+        return NULL_RECORD
+    return records.get(id(generator), NULL_RECORD)
+
+
+class recording(object):
+    """
+    A context manager that records a render of `generator` if it has
+    observers, and passes the record to each of them at the end.
+
+    Nested uses for the same generator on the same thread (render_bytes
+    calling render_to, for example) are folded into the outermost one.
+    """
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.record = None
+
+    def __enter__(self):
+        generator = self.generator
+        if not generator.observers:
+            return NULL_RECORD
+        records = _local.__dict__.setdefault('records', {})
+        record = records.get(id(generator))
+        if record is None:
+            self.record = record = records[id(generator)] = \
+                RenderRecord(generator)
+        return record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record = self.record
+        if record is None:
+            return False
+
+        del _local.records[id(self.generator)]
+        record.finish(exc_value)
+        for observer in self.generator.observers:
+            observer(record)
+        return False
+
+
+class StatsCollector(object):
+    """
+    An observer that accumulates RenderRecords per generator class, and
+    exports the totals.
+
+    Usage:
+
+        stats = StatsCollector()
+        ImageGenerator.observers = (stats,)
+        ...
+        stats.snapshot()['Button']['stages']['encode']
+        stats.to_prometheus()
+    """
+
+    def __init__(self, namespace='imagecraft'):
+        """
+        Constructor.
+
+        namespace - (optional) The prefix of the exported metric names.
+        """
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Discards everything collected so far."""
+        with self._lock:
+            self._generators = {}
+
+    def __call__(self, record):
+        """Adds a RenderRecord to the totals."""
+        with self._lock:
+            totals = self._generators.get(record.generator_name)
+            if totals is None:
+                totals = self._generators[record.generator_name] = {
+                    'renders': 0,
+                    'errors': 0,
+                    'seconds': 0.0,
+                    'max_seconds': 0.0,
+                    'stages': {},
+                    'counters': {},
+                }
+            totals['renders'] += 1
+            if record.error is not None:
+                totals['errors'] += 1
+            totals['seconds'] += record.seconds
+            totals['max_seconds'] = max(totals['max_seconds'],
+                                        record.seconds)
+            for name, seconds in record.stages.items():
+                totals['stages'][name] = (totals['stages'].get(name, 0.0) +
+                                          seconds)
+            for name, value in record.counters.items():
+                totals['counters'][name] = (totals['counters'].get(name, 0) +
+                                            value)
+
+    def snapshot(self):
+        """
+        Returns a copy of the totals: a dictionary of generator class names
+        to dictionaries holding renders, errors, seconds, max_seconds, and
+        the stages and counters dictionaries.
+        """
+        with self._lock:
+            return dict((name, dict(totals, stages=dict(totals['stages']),
+                                    counters=dict(totals['counters'])))
+                        for name, totals in self._generators.items())
+
+    def to_prometheus(self):
+        """Returns the totals in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        metrics = [
+            ('renders_total', 'counter', 'Renders finished.',
+             lambda totals: [({}, totals['renders'])]),
+            ('render_errors_total', 'counter', 'Renders that raised.',
+             lambda totals: [({}, totals['errors'])]),
+            ('render_seconds_total', 'counter', 'Time spent rendering.',
+             lambda totals: [({}, totals['seconds'])]),
+            ('render_seconds_max', 'gauge', 'The slowest render.',
+             lambda totals: [({}, totals['max_seconds'])]),
+            ('stage_seconds_total', 'counter',
+             'Time spent in each stage of rendering.',
+             lambda totals: [({'stage': name}, seconds) for name, seconds
+                             in sorted(totals['stages'].items())]),
+        ]
+        counter_names = sorted(set(name for totals in snapshot.values()
+                                   for name in totals['counters']))
+        for counter in counter_names:
+            metrics.append((counter + '_total', 'counter',
+                            'Total %s.' % counter.replace('_', ' '),
+                            lambda totals, counter=counter: [
+                                ({}, totals['counters'][counter])]
+                            if counter in totals['counters'] else []))
+
+        lines = []
+        for name, kind, help_text, samples in metrics:
+            name = '%s_%s' % (self.namespace, name)
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for generator in sorted(snapshot):
+                for labels, value in samples(snapshot[generator]):
+                    labels = dict(labels, generator=generator)
+                    lines.append('%s{%s} %s' % (
+                        name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    """Formats a dictionary of labels for the Prometheus text format"""
+    return ','.join('%s="%s"' % (key, _escape(labels[key]))
+                    for key in sorted(labels))
+
+
+def _escape(value):
+    """Escapes a label value for the Prometheus text format"""
+    return value.replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
+
+
+def _format_value(value):
+    """Formats a sample value for the Prometheus text format"""
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,374 @@
+"""
+A process-wide cache of decoded source layers.
+
+Source images rarely (if ever) change between renders, so decoding them and
+splitting out their alpha and greyscale planes on every call to render() is
+wasted effort. The LayerCache keeps the decoded images around, keyed by the
+resolved path of the file along with its modification time and size so that
+edited files are picked up automatically. Files with identical contents are
+only ever held once, no matter how many paths or generators refer to them.
+
+Layers can also be fetched at other sizes, for rendering at several pixel
+densities. Each size is resampled from the full-size layer, so a file is
+decoded once however many sizes are needed, and is cached alongside it.
+
+A cache can be backed by a compiled layer_store.LayerStore; layers found in
+the store are mapped from it instead of being decoded.
+"""
+
+# Standard library
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+# Third-party libraries
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    try:
+        import Image, ImageOps
+    except ImportError:
+        raise ImportError("Could not locate Python Imaging Library (PIL)")
+
+
+# Default upper bound on the memory held by the shared cache.
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+
+
+def _image_bytes(pil_image):
+    """Returns the approximate number of bytes held by a decoded image"""
+    if pil_image is None:
+        return 0
+    width, height = pil_image.size
+    return width * height * len(pil_image.getbands())
+
+
+class CachedLayer(object):
+    """
+    A decoded source layer along with the planes derived from it.
+
+    Instances are shared between every generator that uses the same source
+    file, so the images they hold must be treated as read-only.
+    """
+
+    def __init__(self, image, digest):
+        """
+        Constructor.
+
+        image - The fully-loaded PIL image for the layer.
+
+        digest - The hash of the encoded file contents the image came from.
+        """
+        self.image = image
+        self.digest = digest
+
+        # Split the image into component channels
+        split_channels = image.split()
+        if len(split_channels) == 2: # Image is Greyscale + Alpha
+            self.alpha = split_channels[1]
+        elif len(split_channels) == 4: # Image is RGB + Alpha
+            self.alpha = split_channels[3]
+        else: # No alpha channel present
+            self.alpha = None
+
+        self.greyscale = ImageOps.grayscale(image)
+        self.nbytes = (_image_bytes(self.image) + _image_bytes(self.alpha) +
+                       _image_bytes(self.greyscale))
+
+        # Work out once which part of the layer is visible at all, so that
+        # compositing can skip (or simplify) everything else. The bounding
+        # box is None if the layer is fully transparent.
+        if self.alpha is None:
+            self.alpha_extrema = (255, 255)
+            self.bbox = (0, 0) + image.size
+        else:
+            self.alpha_extrema = self.alpha.getextrema()
+            self.bbox = self.alpha.getbbox()
+
+    @classmethod
+    def from_planes(cls, image, alpha, greyscale, digest, alpha_extrema,
+                    bbox, nbytes):
+        """
+        Returns a CachedLayer made of planes that have already been worked
+        out (by a layer_store.LayerStore), without splitting image again.
+
+        nbytes - The private memory held by the planes; planes mapped from a
+            file are not counted.
+        """
+        layer = cls.__new__(cls)
+        layer.image = image
+        layer.digest = digest
+        layer.alpha = alpha
+        layer.greyscale = greyscale
+        layer.alpha_extrema = alpha_extrema
+        layer.bbox = bbox
+        layer.nbytes = nbytes
+        return layer
+
+    @property
+    def size(self):
+        """The (width, height) of the layer"""
+        return self.image.size
+
+    @property
+    def is_opaque(self):
+        """True if every pixel of the layer is fully opaque"""
+        return self.alpha_extrema[0] == 255
+
+    def crop(self, box):
+        """
+        Returns a new, uncached CachedLayer holding just the given
+        (left, upper, right, lower) region of this one.
+        """
+        return CachedLayer(self.image.crop(box), self.digest)
+
+    def resize(self, size):
+        """
+        Returns a new, uncached CachedLayer holding this one resampled to
+        the given (width, height).
+        """
+        return CachedLayer(self.image.resize(size, Image.LANCZOS),
+                           self.digest)
+
+
+class LayerCache(object):
+    """
+    A size-bounded, least-recently-used cache of decoded source layers.
+
+    Usage:
+
+        layer = layer_cache.get('/path/to/layer.png')
+        layer.image, layer.alpha, layer.greyscale
+
+    The hits, misses and evictions attributes count cache activity since the
+    cache was created or last cleared; store_loads counts the misses that
+    were served by the store.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, store=None):
+        """
+        Constructor.
+
+        max_bytes - (optional) The approximate upper bound on the memory used
+            by decoded layers. The most recently used layer is always kept,
+            even if it alone exceeds this limit.
+
+        store - (optional) A layer_store.LayerStore to read layers from
+            before decoding them. It can also be set later, through the
+            store attribute.
+        """
+        self.max_bytes = max_bytes
+        self.store = store
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Drops every cached layer and resets the counters."""
+        with self._lock:
+            # realpath -> (mtime, size, digest)
+            self._paths = {}
+            # digest (or (digest, size) for resized layers) -> CachedLayer,
+            # least recently used first
+            self._layers = OrderedDict()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.store_loads = 0
+
+    def stats(self):
+        """Returns a dictionary of the cache counters."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'store_loads': self.store_loads,
+                'layers': len(self._layers),
+                'bytes': self.current_bytes,
+            }
+
+    def digest(self, path):
+        """
+        Returns the hash of the contents of the file at path, reading the file
+        only if it is unknown or has changed on disk. Nothing is decoded.
+
+        * Raises IOError (or OSError) if the file cannot be read.
+        """
+        realpath = os.path.realpath(path)
+        stat = os.stat(realpath)
+        signature = (stat.st_mtime, stat.st_size)
+
+        digest = self._known_digest(realpath, signature)
+        if digest is not None:
+            return digest
+
+        with open(realpath, 'rb') as fp:
+            digest = hashlib.sha1(fp.read()).hexdigest()
+
+        with self._lock:
+            self._paths[realpath] = signature + (digest,)
+        return digest
+
+    def is_stored(self, path, size=None):
+        """
+        Returns True if the store holds the layer for the image file at path,
+        at the given (width, height) or at full size. Nothing is decoded.
+
+        * Raises IOError (or OSError) if the file cannot be read.
+        """
+        store = self.store
+        return store is not None and \
+            store.get(self.digest(path), size) is not None
+
+    def _known_digest(self, realpath, signature):
+        """
+        Returns the digest of a file if this cache or its store has seen it
+        with the same signature, otherwise None
+        """
+        with self._lock:
+            known = self._paths.get(realpath)
+        if known is None and self.store is not None:
+            known = self.store.paths.get(realpath)
+        if known and known[:2] == signature:
+            return known[2]
+        return None
+
+    def get(self, path, record=None, size=None):
+        """
+        Returns the CachedLayer for the image file at path, decoding it if it
+        is not cached or has changed on disk since it was cached.
+
+        record - (optional) An instrumentation.RenderRecord to count the
+            lookup (and any bytes decoded) in.
+
+        size - (optional) The (width, height) to return the layer at, if not
+            its own size. The resampled layer is cached as well.
+
+        * Raises IOError (or OSError) if the file cannot be read.
+        """
+        if size is not None:
+            return self._get_resized(path, tuple(size), record)
+        return self._get_full(path, record)
+
+    def _get_full(self, path, record, keep=True):
+        """
+        Returns the full-size layer for the image file at path, as for get.
+        Unless keep is True, a newly decoded layer is only cached if that
+        evicts nothing.
+        """
+        realpath = os.path.realpath(path)
+        stat = os.stat(realpath)
+        signature = (stat.st_mtime, stat.st_size)
+
+        data = None
+        digest = self._known_digest(realpath, signature)
+        if digest is None:
+            # Unknown or modified file; read it and see if the contents are
+            # new
+            with open(realpath, 'rb') as fp:
+                data = fp.read()
+            digest = hashlib.sha1(data).hexdigest()
+            with self._lock:
+                self._paths[realpath] = signature + (digest,)
+
+        layer = self._lookup(digest, record)
+        if layer is not None:
+            return layer
+
+        layer = self._load_stored(digest, None, record)
+        if layer is None:
+            if data is None:
+                with open(realpath, 'rb') as fp:
+                    data = fp.read()
+            if record is not None:
+                record.count('layer_cache_misses')
+                record.count('bytes_decoded', len(data))
+            img = Image.open(BytesIO(data))
+            img.load() # Explicitly load the image to prevent errors
+            layer = CachedLayer(img, digest)
+            with self._lock:
+                self.misses += 1
+            if not keep and \
+                    self.current_bytes + layer.nbytes > self.max_bytes:
+                return layer
+
+        return self._insert(digest, layer)
+
+    def _get_resized(self, path, size, record):
+        """Returns the layer at path resampled to size, caching the result"""
+        digest = self.digest(path)
+        key = (digest, size)
+        layer = self._lookup(key, record)
+        if layer is not None:
+            return layer
+
+        layer = self._load_stored(digest, size, record)
+        if layer is None:
+            # The full-size layer is only wanted to resample; making room
+            # for it could push out the very layers resampled from it
+            full = self._get_full(path, record, keep=False)
+            if full.size == size:
+                return self._insert(digest, full)
+            layer = full.resize(size)
+        return self._insert(key, layer)
+
+    def _lookup(self, key, record):
+        """Returns a cached layer (counting the hit) or None"""
+        with self._lock:
+            layer = self._touch(key)
+            if layer is None:
+                return None
+            self.hits += 1
+        if record is not None:
+            record.count('layer_cache_hits')
+        return layer
+
+    def _load_stored(self, digest, size, record):
+        """Returns a layer from the store (counting the miss) or None"""
+        store = self.store
+        if store is None:
+            return None
+        layer = store.get(digest, size)
+        if layer is not None:
+            with self._lock:
+                self.misses += 1
+                self.store_loads += 1
+            if record is not None:
+                record.count('layer_cache_misses')
+                record.count('layer_store_loads')
+        return layer
+
+    def _insert(self, key, layer):
+        """
+        Caches a layer and returns it, or returns the layer cached under the
+        same key by another thread in the meantime
+        """
+        with self._lock:
+            existing = self._touch(key)
+            if existing is not None:
+                return existing
+            self._layers[key] = layer
+            self.current_bytes += layer.nbytes
+            self._evict()
+        return layer
+
+    def _touch(self, digest):
+        """Marks a layer as most recently used and returns it (or None)"""
+        layer = self._layers.pop(digest, None)
+        if layer is not None:
+            self._layers[digest] = layer
+        return layer
+
+    def _evict(self):
+        """Drops least recently used layers until under max_bytes"""
+        while self.current_bytes > self.max_bytes and len(self._layers) > 1:
+            digest, layer = self._layers.popitem(last=False)
+            self.current_bytes -= layer.nbytes
+            self.evictions += 1
+
+
+# The cache shared by every ImageGenerator in the process.
+layer_cache = LayerCache()
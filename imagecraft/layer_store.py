@@ -0,0 +1,294 @@
+"""
+A precompiled store of decoded source layers, shared between processes.
+
+Every process that renders decodes its source images into private memory.
+Compiling the sources into a layer store once, ahead of time, saves the
+decoding: the store holds each layer's pixels uncompressed, along with its
+alpha and greyscale planes, and is memory-mapped when opened. Layers read
+from it refer to the mapped pages rather than copies of them, so any number
+of worker processes on a machine share one copy through the OS page cache.
+
+    imagecraft compile jobs.json -o /srv/skins/layers.store
+
+    # At start-up in each worker:
+    layer_cache.store = LayerStore('/srv/skins/layers.store')
+
+Layers are looked up by the hash of their encoded file contents, so a source
+file edited after compiling is simply decoded as usual; a store can never
+return stale pixels. The store also records the modification time and size
+of each file it was compiled from, which saves hashing files that have not
+changed since.
+
+The file starts with a fixed header, followed by the planes (each aligned to
+64 bytes) and a JSON index describing them, including a CRC-32 of each plane
+for verify(). Compiling writes to a temporary file and renames it into
+place, so processes using the previous version of a store are unaffected.
+"""
+
+# Standard library
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import traceback
+import zlib
+from io import BytesIO
+
+# Third-party libraries
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        raise ImportError("Could not locate Python Imaging Library (PIL)")
+
+# This module
+from .layer_cache import CachedLayer
+
+
+MAGIC = b'ICLAYERS'
+VERSION = 1
+_HEADER = struct.Struct('<8sIQQ') # magic, version, index offset and length
+_ALIGNMENT = 64
+
+# Image modes that can be stored, and those PIL can map without copying.
+# Other layers (palette images, say) are left out and decoded as usual.
+STORABLE_MODES = ('L', 'LA', 'RGB', 'RGBA')
+_MAPPABLE_MODES = ('L', 'RGBA')
+
+_PLANES = ('image', 'alpha', 'greyscale')
+
+
+def _entry_key(digest, size):
+    """Returns the index key of a layer at the given size (None for full)"""
+    if size is None:
+        return digest
+    return '%s@%dx%d' % ((digest,) + tuple(size))
+
+
+class LayerStore(object):
+    """A compiled layer store, opened for reading."""
+
+    def __init__(self, path):
+        """
+        Constructor.
+
+        path - The store file written by compile_store.
+
+        * Raises IOError (or OSError) if the file cannot be read.
+        * Raises ValueError if the file is not a layer store of a supported
+          version.
+        """
+        self.path = path
+        with open(path, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < _HEADER.size:
+            raise ValueError("%s is not a layer store" % path)
+        magic, version, index_offset, index_length = _HEADER.unpack_from(
+            self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a layer store" % path)
+        if version != VERSION:
+            raise ValueError("%s is a version %d layer store; version %d "
+                             "is supported" % (path, version, VERSION))
+
+        index = json.loads(self._map[index_offset:index_offset +
+                                     index_length].decode('utf-8'))
+        self._entries = index['layers']
+        # realpath -> (mtime, size, digest)
+        self.paths = dict((path, tuple(known))
+                          for path, known in index['paths'].items())
+        try:
+            self._view = memoryview(self._map)
+        except TypeError:
+            # Python 2's mmap only has the old buffer interface
+            self._view = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, digest):
+        return digest in self._entries
+
+    def get(self, digest, size=None):
+        """
+        Returns a CachedLayer for the file contents with the given digest
+        (see LayerCache.digest), at the given (width, height) or at full
+        size, or None if the store does not hold it.
+        """
+        entry = self._entries.get(_entry_key(digest, size))
+        if entry is None:
+            return None
+
+        layer_size = tuple(entry['size'])
+        planes = {}
+        nbytes = 0
+        for name in _PLANES:
+            plane = entry.get(name)
+            if plane is None:
+                planes[name] = None
+                continue
+            mode, offset, length = str(plane[0]), plane[1], plane[2]
+            data = self._data(offset, length)
+            if mode in _MAPPABLE_MODES:
+                planes[name] = Image.frombuffer(mode, layer_size, data,
+                                                'raw', mode, 0, 1)
+            else:
+                # PIL keeps these modes in a layout of its own, so they
+                # have to be copied into private memory
+                planes[name] = Image.frombytes(mode, layer_size, bytes(data))
+                nbytes += length
+
+        bbox = entry['bbox']
+        return CachedLayer.from_planes(
+            planes['image'], planes['alpha'], planes['greyscale'], digest,
+            tuple(entry['alpha_extrema']), bbox and tuple(bbox), nbytes)
+
+    def _data(self, offset, length):
+        """Returns a zero-copy view of part of the store"""
+        if self._view is None:
+            return buffer(self._map, offset, length)
+        return self._view[offset:offset + length]
+
+    def verify(self):
+        """
+        Checks every plane against the checksum recorded for it, returning
+        the list of index keys of the layers that do not match.
+        """
+        bad = []
+        for key, entry in sorted(self._entries.items()):
+            for name in _PLANES:
+                plane = entry.get(name)
+                if plane is None:
+                    continue
+                mode, offset, length, crc = plane
+                data = bytes(self._data(offset, length))
+                if zlib.crc32(data) & 0xffffffff != crc:
+                    bad.append(key)
+                    break
+        return bad
+
+
+def _decode(path):
+    """Returns (digest, decoded image, file signature) for an image file"""
+    stat = os.stat(path)
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    image = Image.open(BytesIO(data))
+    image.load()
+    return (hashlib.sha1(data).hexdigest(), image,
+            (stat.st_mtime, stat.st_size))
+
+
+def compile_store(store_path, sources):
+    """
+    Decodes source images and writes them to a layer store, returning the
+    number of layers written.
+
+    sources - An iterable of (path, size) pairs, where size is None to store
+        the image at its own size, or the (width, height) it is rendered at
+        (see ImageGenerator.scale). Images with modes outside STORABLE_MODES
+        are skipped.
+
+    * Raises IOError (or OSError) if a file cannot be read or written.
+    """
+    by_path = {}
+    for path, size in sources:
+        by_path.setdefault(os.path.realpath(path), set()).add(
+            None if size is None else tuple(size))
+
+    directory = os.path.dirname(os.path.abspath(store_path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    entries = {}
+    paths = {}
+    try:
+        with os.fdopen(handle, 'wb') as fp:
+            fp.write(_HEADER.pack(MAGIC, VERSION, 0, 0))
+            for realpath in sorted(by_path):
+                digest, image, signature = _decode(realpath)
+                paths[realpath] = list(signature) + [digest]
+                if image.mode not in STORABLE_MODES:
+                    continue
+                full = CachedLayer(image, digest)
+                sizes = sorted(by_path[realpath],
+                               key=lambda size: size or (0, 0))
+                for size in sizes:
+                    key = _entry_key(digest, size)
+                    if key in entries:
+                        continue # Another path with the same contents
+                    layer = full
+                    if size is not None and size != full.size:
+                        layer = full.resize(size)
+                    entries[key] = _write_layer(fp, layer)
+
+            index = json.dumps({'layers': entries, 'paths': paths},
+                               sort_keys=True).encode('utf-8')
+            index_offset = fp.tell()
+            fp.write(index)
+            fp.seek(0)
+            fp.write(_HEADER.pack(MAGIC, VERSION, index_offset, len(index)))
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, store_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return len(entries)
+
+
+def _write_layer(fp, layer):
+    """Writes the planes of a CachedLayer to fp, returning its index entry"""
+    entry = {
+        'size': list(layer.size),
+        'alpha_extrema': list(layer.alpha_extrema),
+        'bbox': layer.bbox and list(layer.bbox),
+    }
+    for name in _PLANES:
+        image = getattr(layer, name)
+        if image is None:
+            entry[name] = None
+            continue
+        data = image.tobytes()
+        padding = -fp.tell() % _ALIGNMENT
+        fp.write(b'\0' * padding)
+        entry[name] = [image.mode, fp.tell(), len(data),
+                       zlib.crc32(data) & 0xffffffff]
+        fp.write(data)
+    return entry
+
+
+def job_sources(jobs, failures=None):
+    """
+    Returns the set of (path, size) pairs for compile_store needed to
+    render the build jobs (see the build module): the visible layers of
+    each generator, at each scale it is rendered at.
+
+    failures - (optional) A list to which a failed build.BuildResult is
+        appended for each task whose generator cannot be imported, or whose
+        layers cannot be worked out, instead of raising. The layers of the
+        other tasks are returned as usual.
+
+    * Raises ImportError if a generator cannot be imported, and ValueError if
+      a palette lacks a color its generator needs, unless a failures list
+      is given.
+    """
+    # Imported here, as the build module is only needed for compiling
+    from .build import BuildResult, expand_jobs
+
+    sources = set()
+    for task in expand_jobs(jobs, failures):
+        try:
+            generator = task.make_generator()
+            layers, sizes = generator._visible_layers()
+        except Exception:
+            if failures is None:
+                raise
+            failures.append(BuildResult(task, error=traceback.format_exc()))
+            continue
+        for layer, size in zip(layers, sizes):
+            sources.add((os.path.join(generator.source_path, layer.filename),
+                         generator._scaled_size(size)))
+    return sources
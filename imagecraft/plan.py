@@ -0,0 +1,197 @@
+"""
+Render plans: everything about a generator's layers that does not depend on
+the colours it is rendered with.
+
+An ImageGenerator subclass is compiled into a RenderPlan the first time it
+is used. The plan validates the `layers` definition once, and turns it into
+compact LayerSpec objects. Given a source path, the plan reads the header of
+each source file (without decoding any pixels) to check that the layers
+agree on their dimensions, to warn about layers that will hide everything
+beneath them, and to work out which layers can be seen at all: a layer
+without an alpha channel replaces everything below it, so the layers below
+the topmost such layer never need to be decoded or composited.
+
+The results of inspecting a source path are kept until one of its files
+changes on disk, and each warning is only given once.
+"""
+
+# Standard library
+import os
+import threading
+from warnings import warn
+
+# Third-party libraries
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        raise ImportError("Could not locate Python Imaging Library (PIL)")
+
+
+class LayerSpec(object):
+    """One entry of a generator's layers: a colour name and a file name."""
+
+    __slots__ = ('color_name', 'filename')
+
+    def __init__(self, color_name, filename):
+        self.color_name = color_name
+        self.filename = filename
+
+    def __repr__(self):
+        return 'LayerSpec(%r, %r)' % (self.color_name, self.filename)
+
+
+class Layer(object):
+    """A layer of a generator instance: a resolved colour (or None, for no
+    colorization) and a file name."""
+
+    __slots__ = ('color', 'filename')
+
+    def __init__(self, color, filename):
+        self.color = color
+        self.filename = filename
+
+    def __repr__(self):
+        return 'Layer(%r, %r)' % (self.color, self.filename)
+
+
+class SourceInfo(object):
+    """What the file headers of a plan's layers say, for one source path."""
+
+    __slots__ = ('signatures', 'sizes', 'modes', 'first_visible')
+
+    def __init__(self, signatures, sizes, modes, first_visible):
+        """
+        Constructor.
+
+        signatures - The (mtime, size) of each layer's file when read.
+
+        sizes, modes - The dimensions and PIL mode of each layer.
+
+        first_visible - The index of the lowest layer that can affect the
+            output.
+        """
+        self.signatures = signatures
+        self.sizes = sizes
+        self.modes = modes
+        self.first_visible = first_visible
+
+
+def has_alpha(mode):
+    """
+    Returns True if images of the given PIL mode are treated as having an
+    alpha channel (see layer_cache.CachedLayer).
+    """
+    return Image.getmodebands(mode) in (2, 4)
+
+
+class RenderPlan(object):
+    """
+    The compiled, colour-independent form of an ImageGenerator subclass's
+    layers. Plans are shared by every instance of the class and must not be
+    modified.
+    """
+
+    def __init__(self, layers):
+        """
+        Constructor.
+
+        layers - The `layers` definition of the generator class.
+
+        * Raises TypeError if each layer is not a dictionary-like object.
+        * Raises ValueError if each layer does not contain exactly one
+          key-value pair.
+        """
+        specs = []
+        for layer in layers:
+            if not hasattr(layer, 'items'):
+                raise TypeError("Each layer must be a dictionary-like object")
+            elif len(layer) != 1:
+                raise ValueError("Each layer must contain exactly one "
+                                 "color-to-image mapping")
+            color_name, filename = list(layer.items())[0]
+            specs.append(LayerSpec(color_name, filename))
+
+        self.source = layers
+        self.layers = tuple(specs)
+        self._lock = threading.Lock()
+        # source path -> SourceInfo
+        self._sources = {}
+
+    def inspect(self, source_path):
+        """
+        Returns the SourceInfo for this plan's layers in source_path,
+        reading file headers only if a file is new or has changed.
+
+        * Raises IOError (or OSError) if a file cannot be read.
+        """
+        paths = [os.path.join(source_path, spec.filename)
+                 for spec in self.layers]
+        signatures = []
+        for path in paths:
+            stat = os.stat(path)
+            signatures.append((stat.st_mtime, stat.st_size))
+        signatures = tuple(signatures)
+
+        with self._lock:
+            info = self._sources.get(source_path)
+        if info is not None and info.signatures == signatures:
+            return info
+
+        sizes = []
+        modes = []
+        for path in paths:
+            # Opening an image only reads its header
+            image = Image.open(path)
+            try:
+                sizes.append(image.size)
+                modes.append(image.mode)
+            finally:
+                if hasattr(image, 'close'):
+                    image.close()
+
+        first_visible = 0
+        for layeridx, mode in enumerate(modes):
+            if not has_alpha(mode):
+                first_visible = layeridx
+
+        info = SourceInfo(signatures, tuple(sizes), tuple(modes),
+                          first_visible)
+        self._warn(info)
+        with self._lock:
+            self._sources[source_path] = info
+        return info
+
+    def _warn(self, info):
+        """Warns about layer problems that are visible from the headers"""
+        for layeridx, spec in enumerate(self.layers):
+            if layeridx > 0 and not has_alpha(info.modes[layeridx]):
+                warn("Non-background layer `%s` has no alpha channel, "
+                     "which obscures all previous layers" % spec.filename)
+            if info.sizes[layeridx] != info.sizes[0]:
+                warn("Layer `%s` is %dx%d but layer `%s` is %dx%d" % (
+                    (spec.filename,) + info.sizes[layeridx] +
+                    (self.layers[0].filename,) + info.sizes[0]))
+
+
+_compile_lock = threading.Lock()
+
+
+def plan_for(generator_class):
+    """
+    Returns the RenderPlan of an ImageGenerator subclass, compiling it the
+    first time (or if the class's layers have been replaced since).
+    """
+    plan = generator_class.__dict__.get('_render_plan')
+    if plan is not None and plan.source is generator_class.layers:
+        return plan
+
+    with _compile_lock:
+        plan = generator_class.__dict__.get('_render_plan')
+        if plan is None or plan.source is not generator_class.layers:
+            plan = RenderPlan(generator_class.layers)
+            # Set on the class itself, never inherited by subclasses
+            generator_class._render_plan = plan
+    return plan
@@ -0,0 +1,90 @@
+"""
+Rendering on a pool of threads.
+
+Generators can be rendered from any number of threads at once (see
+ImageGenerator), and PIL and NumPy release the GIL for the heavy lifting:
+colorizing, pasting, resampling, blending, and PNG encoding and decoding. A
+RenderPool renders a batch of generators on a pool of threads and returns
+the results in order:
+
+    with RenderPool(workers=4) as pool:
+        images = pool.render_bytes([Button(palette) for palette in palettes])
+
+Threads share the process-wide layer cache, so unlike a process pool every
+source layer is decoded once for all of them. Python 2 needs the `futures`
+package.
+"""
+
+# Standard library
+import multiprocessing
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+
+class RenderPool(object):
+    """A pool of threads that render ImageGenerator instances."""
+
+    def __init__(self, workers=None):
+        """
+        Constructor.
+
+        workers - (optional) The number of threads. Defaults to the number
+            of processors.
+
+        * Raises ImportError if concurrent.futures is not available.
+        """
+        if ThreadPoolExecutor is None:
+            raise ImportError("RenderPool requires concurrent.futures; "
+                              "install the `futures` package")
+        self.workers = workers or multiprocessing.cpu_count()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self, wait=True):
+        """Shuts the threads down once the renders submitted so far finish."""
+        self._executor.shutdown(wait=wait)
+
+    def submit(self, generator, method='render_bytes', *args, **kwargs):
+        """
+        Calls a render method (render_bytes, render_image or render) of
+        `generator` on the pool with the given arguments, returning a
+        concurrent.futures.Future for its result.
+        """
+        return self._executor.submit(getattr(generator, method), *args,
+                                     **kwargs)
+
+    def map(self, generators, method='render_bytes', *args, **kwargs):
+        """
+        Calls a render method of every generator on the pool, as for submit,
+        and returns the list of results in the same order.
+
+        * Raises the first exception raised by a render, once every render
+          has finished.
+        """
+        futures = [self.submit(generator, method, *args, **kwargs)
+                   for generator in generators]
+        return [future.result() for future in futures]
+
+    def render_bytes(self, generators, image_format=None):
+        """Returns the encoded contents of each generator's image, in order."""
+        return self.map(generators, 'render_bytes', image_format)
+
+    def render_images(self, generators):
+        """Returns each generator's rendered PIL image, in order."""
+        return self.map(generators, 'render_image')
+
+    def render(self, generators, force=False):
+        """
+        Renders each generator to its output file, returning a list of
+        booleans stating which were written (see ImageGenerator.render).
+        """
+        return self.map(generators, 'render', force)
@@ -0,0 +1,127 @@
+"""
+A cache of partly composited layer stacks, for re-rendering quickly when only
+the colors of the upper layers change.
+
+A render composites its layers from the bottom up, and everything up to a
+given layer depends only on the source layers and the colors of the layers
+below it. When a generator has a prefix cache, the working state of a render
+is saved before each colorized layer, keyed by the layers of the stack and
+the colors used so far. A later render whose colors only differ from some
+layer upwards carries on from the longest saved prefix, so changing the
+color of the top layer composites just that layer.
+
+    ImageGenerator.prefix_cache = PrefixCache(max_bytes=64 * 1024 * 1024)
+
+This mostly helps interactive editors, which render the same graphic over
+and over with one color changed at a time. Saving the state costs a copy of
+the working image per colorized layer, so generators have no prefix cache
+unless one is set. Images rendered in strips (see max_render_bytes) do not
+use it.
+"""
+
+# Standard library
+import threading
+from collections import OrderedDict
+
+
+# Default upper bound on the memory held by a cache.
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class PrefixCache(object):
+    """
+    A size-bounded, least-recently-used cache of composited stack prefixes.
+
+    The hits and misses attributes count lookups that did (or did not) find
+    a prefix to resume from, and evictions counts dropped prefixes, since
+    the cache was created or last cleared.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Constructor.
+
+        max_bytes - (optional) The approximate upper bound on the memory used
+            by saved states. States larger than this are never saved.
+        """
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Drops every saved state and resets the counters."""
+        with self._lock:
+            # (stack key, colors of the layers below) -> (state, nbytes),
+            # least recently used first
+            self._states = OrderedDict()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Returns a dictionary of the cache counters."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'states': len(self._states),
+                'bytes': self.current_bytes,
+            }
+
+    def find(self, stack_key, colors):
+        """
+        Returns (count, state) for the longest saved prefix of a stack,
+        where count is the number of layers the state covers, or (0, None)
+        if there is none.
+
+        stack_key - A hashable value identifying the stack's source layers
+            (and how they are composited).
+
+        colors - The resolved color (or None) of every layer of the stack.
+        """
+        colors = tuple(colors)
+        with self._lock:
+            for count in range(len(colors) - 1, 0, -1):
+                key = (stack_key, colors[:count])
+                saved = self._states.pop(key, None)
+                if saved is not None:
+                    self._states[key] = saved
+                    self.hits += 1
+                    return count, saved[0]
+            self.misses += 1
+        return 0, None
+
+    def wants(self, stack_key, colors, nbytes):
+        """
+        Returns True if a state covering the layers with the given colors
+        is not saved yet and would fit, so is worth preparing for save().
+        """
+        with self._lock:
+            return nbytes <= self.max_bytes and \
+                (stack_key, tuple(colors)) not in self._states
+
+    def save(self, stack_key, colors, state, nbytes):
+        """
+        Saves the state after compositing the layers with the given colors.
+        The state must not be modified afterwards.
+
+        nbytes - The approximate memory held by the state.
+        """
+        key = (stack_key, tuple(colors))
+        with self._lock:
+            previous = self._states.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous[1]
+            self._states[key] = (state, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes and self._states:
+                unused, (state, nbytes) = self._states.popitem(last=False)
+                self.current_bytes -= nbytes
+                self.evictions += 1
+
+
+# The cache shared by previews (see ImageGenerator.render_preview). Preview
+# images are small, and so is the cache.
+preview_cache = PrefixCache(max_bytes=16 * 1024 * 1024)
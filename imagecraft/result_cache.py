@@ -0,0 +1,153 @@
+"""
+A cache of encoded render results, for serving the same images over and over.
+
+When a generator class has a result cache, render_bytes() keeps what it
+returns, keyed by the generator class, the colors resolved for its layers,
+the output format and the scale:
+
+    ImageGenerator.result_cache = ResultCache(max_bytes=32 * 1024 * 1024)
+
+Palettes that differ only in colors a generator does not use share results.
+Each result is stored with the fingerprint it was rendered from (see
+ImageGenerator.fingerprint) and is only returned while that still matches,
+so an edited source file is never served stale.
+
+Requests for a result that is being rendered already wait for that render
+instead of starting their own, so when a page full of images for a new
+palette is requested by dozens of clients at once, each image is only
+rendered once. If that render fails, every request waiting for it gets the
+same exception, and nothing is cached.
+"""
+
+# Standard library
+import threading
+from collections import OrderedDict
+
+
+# Default upper bound on the memory held by a cache.
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+
+class _Render(object):
+    """A render in progress, which other requests for it can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.data = None
+        self.error = None
+
+
+class ResultCache(object):
+    """
+    A size-bounded, least-recently-used cache of encoded images.
+
+    The hits and misses attributes count requests that did (or did not)
+    find a result, and coalesced counts misses that waited for a render
+    already in progress rather than rendering; evictions counts dropped
+    results. All count since the cache was created or last cleared.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Constructor.
+
+        max_bytes - (optional) The upper bound on the size of the results
+            held. Results larger than this are never kept.
+        """
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # (key, fingerprint) -> _Render, for renders in progress
+        self._renders = {}
+        self.clear()
+
+    def clear(self):
+        """Drops every result and resets the counters."""
+        with self._lock:
+            # key -> (fingerprint, data), least recently used first
+            self._results = OrderedDict()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.coalesced = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Returns a dictionary of the cache counters."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'results': len(self._results),
+                'bytes': self.current_bytes,
+            }
+
+    def render_bytes(self, generator, image_format=None):
+        """
+        Returns the encoded image for a generator instance, as for its
+        render_bytes method: from the cache, by waiting for the same render
+        in another thread, or by rendering it.
+
+        * Raises whatever the render raises.
+        """
+        image_format = image_format or generator.image_format
+        key = (type(generator),
+               tuple(layer.color for layer in generator.colors_for_layers),
+               image_format, generator.scale)
+        fingerprint = generator.fingerprint()
+
+        with self._lock:
+            saved = self._results.pop(key, None)
+            if saved is not None:
+                if saved[0] == fingerprint:
+                    self._results[key] = saved
+                    self.hits += 1
+                    return saved[1]
+                # Rendered from files that have changed since
+                self.current_bytes -= len(saved[1])
+
+            in_progress = self._renders.get((key, fingerprint))
+            if in_progress is None:
+                self.misses += 1
+                in_progress = self._renders[(key, fingerprint)] = _Render()
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            in_progress.done.wait()
+            if in_progress.error is not None:
+                raise in_progress.error
+            if in_progress.data is not None:
+                return in_progress.data
+            # The render was interrupted (by KeyboardInterrupt, say)
+            return generator._render_bytes(image_format)
+
+        try:
+            data = in_progress.data = generator._render_bytes(image_format)
+        except Exception as error:
+            in_progress.error = error
+            raise
+        finally:
+            with self._lock:
+                if in_progress.data is not None:
+                    self._save(key, fingerprint, in_progress.data)
+                del self._renders[(key, fingerprint)]
+            in_progress.done.set()
+        return data
+
+    def _save(self, key, fingerprint, data):
+        """Caches a result, evicting others as needed; call with the lock"""
+        if len(data) > self.max_bytes:
+            return
+        previous = self._results.pop(key, None)
+        if previous is not None:
+            self.current_bytes -= len(previous[1])
+        self._results[key] = (fingerprint, data)
+        self.current_bytes += len(data)
+        while self.current_bytes > self.max_bytes:
+            unused, (fingerprint, data) = self._results.popitem(last=False)
+            self.current_bytes -= len(data)
+            self.evictions += 1
@@ -0,0 +1,204 @@
+"""
+Sprite sheets: several generated images packed into one.
+
+A page that shows a dozen small generated images (buttons, gradients,
+icons) would otherwise fetch and decode a dozen files. A SpriteSheet renders
+a set of generators for one palette, packs the results into a single atlas
+image and records where each one ended up, as JSON or as CSS rules:
+
+    sheet = SpriteSheet.render([Button, Tab, Star], acme_colors)
+    sheet.save('/srv/skins/acme.png', 'PNG')
+    css = sheet.to_css('/skins/acme.png')
+
+Sprites are packed onto shelves, tallest first, into an atlas roughly as
+wide as it is high.
+"""
+
+# Standard library
+import json
+import math
+import re
+
+# Third-party libraries
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        raise ImportError("Could not locate Python Imaging Library (PIL)")
+
+
+def pack(sizes, padding=0, max_width=None):
+    """
+    Works out where to place rectangles of the given (width, height) sizes
+    so that none overlap. Returns ((atlas width, atlas height), positions),
+    where positions holds the (x, y) of each rectangle, in the order given.
+
+    Rectangles are sorted by height and placed on horizontal shelves, each
+    going on the first shelf with enough room left (first-fit decreasing
+    height).
+
+    padding - (optional) Pixels of space kept between rectangles.
+
+    max_width - (optional) The widest the atlas may be. Defaults to about
+        the square root of the total area, or the widest rectangle if that
+        is wider.
+
+    * Raises ValueError if a rectangle is wider than max_width.
+    """
+    if not sizes:
+        return (0, 0), []
+
+    widest = max(width for width, height in sizes)
+    if max_width is None:
+        area = sum((width + padding) * (height + padding)
+                   for width, height in sizes)
+        max_width = max(widest, int(math.ceil(math.sqrt(area))))
+    elif widest > max_width:
+        raise ValueError("A %dpx wide sprite does not fit in %dpx"
+                         % (widest, max_width))
+
+    order = sorted(range(len(sizes)),
+                   key=lambda index: (-sizes[index][1], -sizes[index][0]))
+    positions = [None] * len(sizes)
+    shelves = [] # [y, height, x of the free space]
+    atlas_width = atlas_height = 0
+
+    for index in order:
+        width, height = sizes[index]
+        for shelf in shelves:
+            if shelf[2] + width <= max_width:
+                break
+        else:
+            top = atlas_height + padding if shelves else 0
+            shelf = [top, height, 0]
+            shelves.append(shelf)
+            atlas_height = top + height
+
+        positions[index] = (shelf[2], shelf[0])
+        atlas_width = max(atlas_width, shelf[2] + width)
+        shelf[2] += width + padding
+
+    return (atlas_width, atlas_height), positions
+
+
+class SpriteSheet(object):
+    """
+    An atlas image along with the box each sprite occupies in it.
+
+    The sprites attribute maps each sprite's name to its (x, y, width,
+    height), in the order the sprites were given.
+    """
+
+    def __init__(self, image, sprites):
+        """
+        Constructor.
+
+        image - The PIL image holding every sprite.
+
+        sprites - A list of (name, (x, y, width, height)) pairs.
+        """
+        self.image = image
+        self.sprites = sprites
+
+    @classmethod
+    def render(cls, generators, color_dict, source_path=None, padding=1,
+               max_width=None):
+        """
+        Renders each generator with `color_dict` and packs the results into
+        a new SpriteSheet.
+
+        generators - A sequence of ImageGenerator subclasses, each named
+            after its class, or a sequence of (name, subclass) pairs.
+
+        source_path - (optional) Passed through to the generators.
+
+        padding - (optional) Transparent pixels kept between sprites, so
+            that scaled or filtered backgrounds do not bleed into each other.
+
+        max_width - (optional) As for pack().
+
+        * Raises the same errors as the generators for invalid palettes.
+        """
+        images = []
+        for generator in generators:
+            if isinstance(generator, tuple):
+                name, generator = generator
+            else:
+                name = generator.__name__
+            image = generator(color_dict, source_path=source_path)\
+                .render_image()
+            images.append((name, image))
+        return cls.from_images(images, padding, max_width)
+
+    @classmethod
+    def from_images(cls, images, padding=1, max_width=None):
+        """
+        Packs a sequence of (name, PIL image) pairs into a new SpriteSheet.
+        Takes the same padding and max_width arguments as render.
+        """
+        names = [name for name, image in images]
+        if len(set(names)) != len(names):
+            raise ValueError("Sprite names must be unique")
+
+        size, positions = pack([image.size for name, image in images],
+                               padding, max_width)
+        atlas = Image.new("RGBA", size, (0, 0, 0, 0))
+        sprites = []
+        for (name, image), position in zip(images, positions):
+            if image.mode != "RGBA":
+                image = image.convert("RGBA")
+            # Without a mask the pixels (alpha included) are copied as-is
+            atlas.paste(image, position)
+            sprites.append((name, position + image.size))
+        return cls(atlas, sprites)
+
+    def save(self, fp, image_format=None):
+        """Saves the atlas image to fp, a filename or file-like object."""
+        self.image.save(fp, image_format)
+
+    def coordinates(self):
+        """
+        Returns the coordinate map as a dictionary, ready to be serialized:
+        the atlas size and each sprite's x, y, width and height.
+        """
+        width, height = self.image.size
+        return {
+            'width': width,
+            'height': height,
+            'sprites': dict((name, {'x': x, 'y': y, 'width': w, 'height': h})
+                            for name, (x, y, w, h) in self.sprites),
+        }
+
+    def to_json(self, **kwargs):
+        """Returns the coordinate map as JSON; kwargs go to json.dumps."""
+        kwargs.setdefault('sort_keys', True)
+        return json.dumps(self.coordinates(), **kwargs)
+
+    def to_css(self, image_url, prefix='sprite'):
+        """
+        Returns CSS with one rule per sprite, selected by the class
+        "<prefix>-<sprite name>", which shows the sprite as the element's
+        background.
+
+        image_url - The URL the atlas image is served from.
+        """
+        rules = []
+        for name, (x, y, width, height) in self.sprites:
+            rules.append(
+                '.%s-%s { background: url("%s") no-repeat %s %s; '
+                'width: %dpx; height: %dpx; }'
+                % (_css_class(prefix), _css_class(name), image_url,
+                   _css_offset(x), _css_offset(y), width, height))
+        return '\n'.join(rules) + '\n'
+
+
+def _css_class(name):
+    """Returns name with anything not allowed in a CSS class replaced"""
+    return re.sub(r'[^A-Za-z0-9_-]', '-', name)
+
+
+def _css_offset(pixels):
+    """Returns the background-position offset for a sprite coordinate"""
+    return '-%dpx' % pixels if pixels else '0'
@@ -0,0 +1,354 @@
+"""
+Strip-by-strip rendering for images too large to composite in one go.
+
+Every step of compositing works on each pixel independently, so an image
+can be rendered as a series of horizontal strips that are identical to the
+corresponding rows of a full-frame render. A TiledImage produces those strips
+on demand; saving it as PNG streams each strip into the encoder as soon as it
+is composited, so the full-size result never has to exist in memory. A
+PNGReader does the same for the source images, decoding just the rows of the
+strip being rendered.
+"""
+
+# Standard library
+import struct
+import zlib
+from io import BytesIO
+
+# Third-party libraries
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        raise ImportError("Could not locate Python Imaging Library (PIL)")
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class PNGWriter(object):
+    """
+    Writes an 8-bit PNG incrementally, a strip of rows at a time.
+
+    Usage:
+
+        writer = PNGWriter(fp, (width, height), 'RGBA')
+        for strip in strips:
+            writer.write(strip)
+        writer.close()
+
+    Rows are written with the PNG "Up" filter when NumPy is available, which
+    suits gradients well, and unfiltered otherwise.
+    """
+
+    COLOR_TYPES = {'L': 0, 'RGB': 2, 'LA': 4, 'RGBA': 6}
+    SIGNATURE = b'\x89PNG\r\n\x1a\n'
+    # IDAT data is flushed to fp in chunks of at least this size
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, fp, size, mode, compress_level=6):
+        """
+        Constructor.
+
+        fp - A writable binary file-like object.
+
+        size - The (width, height) of the whole image.
+
+        mode - The PIL mode of the strips; one of L, LA, RGB or RGBA.
+
+        compress_level - (optional) The zlib compression level, 0-9.
+
+        * Raises ValueError if the mode cannot be written.
+        """
+        if mode not in self.COLOR_TYPES:
+            raise ValueError("Cannot stream images of mode %s" % mode)
+
+        self.fp = fp
+        self.size = size
+        self.mode = mode
+        self._stride = size[0] * len(mode)
+        self._compressor = zlib.compressobj(compress_level)
+        self._pending = []
+        self._pending_bytes = 0
+        self._previous = None
+
+        fp.write(self.SIGNATURE)
+        self._write_chunk(b'IHDR', struct.pack(
+            '>IIBBBBB', size[0], size[1], 8, self.COLOR_TYPES[mode], 0, 0, 0))
+
+    def write(self, strip):
+        """Appends the rows of a PIL image strip to the PNG."""
+        if strip.mode != self.mode or strip.size[0] != self.size[0]:
+            raise ValueError("Strip does not match the image being written")
+
+        if numpy is not None:
+            rows = numpy.frombuffer(strip.tobytes(), dtype=numpy.uint8)
+            rows = rows.reshape(strip.size[1], self._stride)
+            previous = self._previous
+            if previous is None:
+                previous = numpy.zeros((1, self._stride), dtype=numpy.uint8)
+            filtered = numpy.empty((rows.shape[0], self._stride + 1),
+                                   dtype=numpy.uint8)
+            filtered[:, 0] = 2 # "Up" filter; uint8 arithmetic wraps mod 256
+            filtered[0, 1:] = rows[0] - previous[-1]
+            filtered[1:, 1:] = rows[1:] - rows[:-1]
+            self._previous = rows[-1:].copy()
+            data = filtered.tobytes()
+        else:
+            raw = strip.tobytes()
+            data = b''.join(b'\x00' + raw[offset:offset + self._stride]
+                            for offset in range(0, len(raw), self._stride))
+
+        self._queue(self._compressor.compress(data))
+
+    def close(self):
+        """Finishes the PNG. Does not close fp."""
+        self._queue(self._compressor.flush())
+        self._flush()
+        self._write_chunk(b'IEND', b'')
+
+    def _queue(self, data):
+        """Buffers compressed data, writing IDAT chunks as they fill up"""
+        if data:
+            self._pending.append(data)
+            self._pending_bytes += len(data)
+        if self._pending_bytes >= self.CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        """Writes any buffered compressed data out as an IDAT chunk"""
+        if self._pending:
+            self._write_chunk(b'IDAT', b''.join(self._pending))
+            self._pending = []
+            self._pending_bytes = 0
+
+    def _write_chunk(self, tag, data):
+        """Writes a single PNG chunk"""
+        self.fp.write(_chunk(tag, data))
+
+
+class PNGReader(object):
+    """
+    Reads a PNG from a file incrementally, a strip of rows at a time.
+
+    Usage:
+
+        with PNGReader('/path/to/layer.png') as reader:
+            while reader.row < reader.size[1]:
+                strip = reader.read(64)
+
+    Only the compressed data being worked through and the rows of the strip
+    are held in memory. PIL still does the decoding: each strip is handed to
+    it as a small uncompressed PNG of its own, headed by the last row of the
+    strip before so that rows filtered against the row above come out the
+    same. Each strip is therefore identical to the same rows of the whole
+    image decoded by PIL.
+
+    Only 8-bit, non-interlaced images can be read.
+    """
+
+    # PNG color type -> bytes per pixel
+    CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+    # Compressed data is read from the file this many bytes at a time
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        """
+        Constructor.
+
+        path - The path of the PNG file.
+
+        * Raises IOError (or OSError) if the file cannot be read.
+        * Raises ValueError if it is not a PNG that can be read in strips.
+        """
+        self.path = path
+        # The index of the next row to be read
+        self.row = 0
+        self._inflater = zlib.decompressobj()
+        self._idat_left = 0
+        self._unused = b''
+        self.fp = open(path, 'rb')
+        try:
+            self._read_header()
+        except Exception:
+            self.fp.close()
+            raise
+        self._previous = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        """Closes the file."""
+        self.fp.close()
+
+    def _read_header(self):
+        """Reads the chunks before the image data, keeping those PIL needs"""
+        if self.fp.read(8) != PNGWriter.SIGNATURE:
+            raise ValueError("%s is not a PNG file" % self.path)
+        self._chunks = []
+        while True:
+            tag, data = self._read_chunk_header()
+            if tag == b'IDAT':
+                self._idat_left = data
+                break
+            if tag == b'IEND':
+                raise ValueError("%s has no image data" % self.path)
+            data = self.fp.read(data)
+            self.fp.read(4) # CRC
+            if tag == b'IHDR':
+                width, height, depth, color_type, compression, filters, \
+                    interlace = struct.unpack('>IIBBBBB', data)
+                if depth != 8 or interlace or \
+                        color_type not in self.CHANNELS:
+                    raise ValueError("Cannot read %s in strips" % self.path)
+                self.size = (width, height)
+                self._ihdr = data
+                # The number of bytes in each (unfiltered) row
+                self.stride = width * self.CHANNELS[color_type]
+            else:
+                self._chunks.append(_chunk(tag, data))
+
+    def _read_chunk_header(self):
+        """Returns the (tag, length) of the next chunk"""
+        header = self.fp.read(8)
+        if len(header) < 8:
+            raise ValueError("%s is truncated" % self.path)
+        length, tag = struct.unpack('>I4s', header)
+        return tag, length
+
+    def _read_idat(self):
+        """Returns the next piece of compressed image data"""
+        while not self._idat_left:
+            self.fp.read(4) # CRC of the previous chunk
+            tag, length = self._read_chunk_header()
+            if tag != b'IDAT':
+                raise ValueError("%s is truncated" % self.path)
+            self._idat_left = length
+        data = self.fp.read(min(self._idat_left, self.READ_SIZE))
+        if not data:
+            raise ValueError("%s is truncated" % self.path)
+        self._idat_left -= len(data)
+        return data
+
+    def read(self, rows):
+        """
+        Returns the next `rows` rows of the image (or as many as are left)
+        as a PIL image.
+
+        * Raises ValueError if the file is truncated or corrupt.
+        """
+        width, height = self.size
+        rows = min(rows, height - self.row)
+        if rows < 1:
+            raise ValueError("Every row of %s has been read" % self.path)
+        needed = rows * (self.stride + 1)
+        pieces = []
+        have = 0
+        while have < needed:
+            data = self._unused or self._read_idat()
+            piece = self._inflater.decompress(data, needed - have)
+            self._unused = self._inflater.unconsumed_tail
+            pieces.append(piece)
+            have += len(piece)
+        data = b''.join(pieces)
+
+        if self._previous is not None:
+            # Filter type 0 leaves the row as it is
+            data = b'\x00' + self._previous + data
+        png = b''.join([
+            PNGWriter.SIGNATURE,
+            _chunk(b'IHDR', struct.pack('>I', width) +
+                   struct.pack('>I', len(data) // (self.stride + 1)) +
+                   self._ihdr[8:]),
+        ] + self._chunks + [
+            _chunk(b'IDAT', zlib.compress(data, 0)),
+            _chunk(b'IEND', b''),
+        ])
+        image = Image.open(BytesIO(png))
+        image.load()
+        if self._previous is not None:
+            image = image.crop((0, 1, width, rows + 1))
+        self._previous = image.crop((0, rows - 1, width, rows)).tobytes()
+        self.row += rows
+        return image
+
+
+def _chunk(tag, data):
+    """Returns a PNG chunk as bytes"""
+    return b''.join([struct.pack('>I', len(data)), tag, data,
+                     struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)])
+
+
+class TiledImage(object):
+    """
+    An image that is rendered in horizontal strips, on demand.
+
+    It stands in for a PIL image wherever a rendered image is only going to
+    be saved: save() streams PNG output strip by strip, and assembles the
+    full image first for any other format.
+    """
+
+    def __init__(self, size, strip_height, render_strip):
+        """
+        Constructor.
+
+        size - The (width, height) of the whole image.
+
+        strip_height - The number of rows rendered at a time.
+
+        render_strip - A callable taking a (left, upper, right, lower) box
+            and returning the PIL image for that part of the output.
+        """
+        self.size = size
+        self.strip_height = max(1, strip_height)
+        self._render_strip = render_strip
+
+    def strips(self):
+        """Yields the rendered strips of the image, top to bottom."""
+        width, height = self.size
+        for top in range(0, height, self.strip_height):
+            bottom = min(top + self.strip_height, height)
+            yield self._render_strip((0, top, width, bottom))
+
+    def assemble(self):
+        """Renders every strip and returns the full PIL image."""
+        image = None
+        top = 0
+        for strip in self.strips():
+            if image is None:
+                image = Image.new(strip.mode, self.size)
+            image.paste(strip, (0, top))
+            top += strip.size[1]
+        return image
+
+    def save(self, fp, format=None, **options):
+        """
+        Saves the image to fp, a filename or writable binary file-like
+        object, in the given format. Options are passed on to PIL, except
+        for PNG, where only compress_level is used.
+        """
+        if (format or '').upper() != 'PNG':
+            self.assemble().save(fp, format, **options)
+            return
+
+        if not hasattr(fp, 'write'):
+            with open(fp, 'wb') as fileobj:
+                self.save(fileobj, format, **options)
+            return
+
+        compress_level = options.get('compress_level', 6)
+        writer = None
+        for strip in self.strips():
+            if writer is None:
+                writer = PNGWriter(fp, self.size, strip.mode, compress_level)
+            writer.write(strip)
+        writer.close()
@@ -0,0 +1,348 @@
+"""
+Re-renders outputs as their source images change, for theme development.
+
+    imagecraft watch jobs.json
+
+The jobs are expanded into BuildTasks as for a build, and a DependencyIndex
+maps each source file to the tasks whose generators use it (through their
+layers). After bringing every output up to date, the Watcher waits for
+source files to change and re-renders only the outputs that depend on them.
+Editors tend to save in bursts (a temporary file, a rename, a metadata
+update), so changes are collected until none has arrived for a short while
+before anything is rendered.
+
+On Linux, changes are picked up through inotify; elsewhere (or if inotify
+cannot be used) the source files are polled.
+
+    watcher = Watcher(jobs)
+    for result in watcher.build():
+        print(result)
+    while True:
+        for result in watcher.rebuild(watcher.wait()):
+            print(result)
+"""
+
+# Standard library
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# This module
+from .build import build_tasks, expand_jobs
+from .plan import plan_for
+
+
+def source_files(task):
+    """
+    Returns the absolute paths of the source files used by a BuildTask's
+    generator.
+    """
+    generator = task.generator
+    source_path = task.source_path or generator._default_source_path
+    return [os.path.abspath(os.path.join(source_path, spec.filename))
+            for spec in plan_for(generator).layers]
+
+
+class DependencyIndex(object):
+    """A reverse index from source files to the BuildTasks that use them."""
+
+    def __init__(self, tasks):
+        """
+        Constructor.
+
+        tasks - The BuildTasks to index.
+        """
+        self.tasks = list(tasks)
+        self._dependents = {}
+        for taskidx, task in enumerate(self.tasks):
+            for path in source_files(task):
+                dependents = self._dependents.setdefault(path, [])
+                if not dependents or dependents[-1] != taskidx:
+                    dependents.append(taskidx)
+
+    @property
+    def paths(self):
+        """The sorted list of every source file used by the tasks"""
+        return sorted(self._dependents)
+
+    def dependents(self, paths):
+        """
+        Returns the tasks using any of the given source files, in the order
+        they were indexed and without duplicates.
+        """
+        found = set()
+        for path in paths:
+            found.update(self._dependents.get(os.path.abspath(path), ()))
+        return [self.tasks[taskidx] for taskidx in sorted(found)]
+
+
+def _signature(path):
+    """Returns the (mtime, size) of a file, or None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+class PollingMonitor(object):
+    """Notices changes to a set of files by checking them periodically."""
+
+    def __init__(self, paths, interval=0.5):
+        """
+        Constructor.
+
+        paths - The files to watch. They need not exist yet.
+
+        interval - (optional) Seconds between checks.
+        """
+        self.interval = interval
+        self._signatures = dict((path, _signature(path)) for path in paths)
+
+    def wait(self, timeout=None):
+        """
+        Returns the set of watched files that have been modified, created or
+        removed, waiting until there is at least one. Returns an empty set
+        if `timeout` seconds pass first.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            changed = set()
+            for path, signature in self._signatures.items():
+                current = _signature(path)
+                if current != signature:
+                    self._signatures[path] = current
+                    changed.add(path)
+            if changed:
+                return changed
+
+            delay = self.interval
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return changed
+                delay = min(delay, remaining)
+            time.sleep(delay)
+
+    def close(self):
+        """Stops watching."""
+        pass
+
+
+# inotify constants, from <sys/inotify.h>
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_DELETE = 0x00000200
+_IN_CLOEXEC = 0o2000000
+_IN_EVENT = struct.Struct('iIII')
+
+_libc = None
+
+
+def _inotify_libc():
+    """Returns the C library if it provides inotify, otherwise None"""
+    global _libc
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                   use_errno=True)
+            except OSError:
+                libc = None
+            if libc is not None and hasattr(libc, 'inotify_init1'):
+                _libc = libc
+    return _libc or None
+
+
+class InotifyMonitor(object):
+    """
+    Notices changes to a set of files through Linux's inotify. The
+    directories holding the files are watched, rather than the files
+    themselves, so that files replaced by a rename are still followed.
+    """
+
+    # Writes finish with IN_CLOSE_WRITE, but some programs update a file in
+    # place without closing it, hence IN_MODIFY too.
+    mask = (_IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO |
+            _IN_DELETE)
+
+    def __init__(self, paths):
+        """
+        Constructor.
+
+        paths - The files to watch. Their directories must exist.
+
+        * Raises OSError if inotify is unavailable or a directory cannot be
+          watched.
+        """
+        libc = _inotify_libc()
+        if libc is None:
+            raise OSError("inotify is not available on this system")
+        self._libc = libc
+        self._paths = set(paths)
+        self._fd = libc.inotify_init1(_IN_CLOEXEC)
+        if self._fd < 0:
+            raise _errno_error("inotify_init1")
+
+        self._directories = {}
+        try:
+            for directory in sorted(set(os.path.dirname(path)
+                                        for path in self._paths)):
+                encoded = directory
+                if not isinstance(encoded, bytes):
+                    encoded = encoded.encode(sys.getfilesystemencoding())
+                wd = libc.inotify_add_watch(self._fd, encoded, self.mask)
+                if wd < 0:
+                    raise _errno_error(directory)
+                self._directories[wd] = directory
+        except Exception:
+            self.close()
+            raise
+
+    def wait(self, timeout=None):
+        """As for PollingMonitor.wait."""
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            remaining = None
+            if timeout is not None:
+                remaining = max(0, deadline - time.time())
+            ready = select.select([self._fd], [], [], remaining)[0]
+            if not ready:
+                return set()
+            changed = self._read_events()
+            if changed:
+                return changed
+
+    def _read_events(self):
+        """Reads the pending events, returning the watched files named"""
+        data = os.read(self._fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _IN_EVENT.unpack_from(data, offset)
+            offset += _IN_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if not isinstance(name, str):
+                name = name.decode(sys.getfilesystemencoding())
+            directory = self._directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if path in self._paths:
+                changed.add(path)
+        return changed
+
+    def close(self):
+        """Stops watching."""
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def _errno_error(what):
+    """Returns an OSError for the errno left by a failed C library call"""
+    code = ctypes.get_errno()
+    return OSError(code, os.strerror(code), what)
+
+
+def open_monitor(paths, method='auto', interval=0.5):
+    """
+    Returns a monitor for a set of files.
+
+    method - (optional) 'inotify', 'poll', or 'auto' for inotify where it
+        works and polling otherwise.
+
+    interval - (optional) Seconds between checks when polling.
+
+    * Raises ValueError if the method is unknown.
+    * Raises OSError if the method is 'inotify' and it cannot be used.
+    """
+    if method not in ('auto', 'inotify', 'poll'):
+        raise ValueError("Unknown watch method %r" % (method,))
+    if method != 'poll':
+        try:
+            return InotifyMonitor(paths)
+        except OSError:
+            if method == 'inotify':
+                raise
+    return PollingMonitor(paths, interval)
+
+
+class Watcher(object):
+    """Keeps the outputs of a set of build jobs up to date."""
+
+    def __init__(self, jobs, workers=1, chunksize=8, debounce=0.2,
+                 method='auto', interval=0.5):
+        """
+        Constructor.
+
+        jobs - The build jobs (see the build module).
+
+        workers, chunksize - (optional) As for build.build. A single worker
+            keeps the decoded layers that did not change in this process's
+            layer cache, so re-renders only decode what was edited.
+
+        debounce - (optional) Seconds without further changes to wait for
+            before re-rendering.
+
+        method, interval - (optional) As for open_monitor.
+
+        As with build.build, a generator that cannot be imported does not
+        stop the others being watched: a failed BuildResult for each of its
+        tasks is kept in the failures attribute and yielded by build().
+        """
+        self.workers = workers
+        self.chunksize = chunksize
+        self.debounce = debounce
+        self.failures = []
+        self.index = DependencyIndex(expand_jobs(jobs, self.failures))
+        self.monitor = open_monitor(self.index.paths, method, interval)
+
+    def build(self, force=False):
+        """
+        Renders every output that is out of date (or every output, if
+        force is True), yielding BuildResults, including those for tasks
+        whose generators could not be imported.
+        """
+        for result in self.failures:
+            yield result
+        for result in build_tasks(self.index.tasks, self.workers,
+                                  self.chunksize, force):
+            yield result
+
+    def wait(self, timeout=None):
+        """
+        Waits for source files to change, returning the set of changed
+        paths once `debounce` seconds pass without another change. Returns
+        an empty set if nothing changes within `timeout` seconds.
+        """
+        changed = self.monitor.wait(timeout)
+        while changed:
+            more = self.monitor.wait(self.debounce)
+            if not more:
+                break
+            changed |= more
+        return changed
+
+    def rebuild(self, paths):
+        """
+        Renders the outputs that depend on the given source files, yielding
+        BuildResults. Outputs whose inputs turn out not to have changed
+        (a file saved without edits, say) are skipped as usual.
+        """
+        return build_tasks(self.index.dependents(paths), self.workers,
+                           self.chunksize)
+
+    def close(self):
+        """Stops watching."""
+        self.monitor.close()
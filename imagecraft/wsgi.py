@@ -0,0 +1,297 @@
+"""
+A WSGI application that renders images on demand, for serving skins
+"just in time" straight from a web application.
+
+    app = SkinServer([Button, Tab], palettes=[acme_colors, globex_colors])
+
+    # In a template:
+    url = app.url_for(Button, acme_colors) # "/Button/3f9a0c21d4e8b7a6.png"
+
+Requests take the form /<generator>/<palette hash>.<extension>, where the
+palette hash is palette_hash() of a registered color dictionary and the
+extension names the output format: the generator's own image_format unless
+the application was given a list of formats to allow. Other pixel densities
+are requested by adding a suffix to the hash, as in
+/<generator>/<palette hash>@2x.png.
+Images are rendered in memory and never touch the disk. A render that fails
+gets a 500 Internal Server Error, with the traceback written to wsgi.errors.
+
+Every response carries a strong ETag derived from the generator's
+fingerprint (its layers, colors, source file contents and format), along
+with a Cache-Control header. A request whose If-None-Match matches gets a
+304 Not Modified, which only costs checking the source files, not a render.
+Setting ImageGenerator.result_cache (see imagecraft.result_cache) also saves
+rendering an image again for every client that asks for it, and renders it
+just once when many ask at the same time.
+"""
+
+# Standard library
+import hashlib
+import json
+import sys
+import traceback
+
+# Third-party libraries
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        raise ImportError("Could not locate Python Imaging Library (PIL)")
+
+
+STATUS_LINES = {
+    200: '200 OK',
+    304: '304 Not Modified',
+    404: '404 Not Found',
+    405: '405 Method Not Allowed',
+    500: '500 Internal Server Error',
+}
+
+
+def palette_hash(color_dict):
+    """
+    Returns the short hash identifying a color dictionary in URLs. Equal
+    dictionaries always have the same hash, whatever their key order.
+    """
+    data = json.dumps(color_dict, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+
+class SkinServer(object):
+    """
+    A WSGI application serving the images of a set of ImageGenerator
+    subclasses, rendered with a set of palettes.
+    """
+
+    def __init__(self, generators, palettes=(), source_path=None,
+                 max_age=3600, palette_lookup=None, scales=(1, 2, 3),
+                 formats=None):
+        """
+        Constructor.
+
+        generators - The ImageGenerator subclasses to serve, either as a
+            sequence (each is served under its class name) or as a
+            dictionary of URL names to classes.
+
+        palettes - (optional) The color dictionaries that may be requested.
+            More can be added later with add_palette.
+
+        source_path - (optional) Passed through to the generators.
+
+        max_age - (optional) The number of seconds clients and caches may
+            reuse a response without revalidating it.
+
+        palette_lookup - (optional) A callable taking a palette hash and
+            returning its color dictionary, or None if it is unknown; it is
+            consulted for hashes that were not registered with add_palette.
+
+        scales - (optional) The pixel densities that may be requested.
+
+        formats - (optional) The PIL format names (such as "PNG" and "WEBP")
+            that may be requested for any generator. By default each
+            generator is only served in its own image_format.
+        """
+        if hasattr(generators, 'items'):
+            self.generators = dict(generators)
+        else:
+            self.generators = dict((generator.__name__, generator)
+                                   for generator in generators)
+        self.palettes = {}
+        for palette in palettes:
+            self.add_palette(palette)
+        self.source_path = source_path
+        self.max_age = max_age
+        self.palette_lookup = palette_lookup
+        self.scales = scales
+        self.formats = formats
+
+    def add_palette(self, color_dict):
+        """Registers a color dictionary and returns its palette hash."""
+        key = palette_hash(color_dict)
+        self.palettes[key] = color_dict
+        return key
+
+    def url_for(self, generator, color_dict, extension=None, scale=1):
+        """
+        Returns the path (relative to where the application is mounted) of
+        the image for a generator class and color dictionary, registering
+        the palette if necessary.
+
+        extension - (optional) The file extension; defaults to the one for
+            the generator's image_format.
+
+        scale - (optional) The pixel density of the image.
+
+        * Raises ValueError if the generator is not served by this
+          application, or not in the format of the extension.
+        """
+        for name, candidate in self.generators.items():
+            if candidate is generator:
+                break
+        else:
+            raise ValueError("%s is not served by this application"
+                             % generator.__name__)
+
+        if extension is None:
+            extension = _extension_for(generator.image_format)
+        elif _format_for(extension) not in self._formats_for(generator):
+            raise ValueError("%s is not served as .%s"
+                             % (generator.__name__, extension))
+        key = self.add_palette(color_dict)
+        if scale != 1:
+            key += '@%sx' % _format_scale(scale)
+        return '/%s/%s.%s' % (name, key, extension)
+
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        if method not in ('GET', 'HEAD'):
+            return self._respond(start_response, 405, b'Method not allowed',
+                                 [('Allow', 'GET, HEAD')])
+
+        generator = self._resolve(environ.get('PATH_INFO', ''))
+        if generator is None:
+            return self._respond(start_response, 404, b'Not found')
+
+        try:
+            etag = '"%s"' % generator.fingerprint()
+        except Exception:
+            return self._failed(environ, start_response)
+        headers = [
+            ('ETag', etag),
+            ('Cache-Control', 'public, max-age=%d' % self.max_age),
+        ]
+        if _etag_matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+            return self._respond(start_response, 304, b'', headers)
+
+        try:
+            body = generator.render_bytes()
+        except Exception:
+            return self._failed(environ, start_response)
+        headers.append(('Content-Type',
+                        Image.MIME.get(generator.image_format,
+                                       'application/octet-stream')))
+        if method == 'HEAD':
+            return self._respond(start_response, 200, b'', headers,
+                                 content_length=len(body))
+        return self._respond(start_response, 200, body, headers)
+
+    def _resolve(self, path):
+        """
+        Returns a generator instance for the request path, or None if it
+        does not name a known generator, palette and format.
+        """
+        parts = path.strip('/').split('/')
+        if len(parts) != 2:
+            return None
+        name, filename = parts
+        key, dot, extension = filename.rpartition('.')
+        key, at, density = key.partition('@')
+        scale = _parse_scale(density) if at else 1
+        if scale not in self.scales:
+            return None
+
+        generator_class = self.generators.get(name)
+        if generator_class is None or not key:
+            return None
+        image_format = _format_for(extension)
+        if image_format not in self._formats_for(generator_class):
+            return None
+
+        color_dict = self.palettes.get(key)
+        if color_dict is None and self.palette_lookup is not None:
+            color_dict = self.palette_lookup(key)
+        if color_dict is None:
+            return None
+
+        try:
+            generator = generator_class(color_dict,
+                                        source_path=self.source_path,
+                                        scale=scale)
+        except (KeyError, ValueError):
+            # The palette lacks a color this generator needs
+            return None
+        # The format comes from the URL; it also feeds the fingerprint
+        generator.image_format = image_format
+        return generator
+
+    def _formats_for(self, generator_class):
+        """Returns the PIL format names a generator class is served in"""
+        if self.formats is not None:
+            return self.formats
+        return (generator_class.image_format,)
+
+    def _failed(self, environ, start_response):
+        """Logs the exception being handled and responds with a 500"""
+        traceback.print_exc(file=environ.get('wsgi.errors', sys.stderr))
+        return self._respond(start_response, 500, b'Internal server error')
+
+    def _respond(self, start_response, status, body, headers=(),
+                 content_length=None):
+        """Starts the response and returns the body iterable"""
+        headers = list(headers)
+        if status != 304:
+            if content_length is None:
+                content_length = len(body)
+            if not any(name == 'Content-Type' for name, value in headers):
+                headers.append(('Content-Type', 'text/plain'))
+            headers.append(('Content-Length', str(content_length)))
+        start_response(STATUS_LINES[status], headers)
+        return [body]
+
+
+def _parse_scale(density):
+    """Returns the scale of a density such as "2x", or None if invalid"""
+    if not density.endswith('x'):
+        return None
+    try:
+        scale = float(density[:-1])
+    except ValueError:
+        return None
+    return int(scale) if scale == int(scale) else scale
+
+
+def _format_scale(scale):
+    """Formats a scale for a URL: 2 and 2.0 as "2", 1.5 as "1.5" """
+    if float(scale) == int(scale):
+        return str(int(scale))
+    return str(scale)
+
+
+def _format_for(extension):
+    """Returns the PIL format name for a file extension, or None"""
+    Image.init()
+    return Image.EXTENSION.get('.' + extension.lower())
+
+
+def _extension_for(image_format):
+    """Returns the preferred file extension for a PIL format name"""
+    Image.init()
+    extensions = sorted(extension for extension, name
+                        in Image.EXTENSION.items() if name == image_format)
+    if not extensions:
+        raise ValueError("Unknown image format %s" % (image_format,))
+    # Prefer the extension spelled like the format (".png" for PNG)
+    for extension in extensions:
+        if extension[1:].upper() == image_format:
+            return extension[1:]
+    return extensions[0][1:]
+
+
+def _etag_matches(if_none_match, etag):
+    """
+    Returns True if an If-None-Match header value matches etag. Matching is
+    weak, as RFC 7232 requires for If-None-Match.
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
@@ -42,5 +42,6 @@ setup(
     url = 'https://github.com/isolationism/imagecraft',
     classifiers = [],
     packages = find_packages('imagecraft'),
+    scripts = ['scripts/imagecraft'],
     install_requires = ['Pillow'],
 )
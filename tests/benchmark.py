@@ -0,0 +1,491 @@
+"""
+Benchmarks for the render pipeline.
+
+Synthetic layer stacks are generated for a range of image sizes, layer
+counts and layer mixes, and each stage of the pipeline is timed against
+them: colour parsing, colorization, the premultiplied alpha helpers,
+compositing (including recoloring just the top layer with a prefix cache)
+whole renders (with and without a warm layer cache, and from a compiled
+layer store instead of the source files) and previews. Every
+benchmark runs in a child process so that its peak memory can be measured
+on its own.
+
+    python tests/benchmark.py                          # print the results
+    python tests/benchmark.py --save baseline.json     # record a baseline
+    python tests/benchmark.py --baseline baseline.json # compare against it
+
+When comparing, the run fails (exit status 1) if any benchmark's throughput
+drops, or its peak memory grows, by more than --threshold. The run also fails
+if the median preview takes longer than --preview-target milliseconds, the
+budget for redrawing a colour picker while a slider is dragged.
+"""
+
+# Python standard library
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+
+try:
+    import resource
+except ImportError:
+    resource = None # Peak memory is not measured on Windows
+
+# Third-party libraries
+from PIL import Image, ImageOps
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# This module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from imagecraft import ImageGenerator, LayerCache, LayerStore, PrefixCache, \
+    colorize
+from imagecraft.layer_store import compile_store
+
+SIZES = (64, 256, 1024, 4096)
+LAYER_COUNTS = (1, 5, 20)
+MIXES = ('alpha', 'opaque', 'mixed')
+QUICK_SIZES = (64, 256)
+QUICK_LAYER_COUNTS = (1, 5)
+
+# The pure-Python premultiply helpers take minutes on large images
+MAX_PYTHON_PREMULTIPLY_SIZE = 256
+
+# Each benchmark is repeated until it has run for at least this long
+MIN_SECONDS = 0.5
+MAX_REPEATS = 50
+
+# Peak memory growth below this many MB is never reported as a regression
+MEMORY_SLACK_MB = 2.0
+
+# The largest dimension of previews, and the time allowed for one
+PREVIEW_SIZE = 256
+PREVIEW_TARGET_MS = 10.0
+
+
+def write_layers(directory, size):
+    """
+    Writes the synthetic source layers for one image size into directory:
+
+    alpha0-alpha3 - Greyscale gradients with gradient alpha, each rotated.
+    opaque - A greyscale gradient without an alpha channel.
+    transparent - A layer with no visible pixels.
+    sparse - A gradient visible only in a small box in the middle.
+    wheel - A full-colour layer with gradient alpha, for use uncolorized.
+    """
+    gradient = Image.linear_gradient("L").resize((size, size))
+    for turn in range(4):
+        grey = gradient.rotate(90 * turn)
+        alpha = gradient.rotate(90 * turn + 45)
+        layer = Image.merge("RGBA", (grey, grey, grey, alpha))
+        layer.save(os.path.join(directory, 'alpha%d.png' % turn))
+
+    gradient.convert("RGB").save(os.path.join(directory, 'opaque.png'))
+    Image.new("RGBA", (size, size), (255, 255, 255, 0)).save(
+        os.path.join(directory, 'transparent.png'))
+
+    sparse_alpha = Image.new("L", (size, size), 0)
+    box = (size * 3 // 8, size * 3 // 8, size * 5 // 8, size * 5 // 8)
+    sparse_alpha.paste(gradient.crop(box), box)
+    Image.merge("RGBA", (gradient, gradient, gradient, sparse_alpha)).save(
+        os.path.join(directory, 'sparse.png'))
+
+    colours = Image.merge("RGB", (gradient, gradient.rotate(90),
+                                  gradient.rotate(180)))
+    colours.putalpha(gradient.rotate(270))
+    colours.save(os.path.join(directory, 'wheel.png'))
+
+
+def make_generator(source_path, output_path, count, mix):
+    """
+    Returns an ImageGenerator subclass with `count` layers of the given mix,
+    along with a palette for it.
+
+    alpha - An opaque background under colorized gradient layers.
+    opaque - Colorized layers without alpha, each hiding the one below.
+    mixed - Gradients, transparent and sparse layers, and uncolorized
+        full-colour layers.
+    """
+    if mix == 'alpha':
+        files = ['opaque.png'] + ['alpha%d.png' % (index % 4)
+                                  for index in range(count - 1)]
+    elif mix == 'opaque':
+        files = ['opaque.png'] * count
+    else:
+        cycle = ['alpha0.png', 'transparent.png', 'alpha1.png', 'sparse.png',
+                 'wheel.png', 'alpha2.png']
+        files = [cycle[index % len(cycle)] for index in range(count)]
+
+    layers = []
+    palette = {'transparent': None}
+    for index, filename in enumerate(files):
+        if filename == 'wheel.png':
+            layers.append({'transparent': filename})
+        else:
+            key = 'color%d' % index
+            palette[key] = '#%02X%02X%02X' % ((index * 53) % 256,
+                                               (index * 101) % 256,
+                                               (index * 197) % 256)
+            layers.append({key: filename})
+
+    generator = type('Benchmark', (ImageGenerator,), {
+        'layers': tuple(layers),
+        'output_filename': 'benchmark.png',
+        'image_format': 'PNG',
+        '_default_source_path': source_path,
+        '_default_output_path': output_path,
+    })
+    return generator, palette
+
+
+def time_calls(func, pixels=0):
+    """
+    Calls func repeatedly and returns a dictionary of results: the best
+    and median times per call, calls per second and (if pixels is given)
+    megapixels per second.
+    """
+    func() # Warm up
+    times = []
+    started = time.time()
+    for repeat in range(MAX_REPEATS):
+        before = time.time()
+        func()
+        times.append(time.time() - before)
+        if time.time() - started >= MIN_SECONDS:
+            break
+
+    times.sort()
+    best = max(times[0], 1e-9)
+    result = {'seconds': best, 'median_seconds': times[len(times) // 2],
+              'ops_per_second': 1.0 / best}
+    if pixels:
+        result['mpx_per_second'] = pixels / best / 1e6
+    return result
+
+
+def benchmark_rgbcolor(workdir):
+    """Parses a batch of colours in every supported format"""
+    generator = ImageGenerator({})
+    colours = ['#FF6600', '#F60', (255, 102, 0), 'rgb(100%, 40%, 0%)',
+               'transparent', None] * 100
+
+    def parse():
+        for colour in colours:
+            generator._rgbcolor(colour)
+
+    result = time_calls(parse)
+    result['ops_per_second'] *= len(colours)
+    return result
+
+
+def benchmark_colorize(workdir, size):
+    """Colorizes a greyscale layer"""
+    greyscale = ImageOps.grayscale(
+        Image.open(os.path.join(workdir, str(size), 'alpha0.png')))
+    return time_calls(lambda: colorize(greyscale, (255, 102, 0),
+                                       (255, 255, 255)), size * size)
+
+
+def benchmark_premultiply(workdir, size, implementation):
+    """Removes and re-applies premultiplied alpha on an RGBA layer"""
+    image = Image.open(os.path.join(workdir, str(size), 'alpha0.png'))
+    image.load()
+    generator = ImageGenerator({})
+    remove = getattr(generator,
+                     '_remove_premultiplied_alpha_%s' % implementation)
+    apply = getattr(generator,
+                    '_apply_premultiplied_alpha_%s' % implementation)
+    return time_calls(lambda: apply(remove(image)), size * size)
+
+
+def benchmark_composite(workdir, size, count, mix):
+    """Composites a layer stack, with its layers already decoded"""
+    generator_class, palette = make_generator(
+        os.path.join(workdir, str(size)), workdir, count, mix)
+    generator = generator_class(palette)
+    return time_calls(generator._composite_layers, size * size)
+
+
+def benchmark_recolor(workdir, size, count, mix):
+    """
+    Composites a layer stack with a prefix cache, giving the topmost
+    colorized layer a new color every time
+    """
+    generator_class, palette = make_generator(
+        os.path.join(workdir, str(size)), workdir, count, mix)
+    generator_class.prefix_cache = PrefixCache()
+    top = [name for layer in generator_class.layers for name in layer
+           if name != 'transparent'][-1]
+    calls = [0]
+
+    def recolor():
+        calls[0] += 1
+        palette[top] = '#%06X' % (calls[0] * 7919 % 0x1000000)
+        generator_class(palette)._composite_layers()
+
+    return time_calls(recolor, size * size)
+
+
+def benchmark_render(workdir, size, count, mix, cold=False, stored=False):
+    """
+    Renders and writes a layer stack; if cold, the layers are fetched anew
+    every time, and if stored, they are fetched from a compiled layer store
+    rather than decoded.
+    """
+    generator_class, palette = make_generator(
+        os.path.join(workdir, str(size)), workdir, count, mix)
+    generator = generator_class(palette)
+    if stored:
+        store_path = os.path.join(workdir, '%d-%d-%s.store' % (size, count,
+                                                               mix))
+        layers, sizes = generator._visible_layers()
+        compile_store(store_path, [
+            (os.path.join(generator.source_path, layer.filename), None)
+            for layer in layers])
+        generator.layer_cache = LayerCache(store=LayerStore(store_path))
+
+    def render():
+        if cold:
+            generator.layer_cache.clear()
+        generator.render(force=True)
+
+    return time_calls(render, size * size)
+
+
+def benchmark_preview(workdir, size, count, mix):
+    """
+    Renders previews as a colour picker would while a slider is dragged:
+    each call gives one colorized layer a new color, working up through the
+    layers in turn
+    """
+    generator_class, palette = make_generator(
+        os.path.join(workdir, str(size)), workdir, count, mix)
+    names = [name for layer in generator_class.layers for name in layer
+             if name != 'transparent']
+    calls = [0]
+
+    def drag():
+        calls[0] += 1
+        name = names[calls[0] % len(names)]
+        palette[name] = '#%06X' % (calls[0] * 7919 % 0x1000000)
+        generator_class(palette).render_preview(PREVIEW_SIZE)
+
+    return time_calls(drag, min(size, PREVIEW_SIZE) ** 2)
+
+
+def cases(sizes, layer_counts):
+    """Returns the list of (name, function, arguments) to benchmark"""
+    found = [('rgbcolor', benchmark_rgbcolor, ())]
+    for size in sizes:
+        found.append(('colorize/%d' % size, benchmark_colorize, (size,)))
+        if numpy is not None:
+            found.append(('premultiply_numpy/%d' % size,
+                          benchmark_premultiply, (size, 'numpy')))
+        if size <= MAX_PYTHON_PREMULTIPLY_SIZE:
+            found.append(('premultiply_python/%d' % size,
+                          benchmark_premultiply, (size, 'python')))
+    for size in sizes:
+        for count in layer_counts:
+            for mix in MIXES:
+                suffix = '%d/%d/%s' % (size, count, mix)
+                found.append(('composite/' + suffix, benchmark_composite,
+                              (size, count, mix)))
+                found.append(('recolor/' + suffix, benchmark_recolor,
+                              (size, count, mix)))
+                found.append(('render/' + suffix, benchmark_render,
+                              (size, count, mix)))
+                found.append(('render_cold/' + suffix, benchmark_render,
+                              (size, count, mix, True)))
+                found.append(('render_stored/' + suffix, benchmark_render,
+                              (size, count, mix, True, True)))
+                found.append(('preview/' + suffix, benchmark_preview,
+                              (size, count, mix)))
+    return found
+
+
+def current_rss_mb():
+    """Returns the resident memory of this process in MB, or None"""
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+    except (IOError, OSError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+
+
+def peak_rss_mb():
+    """Returns the peak resident memory of this process in MB, or None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1048576.0 # Reported in bytes
+    return peak / 1024.0 # Reported in kilobytes
+
+
+def run_case(queue, workdir, function, args):
+    """Runs one benchmark; this is the body of the child process"""
+    warnings.simplefilter('ignore')
+    try:
+        started_mb = current_rss_mb() or 0.0
+        result = function(workdir, *args)
+        peak = peak_rss_mb()
+        if peak is not None:
+            result['peak_mb'] = max(0.0, peak - started_mb)
+        queue.put(result)
+    except Exception as error:
+        queue.put({'error': repr(error)})
+
+
+def run(sizes, layer_counts, only=None):
+    """Runs every benchmark and returns a dictionary of name -> result"""
+    workdir = tempfile.mkdtemp(prefix='imagecraft-benchmark-')
+    results = {}
+    try:
+        for size in sizes:
+            os.mkdir(os.path.join(workdir, str(size)))
+            write_layers(os.path.join(workdir, str(size)), size)
+
+        for name, function, args in cases(sizes, layer_counts):
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            queue = multiprocessing.Queue()
+            child = multiprocessing.Process(target=run_case,
+                                            args=(queue, workdir, function,
+                                                  args))
+            child.start()
+            result = queue.get()
+            child.join()
+            results[name] = result
+            report(name, result)
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def report(name, result):
+    """Prints one line of results"""
+    if 'error' in result:
+        print('%-36s  FAILED %s' % (name, result['error']))
+        return
+    line = '%-36s %12.1f/s' % (name, result['ops_per_second'])
+    if 'mpx_per_second' in result:
+        line += ' %9.1f Mpx/s' % result['mpx_per_second']
+    else:
+        line += ' ' * 15
+    if result.get('peak_mb') is not None:
+        line += ' %8.1f MB' % result['peak_mb']
+    print(line)
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns a list of descriptions of the benchmarks in results that have
+    regressed by more than threshold (a fraction) against baseline.
+    """
+    regressions = []
+    for name in sorted(results):
+        current = results[name]
+        previous = baseline.get(name)
+        if previous is None or 'error' in previous:
+            continue
+        if 'error' in current:
+            regressions.append('%s failed: %s' % (name, current['error']))
+            continue
+
+        ratio = current['ops_per_second'] / previous['ops_per_second']
+        if ratio < 1 - threshold:
+            regressions.append('%s throughput %.0f%% of baseline'
+                               % (name, ratio * 100))
+
+        if current.get('peak_mb') is not None and \
+                previous.get('peak_mb') is not None:
+            allowed = previous['peak_mb'] * (1 + threshold) + MEMORY_SLACK_MB
+            if current['peak_mb'] > allowed:
+                regressions.append('%s peak memory %.1f MB, baseline %.1f MB'
+                                   % (name, current['peak_mb'],
+                                      previous['peak_mb']))
+    return regressions
+
+
+def slow_previews(results, target_ms):
+    """
+    Returns a list of descriptions of the preview benchmarks in results
+    whose median time exceeds target_ms milliseconds.
+    """
+    slow = []
+    for name in sorted(results):
+        result = results[name]
+        if not name.startswith('preview/') or 'error' in result:
+            continue
+        median_ms = result['median_seconds'] * 1000
+        if median_ms > target_ms:
+            slow.append('%s takes %.1f ms' % (name, median_ms))
+    return slow
+
+
+def main(argv=None):
+    """Runs the benchmarks from the command line"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the imagecraft render pipeline.")
+    parser.add_argument('--quick', action='store_true',
+                        help="only benchmark small images and layer counts")
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        help="image sizes to benchmark (default: %s)"
+                        % ' '.join(map(str, SIZES)))
+    parser.add_argument('--layers', type=int, nargs='+',
+                        help="layer counts to benchmark (default: %s)"
+                        % ' '.join(map(str, LAYER_COUNTS)))
+    parser.add_argument('--only', nargs='+', metavar='PREFIX',
+                        help="only run benchmarks whose names start with "
+                        "one of these prefixes")
+    parser.add_argument('--save', metavar='FILE',
+                        help="write the results to FILE as a baseline")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="compare the results against a saved baseline")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="the fraction by which a benchmark may regress "
+                        "before the run fails (default: %(default)s)")
+    parser.add_argument('--preview-target', type=float,
+                        default=PREVIEW_TARGET_MS, metavar='MS',
+                        help="the median time a preview may take before the "
+                        "run fails (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes or (QUICK_SIZES if args.quick else SIZES)
+    layer_counts = args.layers or (QUICK_LAYER_COUNTS if args.quick
+                                   else LAYER_COUNTS)
+    results = run(sizes, layer_counts, args.only)
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)
+
+    slow = slow_previews(results, args.preview_target)
+    for description in slow:
+        print('SLOW PREVIEW: %s (target %.1f ms)'
+              % (description, args.preview_target))
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print('REGRESSION: %s' % regression)
+        if regressions:
+            return 1
+        print('No regressions beyond %.0f%%' % (args.threshold * 100))
+
+    return 1 if slow else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""
+Tests for imagecraft.layer_store: renders from a compiled, memory-mapped
+layer store must match renders from the decoded source files.
+
+    python tests/layer_store_test.py
+"""
+
+# Python standard library
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Third-party libraries
+from PIL import Image
+
+# This module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.dirname(__file__))
+from imagecraft import LayerStore, layer_cache
+from imagecraft.layer_store import compile_store, job_sources
+from test import AlphaStarTest, ComplexGradientTest, DualGradientTest, \
+    GeneratorTest, GradientStripe, QuadGradientTest, RGB24_COLORS, \
+    SingleGradientTest, SolidStarTest
+
+GENERATORS = [
+    SingleGradientTest,
+    DualGradientTest,
+    QuadGradientTest,
+    SolidStarTest,
+    AlphaStarTest,
+    ComplexGradientTest,
+    GradientStripe,
+]
+SCALES = [1, 2]
+
+
+class LayerStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.path, 'layers.store')
+        self.jobs = [{
+            'generators': GENERATORS,
+            'palettes': {'test': RGB24_COLORS},
+            'output_path': self.path,
+            'scales': SCALES,
+        }]
+        layer_cache.clear()
+
+    def tearDown(self):
+        layer_cache.store = None
+        layer_cache.clear()
+        shutil.rmtree(self.path)
+
+    def render_all(self, generators=GENERATORS):
+        return [generator_class(RGB24_COLORS, scale=scale).render_image()
+                for generator_class in generators for scale in SCALES]
+
+    def test_renders_match(self):
+        expected = self.render_all()
+        compile_store(self.store_path, job_sources(self.jobs))
+        store = LayerStore(self.store_path)
+        self.assertEqual(store.verify(), [])
+
+        layer_cache.clear()
+        layer_cache.store = store
+        images = self.render_all()
+        for image, reference in zip(images, expected):
+            self.assertEqual(image.mode, reference.mode)
+            self.assertEqual(image.tobytes(), reference.tobytes())
+        # Every layer came from the store; nothing was decoded
+        stats = layer_cache.stats()
+        self.assertTrue(stats['store_loads'] > 0)
+        self.assertEqual(stats['store_loads'], stats['misses'])
+
+    def test_changed_source_file(self):
+        source_path = os.path.join(self.path, 'source')
+        os.mkdir(source_path)
+
+        class Edited(GeneratorTest):
+            _default_source_path = source_path
+            output_filename = 'edited.png'
+            layers = AlphaStarTest.layers
+
+        for layer in Edited.layers:
+            for filename in layer.values():
+                shutil.copy(os.path.join(
+                    AlphaStarTest._default_source_path, filename), source_path)
+        self.jobs[0]['generators'] = [Edited]
+        compile_store(self.store_path, job_sources(self.jobs))
+
+        # The modification time is bumped explicitly, as the file may be
+        # rewritten within its resolution
+        filename = os.path.join(source_path, 'rgba_star.png')
+        Image.open(filename).rotate(90).save(filename)
+        stat = os.stat(filename)
+        os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+        expected = self.render_all([Edited])
+
+        layer_cache.clear()
+        layer_cache.store = LayerStore(self.store_path)
+        for image, reference in zip(self.render_all([Edited]), expected):
+            self.assertEqual(image.tobytes(), reference.tobytes())
+
+    def test_failures(self):
+        self.jobs[0]['generators'] = ['test:Nope', SolidStarTest]
+        self.jobs.append({
+            'generators': [SolidStarTest],
+            'palettes': {'short': {'red': '#FF0000'}},
+            'output_path': self.path,
+        })
+        self.assertRaises(ImportError, job_sources, self.jobs)
+
+        failures = []
+        sources = job_sources(self.jobs, failures)
+        self.assertEqual(sorted((result.generator_name, result.palette_name)
+                                for result in failures),
+                         [('Nope', 'test'), ('Nope', 'test'),
+                          ('SolidStarTest', 'short')])
+        self.assertEqual(set(os.path.basename(path) for path, size
+                             in sources),
+                         set(['rgb_solid.png', 'rgba_star.png']))
+
+    def test_not_a_store(self):
+        with open(self.store_path, 'wb') as fp:
+            fp.write(b'not a layer store at all, just some bytes')
+        self.assertRaises(ValueError, LayerStore, self.store_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
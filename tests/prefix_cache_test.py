@@ -0,0 +1,180 @@
+"""
+Tests for imagecraft.prefix_cache.PrefixCache: renders resumed from a saved
+prefix must be identical to uncached renders, and the cache must stay within
+its size by dropping the least recently used prefixes.
+
+    python tests/prefix_cache_test.py
+"""
+
+# Python standard library
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Third-party libraries
+from PIL import Image
+
+# This module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.dirname(__file__))
+import imagecraft.imagecraft
+from imagecraft import PrefixCache
+from test import AlphaStarTest, ComplexGradientTest, DualGradientTest, \
+    GeneratorTest, GradientStripe, QuadGradientTest, RGB24_COLORS, \
+    SolidStarTest
+
+GENERATORS = (
+    DualGradientTest,
+    QuadGradientTest,
+    SolidStarTest,
+    AlphaStarTest,
+    ComplexGradientTest,
+    GradientStripe,
+)
+
+
+def palettes(count, seed):
+    """
+    Returns count palettes that each change one random color of the one
+    before, so that successive renders share prefixes of varying length.
+    """
+    rng = random.Random(seed)
+    palette = dict(RGB24_COLORS)
+    names = sorted(name for name in palette if name != 'transparent')
+    result = []
+    for unused in range(count):
+        palette = dict(palette)
+        palette[rng.choice(names)] = '#%06X' % rng.randint(0, 0xFFFFFF)
+        result.append(palette)
+    return result
+
+
+class RenderTest(unittest.TestCase):
+    """Renders with a prefix cache must match those without one"""
+
+    def setUp(self):
+        self.cache = PrefixCache()
+
+    def tearDown(self):
+        imagecraft.imagecraft.numpy = self.numpy
+
+    @classmethod
+    def setUpClass(cls):
+        cls.numpy = imagecraft.imagecraft.numpy
+
+    def check(self, generator_class, palette):
+        expected = generator_class(palette).render_image()
+        cached = type('Cached', (generator_class,),
+                      {'prefix_cache': self.cache})
+        image = cached(palette).render_image()
+        self.assertEqual(image.mode, expected.mode)
+        self.assertEqual(image.tobytes(), expected.tobytes(),
+                         (generator_class, palette))
+
+    def check_all(self):
+        for generator_class in GENERATORS:
+            for palette in palettes(12, generator_class.__name__):
+                self.check(generator_class, palette)
+        stats = self.cache.stats()
+        self.assertTrue(stats['hits'] > 0 and stats['states'] > 0, stats)
+
+    def test_frame_compositor(self):
+        if self.numpy is None:
+            self.skipTest("NumPy is not installed")
+        self.check_all()
+
+    def test_pil_compositor(self):
+        imagecraft.imagecraft.numpy = None
+        self.check_all()
+
+    def test_generators_do_not_share_prefixes(self):
+        # Same colors, different source layers
+        for palette in palettes(4, 0):
+            self.check(AlphaStarTest, palette)
+            self.check(QuadGradientTest, palette)
+
+    def test_changed_source_file(self):
+        path = tempfile.mkdtemp()
+        try:
+            class Edited(GeneratorTest):
+                _default_source_path = path
+                output_filename = 'edited.png'
+                layers = AlphaStarTest.layers
+
+            for layer in Edited.layers:
+                for filename in layer.values():
+                    shutil.copy(os.path.join(
+                        AlphaStarTest._default_source_path, filename), path)
+            self.check(Edited, RGB24_COLORS)
+
+            # Change a lower layer; its saved prefixes must not be used.
+            # The modification time is bumped explicitly, as the file may
+            # be rewritten within its resolution.
+            filename = os.path.join(path, 'rgba_grad_ne.png')
+            Image.open(filename).rotate(90).save(filename)
+            stat = os.stat(filename)
+            os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+            self.check(Edited, dict(RGB24_COLORS, purple='#123456'))
+        finally:
+            shutil.rmtree(path)
+
+
+class EvictionTest(unittest.TestCase):
+    """The cache's own bookkeeping"""
+
+    def setUp(self):
+        self.cache = PrefixCache(max_bytes=100)
+
+    def test_find_longest_prefix(self):
+        colors = ('red', 'green', 'blue', 'white')
+        self.cache.save('stack', colors[:1], 'one', 10)
+        self.cache.save('stack', colors[:3], 'three', 10)
+        self.assertEqual(self.cache.find('stack', colors), (3, 'three'))
+        self.assertEqual(self.cache.find('stack', ('red', 'blue', 'blue')),
+                         (1, 'one'))
+        self.assertEqual(self.cache.find('other', colors), (0, None))
+        self.assertEqual(self.cache.find('stack', ('blue', 'green')),
+                         (0, None))
+
+    def test_evicts_least_recently_used(self):
+        for name in ('a', 'b', 'c'):
+            self.cache.save('stack', (name,), name, 40)
+        # "a" went to make room for "c"
+        self.assertEqual(self.cache.find('stack', ('a', 'x')), (0, None))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+        # Finding "b" makes "c" the least recently used
+        self.assertEqual(self.cache.find('stack', ('b', 'x')), (1, 'b'))
+        self.cache.save('stack', ('d',), 'd', 40)
+        self.assertEqual(self.cache.find('stack', ('c', 'x')), (0, None))
+        self.assertEqual(self.cache.find('stack', ('b', 'x')), (1, 'b'))
+        stats = self.cache.stats()
+        self.assertEqual((stats['states'], stats['bytes']), (2, 80))
+
+    def test_too_large(self):
+        self.assertFalse(self.cache.wants('stack', ('a',), 101))
+        self.assertTrue(self.cache.wants('stack', ('a',), 100))
+        self.cache.save('stack', ('a',), 'a', 100)
+        self.assertFalse(self.cache.wants('stack', ('a',), 100))
+
+    def test_replace(self):
+        self.cache.save('stack', ('a',), 'old', 30)
+        self.cache.save('stack', ('a',), 'new', 50)
+        self.assertEqual(self.cache.find('stack', ('a', 'x')), (1, 'new'))
+        self.assertEqual(self.cache.stats()['bytes'], 50)
+
+    def test_render_stays_within_bounds(self):
+        # Large enough for some prefixes of the 100x100 test images only
+        cache = PrefixCache(max_bytes=100 * 100 * 4 * 3)
+        cached = type('Cached', (AlphaStarTest,), {'prefix_cache': cache})
+        for palette in palettes(10, 1):
+            cached(palette).render_image()
+            self.assertTrue(cache.current_bytes <= cache.max_bytes)
+        self.assertTrue(cache.stats()['evictions'] > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+"""
+Tests for imagecraft.result_cache.ResultCache: concurrent requests for the
+same image render it once, failures are not cached and results rendered
+from files that have since changed are not served.
+
+    python tests/result_cache_test.py
+"""
+
+# Python standard library
+import os
+import sys
+import threading
+import time
+import unittest
+
+# This module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.dirname(__file__))
+from imagecraft import ResultCache
+from test import RGB24_COLORS, SingleGradientTest
+
+# Seconds to wait for other threads before giving up
+TIMEOUT = 10
+
+
+def counting_generator(cache):
+    """
+    Returns an ImageGenerator subclass using cache, which counts its renders
+    and can hold them until released. Its fingerprint is its `version`.
+    """
+    class Counting(SingleGradientTest):
+        result_cache = cache
+        version = 1
+        renders = 0
+        fail = False
+        # Set by a render once it starts; renders wait for `release`
+        started = threading.Event()
+        release = threading.Event()
+
+        def fingerprint(self):
+            return 'version-%d' % Counting.version
+
+        def _render_bytes(self, image_format):
+            Counting.renders += 1
+            Counting.started.set()
+            Counting.release.wait(TIMEOUT)
+            if Counting.fail:
+                raise IOError("render failed")
+            return ('%s %s' % (self.colors_for_layers[0].color,
+                               Counting.version)).encode('ascii')
+
+    Counting.release.set()
+    return Counting
+
+
+def wait_for(condition):
+    """Waits for condition() to become true, failing after TIMEOUT"""
+    deadline = time.time() + TIMEOUT
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("Timed out waiting for other threads")
+        time.sleep(0.001)
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResultCache()
+        self.generator = counting_generator(self.cache)
+
+    def render_concurrently(self, count):
+        """
+        Renders count instances at once, the first of which holds its render
+        until every other one is waiting for it. Returns the list of results
+        (or exceptions), in the order the threads were started.
+        """
+        generator = self.generator
+        generator.release.clear()
+        generator.started.clear()
+        results = [None] * count
+
+        def render(position):
+            try:
+                results[position] = generator(RGB24_COLORS).render_bytes()
+            except Exception as error:
+                results[position] = error
+
+        threads = [threading.Thread(target=render, args=(position,))
+                   for position in range(count)]
+        threads[0].start()
+        generator.started.wait(TIMEOUT)
+        for thread in threads[1:]:
+            thread.start()
+        wait_for(lambda: self.cache.stats()['coalesced'] == count - 1)
+        generator.release.set()
+        for thread in threads:
+            thread.join(TIMEOUT)
+        return results
+
+    def test_hit(self):
+        first = self.generator(RGB24_COLORS).render_bytes()
+        second = self.generator(RGB24_COLORS).render_bytes()
+        self.assertEqual(first, second)
+        self.assertEqual(self.generator.renders, 1)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['bytes'], len(first))
+
+    def test_unused_colors_share_results(self):
+        self.generator(RGB24_COLORS).render_bytes()
+        self.generator(dict(RGB24_COLORS, red='#123456')).render_bytes()
+        self.assertEqual(self.generator.renders, 1)
+        self.generator(dict(RGB24_COLORS, white='#123456')).render_bytes()
+        self.assertEqual(self.generator.renders, 2)
+
+    def test_concurrent_requests_render_once(self):
+        results = self.render_concurrently(8)
+        self.assertEqual(self.generator.renders, 1)
+        for result in results:
+            # Waiters are handed the very bytes the render produced
+            self.assertTrue(result is results[0])
+        stats = self.cache.stats()
+        self.assertEqual((stats['misses'], stats['coalesced']), (1, 7))
+
+        self.assertEqual(self.generator(RGB24_COLORS).render_bytes(),
+                         results[0])
+        self.assertEqual(self.generator.renders, 1)
+
+    def test_failure_is_shared_and_not_cached(self):
+        self.generator.fail = True
+        results = self.render_concurrently(4)
+        self.assertEqual(self.generator.renders, 1)
+        for result in results:
+            self.assertTrue(isinstance(result, IOError))
+        self.assertEqual(self.cache.stats()['results'], 0)
+
+        self.generator.fail = False
+        data = self.generator(RGB24_COLORS).render_bytes()
+        self.assertEqual(self.generator.renders, 2)
+        self.assertEqual(self.generator(RGB24_COLORS).render_bytes(), data)
+        self.assertEqual(self.generator.renders, 2)
+
+    def test_stale_fingerprint(self):
+        old = self.generator(RGB24_COLORS).render_bytes()
+        self.generator.version = 2
+        new = self.generator(RGB24_COLORS).render_bytes()
+        self.assertNotEqual(old, new)
+        self.assertEqual(self.generator.renders, 2)
+        stats = self.cache.stats()
+        self.assertEqual((stats['results'], stats['bytes']), (1, len(new)))
+
+    def test_eviction(self):
+        data = self.generator(RGB24_COLORS).render_bytes()
+        cache = self.cache
+        cache.max_bytes = len(data) * 2
+        self.generator(dict(RGB24_COLORS, white='#000001')).render_bytes()
+        self.generator(dict(RGB24_COLORS, white='#000002')).render_bytes()
+        stats = cache.stats()
+        self.assertEqual((stats['results'], stats['evictions']), (2, 1))
+        self.assertTrue(stats['bytes'] <= cache.max_bytes)
+
+        # The least recently used result was the one dropped
+        self.generator(dict(RGB24_COLORS, white='#000002')).render_bytes()
+        self.assertEqual(self.generator.renders, 3)
+        self.generator(RGB24_COLORS).render_bytes()
+        self.assertEqual(self.generator.renders, 4)
+
+    def test_too_large(self):
+        self.cache.max_bytes = 4
+        self.generator(RGB24_COLORS).render_bytes()
+        self.generator(RGB24_COLORS).render_bytes()
+        self.assertEqual(self.generator.renders, 2)
+        self.assertEqual(self.cache.stats()['results'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+"""
+Stress test for concurrent rendering.
+
+Renders the test generators with random palettes on 1, 2, 4 and 8 threads
+at once, each thread sharing the layer cache and the render plans and half
+of the renders sharing a generator instance with another thread. Every image
+is checked against the same render done on one thread, and the throughput of
+each thread count is reported along with its speed-up over one thread.
+
+    python tests/stress.py
+    python tests/stress.py --threads 1 2 4 8 16 --renders 400 --prefix-cache
+    python tests/stress.py --result-cache
+
+The run fails (exit status 1) if any image differs. With --result-cache
+each thread count starts from an empty cache, so none of them is served the
+results of the one before.
+
+Rendering scales with the number of threads up to the number of processors,
+as PIL and NumPy release the GIL while they work. At the size of the test
+images, though, most of a render is spent in Python, holding the GIL; so on
+a machine with several processors the speed-up is checked separately, on
+renders at --speedup-scale (8x, or 800 pixels square, by default) with the
+prefix and result caches turned off. The run also fails if the most threads
+tried (up to the number of processors) do not render at least --min-speedup
+times as fast as one thread. The check is skipped on a single processor.
+"""
+
+# Python standard library
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+
+# This module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from imagecraft import ImageGenerator, PrefixCache, RenderPool, ResultCache
+from test import AlphaStarTest, ComplexGradientTest, DualGradientTest, \
+    GradientStripe, QuadGradientTest, RGB24_COLORS, SingleGradientTest, \
+    SolidStarTest
+
+# OriginalColorTest is left out: its uncolorized layer over an opaque base
+# cannot be rendered at all yet
+GENERATORS = (
+    SingleGradientTest,
+    DualGradientTest,
+    QuadGradientTest,
+    SolidStarTest,
+    AlphaStarTest,
+    ComplexGradientTest,
+    GradientStripe,
+)
+
+
+def random_palette(rng):
+    """Returns a palette with a random colour for every name the tests use"""
+    palette = {}
+    for name in RGB24_COLORS:
+        if name == 'transparent':
+            palette[name] = None
+        else:
+            palette[name] = '#%06X' % rng.randint(0, 0xFFFFFF)
+    return palette
+
+
+def make_generators(count, seed, scale=1):
+    """
+    Returns a list of count generators with random palettes, rendering at
+    the given scale, in which every other entry is the same instance as the
+    one before it.
+    """
+    rng = random.Random(seed)
+    generators = []
+    while len(generators) < count:
+        generator = rng.choice(GENERATORS)(random_palette(rng), scale=scale)
+        generators.extend([generator, generator])
+    return generators[:count]
+
+
+def run(generators, threads):
+    """Renders the generators on a pool, returning (images, seconds)"""
+    with RenderPool(workers=threads) as pool:
+        start = time.time()
+        images = pool.render_bytes(generators)
+        return images, time.time() - start
+
+
+def measure_speedup(threads, renders, seed, scale):
+    """
+    Returns how many times faster `threads` threads render than one thread,
+    with no prefix or result cache, at the given scale.
+    """
+    caches = ImageGenerator.prefix_cache, ImageGenerator.result_cache
+    ImageGenerator.prefix_cache = ImageGenerator.result_cache = None
+    try:
+        generators = make_generators(renders, seed, scale)
+        # Resample the source layers up front, so that neither run pays
+        for generator in generators:
+            generator._layer_stack()
+        single = run(generators, 1)[1]
+        multiple = run(generators, threads)[1]
+    finally:
+        ImageGenerator.prefix_cache, ImageGenerator.result_cache = caches
+    return single / multiple
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Checks that concurrent renders match sequential ones "
+                    "and measures how throughput scales with threads.")
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help="thread counts to try (default: 1 2 4 8)")
+    parser.add_argument('--renders', type=int, default=200,
+                        help="renders per thread count (default: 200)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed for the random palettes")
+    parser.add_argument('--prefix-cache', action='store_true',
+                        help="share a prefix cache between the threads too")
+    parser.add_argument('--result-cache', action='store_true',
+                        help="share a result cache between the threads, so "
+                        "that repeated renders are served from it")
+    parser.add_argument('--min-speedup', type=float, default=1.5,
+                        help="the speed-up over one thread that the most "
+                        "threads must reach on several processors "
+                        "(default: 1.5)")
+    parser.add_argument('--speedup-scale', type=int, default=8,
+                        help="the scale of the renders the speed-up is "
+                        "checked on (default: 8)")
+    parser.add_argument('--speedup-renders', type=int, default=32,
+                        help="renders per run when checking the speed-up "
+                        "(default: 32)")
+    args = parser.parse_args(argv)
+
+    if args.prefix_cache:
+        ImageGenerator.prefix_cache = PrefixCache()
+
+    generators = make_generators(args.renders, args.seed)
+    # The reference images are rendered one at a time, on this thread
+    expected = [generator.render_bytes() for generator in generators]
+
+    failures = 0
+    baseline = None
+    print("%-8s %10s %10s %8s" % ('threads', 'seconds', 'renders/s',
+                                  'speed-up'))
+    for threads in args.threads:
+        if args.result_cache:
+            ImageGenerator.result_cache = ResultCache()
+        images, seconds = run(generators, threads)
+        mismatched = sum(1 for image, reference in zip(images, expected)
+                         if image != reference)
+        failures += mismatched
+        rate = len(generators) / seconds
+        if baseline is None:
+            baseline = rate
+        print("%-8d %10.3f %10.1f %7.2fx%s" % (
+            threads, seconds, rate, rate / baseline,
+            "  %d images differ!" % mismatched if mismatched else ""))
+
+    processors = multiprocessing.cpu_count()
+    print("%d processors; %d threads alive at exit" % (
+        processors, threading.active_count()))
+    if args.result_cache:
+        print("result cache (last run): %r"
+              % ImageGenerator.result_cache.stats())
+
+    threads = min(max(args.threads), processors)
+    if processors < 2:
+        print("Speed-up not checked: only one processor")
+    elif threads < 2:
+        print("Speed-up not checked: needs more than one of --threads")
+    else:
+        speedup = measure_speedup(threads, args.speedup_renders, args.seed,
+                                  args.speedup_scale)
+        print("%d threads render %.2fx as fast as one at %dx scale" % (
+            threads, speedup, args.speedup_scale))
+        if speedup < args.min_speedup:
+            print("Speed-up of %.2fx is below the minimum of %.2fx" % (
+                speedup, args.min_speedup))
+            failures += 1
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
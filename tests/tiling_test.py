@@ -0,0 +1,185 @@
+"""
+Tests for rendering in strips (ImageGenerator.max_render_bytes): the pixels
+must match a full-frame render, and the memory used must stay under the
+ceiling even when the decoded source images would not fit under it.
+
+    python tests/tiling_test.py
+"""
+
+# Python standard library
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from io import BytesIO
+
+try:
+    import resource
+except ImportError:
+    resource = None # Peak memory is not measured on Windows
+
+# Third-party libraries
+from PIL import Image
+
+# This module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.dirname(__file__))
+from imagecraft.tiling import PNGReader, TiledImage
+from test import AlphaStarTest, ComplexGradientTest, RGB24_COLORS
+
+# A print-size banner, whose five decoded source layers take about 180 MB
+BANNER_SIZE = (3000, 2000)
+CEILING = 16 * 1024 * 1024
+
+
+def make_banner_sources(path):
+    """Writes banner-sized copies of the AlphaStarTest source images"""
+    for layer in AlphaStarTest.layers:
+        for filename in layer.values():
+            image = Image.open(os.path.join(
+                AlphaStarTest._default_source_path, filename))
+            image.resize(BANNER_SIZE, Image.BILINEAR).save(
+                os.path.join(path, filename))
+
+
+class Sink(object):
+    """A writable file-like object that only counts what it is given"""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+def peak_growth(source_path, max_render_bytes):
+    """
+    Renders the banner in this process, streaming it out as PNG, and prints
+    how many bytes the peak resident memory grew by. Run in a fresh process
+    by PeakMemoryTest.
+    """
+    class Banner(AlphaStarTest):
+        _default_source_path = source_path
+
+    # Load every code path first, so that only the render is measured
+    small = type('Small', (AlphaStarTest,), {'max_render_bytes': 20000})
+    small(RGB24_COLORS).render_to(Sink())
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    Banner.max_render_bytes = max_render_bytes
+    Banner(RGB24_COLORS).render_to(Sink())
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+    sys.stdout.write('%d\n' % ((after - before) * scale))
+
+
+class TiledRenderTest(unittest.TestCase):
+
+    def render(self, generator_class, max_render_bytes, image_format='PNG',
+               scale=None):
+        tiled = type('Tiled', (generator_class,),
+                     {'max_render_bytes': max_render_bytes})
+        generator = tiled(RGB24_COLORS, scale=scale)
+        self.assertTrue(isinstance(generator._render_output(), TiledImage))
+        return Image.open(BytesIO(generator.render_bytes(image_format)))
+
+    def test_matches_full_frame(self):
+        for generator_class in (AlphaStarTest, ComplexGradientTest):
+            expected = generator_class(RGB24_COLORS).render_image()
+            for max_render_bytes in (1, 20000, 200000):
+                for image_format in ('PNG', 'TIFF'):
+                    image = self.render(generator_class, max_render_bytes,
+                                        image_format)
+                    self.assertEqual(image.mode, expected.mode)
+                    self.assertEqual(image.tobytes(), expected.tobytes(),
+                                     (generator_class, max_render_bytes))
+
+    def test_scaled(self):
+        # Resampled layers cannot be read in strips, so are held whole
+        expected = AlphaStarTest(RGB24_COLORS, scale=2).render_image()
+        image = self.render(AlphaStarTest, 50000, scale=2)
+        self.assertEqual(image.tobytes(), expected.tobytes())
+
+    def test_rendered_twice(self):
+        tiled = type('Tiled', (AlphaStarTest,), {'max_render_bytes': 50000})
+        image = tiled(RGB24_COLORS)._render_output()
+        self.assertEqual(image.assemble().tobytes(),
+                         image.assemble().tobytes())
+
+
+class PNGReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_strips_match_whole_image(self):
+        wheel = Image.open(os.path.join(AlphaStarTest._default_source_path,
+                                        'rgba_rgb_wheel.png'))
+        wheel = wheel.convert('RGBA').resize((301, 203))
+        rng = random.Random(0)
+        for mode in ('RGBA', 'RGB', 'LA', 'L', 'P'):
+            for options in ({}, {'optimize': True}, {'compress_level': 0}):
+                filename = os.path.join(self.path, 'wheel.png')
+                wheel.convert(mode).save(filename, **options)
+                expected = Image.open(filename)
+                expected.load()
+
+                with PNGReader(filename) as reader:
+                    self.assertEqual(reader.size, expected.size)
+                    top = 0
+                    while reader.row < reader.size[1]:
+                        strip = reader.read(rng.choice((1, 2, 7, 50)))
+                        bottom = top + strip.size[1]
+                        self.assertEqual(strip.mode, expected.mode)
+                        self.assertEqual(strip.tobytes(), expected.crop(
+                            (0, top, expected.size[0], bottom)).tobytes())
+                        top = bottom
+                self.assertEqual(top, expected.size[1])
+
+    def test_unreadable(self):
+        filename = os.path.join(self.path, 'wheel.png')
+        Image.new('RGBA', (10, 10)).save(filename, 'TIFF')
+        self.assertRaises(ValueError, PNGReader, filename)
+        Image.new('I;16', (10, 10)).save(filename, 'PNG')
+        self.assertRaises(ValueError, PNGReader, filename)
+
+
+@unittest.skipIf(resource is None, "peak memory cannot be measured here")
+class PeakMemoryTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.path = tempfile.mkdtemp()
+        make_banner_sources(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path)
+
+    def test_under_ceiling(self):
+        growth = int(subprocess.check_output([
+            sys.executable, '-c',
+            'import tiling_test; tiling_test.peak_growth(%r, %d)' % (
+                self.path, CEILING)],
+            cwd=os.path.dirname(os.path.abspath(__file__))))
+        self.assertTrue(growth < CEILING,
+                        "peak memory grew by %d bytes" % growth)
+
+    def test_matches_full_frame(self):
+        class Banner(AlphaStarTest):
+            _default_source_path = self.path
+
+        expected = Banner(RGB24_COLORS).render_image()
+        Banner.max_render_bytes = CEILING
+        image = Image.open(BytesIO(Banner(RGB24_COLORS).render_bytes()))
+        self.assertEqual(image.tobytes(), expected.tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
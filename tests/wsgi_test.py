@@ -0,0 +1,147 @@
+"""
+Tests for imagecraft.wsgi.SkinServer, run through a local WSGI client.
+
+    python tests/wsgi_test.py
+"""
+
+# Python standard library
+import io
+import os
+import sys
+import unittest
+from wsgiref.util import setup_testing_defaults
+
+# This module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.dirname(__file__))
+from imagecraft.wsgi import SkinServer, palette_hash
+from test import DualGradientTest, GeneratorTest, RGB24_COLORS, \
+    SingleGradientTest
+
+
+class MissingSourceTest(GeneratorTest):
+    """A generator whose source image does not exist, so it cannot render"""
+    output_filename = "missing_source_test.png"
+    layers = (
+        {'white': 'no_such_layer.png'},
+    )
+
+
+class Client(object):
+    """Calls a WSGI application the way a server would"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, path, method='GET', headers=None):
+        """Returns (status code, headers dictionary, body) for a request"""
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'wsgi.errors': io.StringIO() if sys.version_info[0] > 2
+                           else io.BytesIO(),
+        }
+        environ.update(headers or {})
+        setup_testing_defaults(environ)
+        response = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            response['status'] = int(status.split()[0])
+            response['headers'] = dict(response_headers)
+
+        body = b''.join(self.app(environ, start_response))
+        return response['status'], response['headers'], body
+
+
+class SkinServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = SkinServer([SingleGradientTest, DualGradientTest,
+                               MissingSourceTest], palettes=[RGB24_COLORS])
+        self.client = Client(self.app)
+
+    def test_render(self):
+        url = self.app.url_for(SingleGradientTest, RGB24_COLORS)
+        status, headers, body = self.client.request(url)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'image/png')
+        self.assertEqual(int(headers['Content-Length']), len(body))
+        self.assertIn('max-age=3600', headers['Cache-Control'])
+        self.assertEqual(body, SingleGradientTest(RGB24_COLORS).render_bytes())
+
+    def test_head(self):
+        url = self.app.url_for(SingleGradientTest, RGB24_COLORS)
+        status, headers, body = self.client.request(url, method='HEAD')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'')
+        self.assertTrue(int(headers['Content-Length']) > 0)
+
+    def test_etag(self):
+        url = self.app.url_for(SingleGradientTest, RGB24_COLORS)
+        etag = self.client.request(url)[1]['ETag']
+        self.assertEqual(etag, '"%s"' % SingleGradientTest(
+            RGB24_COLORS).fingerprint())
+        self.assertEqual(self.client.request(url)[1]['ETag'], etag)
+
+        other = self.app.url_for(DualGradientTest, RGB24_COLORS)
+        self.assertNotEqual(self.client.request(other)[1]['ETag'], etag)
+
+    def test_not_modified(self):
+        url = self.app.url_for(SingleGradientTest, RGB24_COLORS)
+        etag = self.client.request(url)[1]['ETag']
+        for if_none_match in (etag, 'W/%s' % etag, '"other", %s' % etag):
+            status, headers, body = self.client.request(
+                url, headers={'HTTP_IF_NONE_MATCH': if_none_match})
+            self.assertEqual(status, 304)
+            self.assertEqual(headers['ETag'], etag)
+            self.assertEqual(body, b'')
+
+        status = self.client.request(
+            url, headers={'HTTP_IF_NONE_MATCH': '"other"'})[0]
+        self.assertEqual(status, 200)
+
+    def test_scale(self):
+        url = self.app.url_for(SingleGradientTest, RGB24_COLORS, scale=2)
+        self.assertTrue(url.endswith('@2x.png'))
+        self.assertEqual(self.client.request(url)[0], 200)
+        self.assertEqual(self.client.request(
+            url.replace('@2x', '@5x'))[0], 404)
+
+    def test_not_found(self):
+        key = palette_hash(RGB24_COLORS)
+        for path in ('/', '/SingleGradientTest',
+                     '/NoSuchTest/%s.png' % key,
+                     '/SingleGradientTest/0123456789abcdef.png',
+                     '/SingleGradientTest/%s.nope' % key,
+                     '/SingleGradientTest/%s.gif' % key,
+                     '/SingleGradientTest/%s.png/extra' % key):
+            self.assertEqual(self.client.request(path)[0], 404, path)
+
+    def test_formats(self):
+        self.assertRaises(ValueError, self.app.url_for, SingleGradientTest,
+                          RGB24_COLORS, extension='gif')
+
+        app = SkinServer([SingleGradientTest], palettes=[RGB24_COLORS],
+                         formats=('PNG', 'GIF'))
+        url = app.url_for(SingleGradientTest, RGB24_COLORS, extension='gif')
+        status, headers, body = Client(app).request(url)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'image/gif')
+        self.assertEqual(Client(app).request(
+            url.replace('.gif', '.bmp'))[0], 404)
+
+    def test_method_not_allowed(self):
+        url = self.app.url_for(SingleGradientTest, RGB24_COLORS)
+        status, headers, body = self.client.request(url, method='POST')
+        self.assertEqual(status, 405)
+        self.assertEqual(headers['Allow'], 'GET, HEAD')
+
+    def test_render_failure(self):
+        url = self.app.url_for(MissingSourceTest, RGB24_COLORS)
+        status, headers, body = self.client.request(url)
+        self.assertEqual(status, 500)
+        self.assertEqual(body, b'Internal server error')
+
+
+if __name__ == '__main__':
+    unittest.main()